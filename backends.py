@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+'''
+Registry of the graph databases the tools talk to (Neptune, Neo4j, and any plugins).
+
+A Backend knows its connection options and default batch sizes, and which module holds its writer, reader and
+is_transient (csv2neptune, csv2neo4j). That module, and with it gremlin_python or the neo4j driver, is only imported
+once a command actually connects, so building the command line and --help never pay for the drivers.
+
+Plugins are modules that call register() with a Backend subclass of their own, which must implement connect();
+list them, comma separated, in the COREDEX_PLUGINS environment variable and they are imported the first time the
+registry is used.
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import abc
+import importlib
+import os
+
+_BACKENDS = {}
+_plugins_loaded = False
+
+
+class Connection(object):
+    '''
+    What a command needs from a connected backend.
+    :param open_writer: callable returning a new writer (see parallel_load.py)
+    :param open_reader: callable returning a new reader (see graph_export.py)
+    :param is_transient: callable(exception) -> bool, see write_control.py
+    :param close: callable releasing whatever the writers and readers share
+    '''
+    def __init__(self, open_writer, open_reader, is_transient, close=None):
+        self.open_writer = open_writer
+        self.open_reader = open_reader
+        self.is_transient = is_transient
+        self.close = close or (lambda: None)
+
+
+class Backend(abc.ABC):
+    '''
+    A graph database. Subclasses add their connection options and must implement connect(); one that does not
+    cannot be instantiated, so a plugin missing it fails when it registers rather than when a command connects.
+    :param name: subcommand name
+    :param module: module with the backend's writer, reader and is_transient, imported on first use
+    :param help: one line for the command line help
+    '''
+    # Defaults for -b and --max-batch-size when writing, and the page sizes when exporting
+    batch_size = 1000
+    max_batch_size = 20000
+    page_size = 1000
+    max_page_size = 10000
+
+    def __init__(self, name, module, help):
+        self.name = name
+        self.module_name = module
+        self.help = help
+
+    def module(self):
+        return importlib.import_module(self.module_name)
+
+    def add_options(self, parser):
+        pass
+
+    @abc.abstractmethod
+    def connect(self, args, write=True):
+        '''
+        :param args: parsed options, including those from add_options()
+        :param write: False for read-only use, which must leave the database as it is
+        :return: Connection
+        '''
+
+
+class NeptuneBackend(Backend):
+    batch_size = 50
+    max_batch_size = 500
+    page_size = 500
+    max_page_size = 5000
+
+    def add_options(self, parser):
+        parser.add_argument('-n', '--neptune', dest='neptune', action="store", metavar="URI:PORT", required=True)
+
+    def connect(self, args, write=True):
+        module = self.module()
+        neptune_constr = "ws://%s/gremlin" % args.neptune
+        return Connection(lambda: module.NeptuneWriter(neptune_constr), lambda: module.NeptuneReader(neptune_constr),
+                          module.is_transient)
+
+
+class Neo4jBackend(Backend):
+    page_size = 5000
+    max_page_size = 50000
+
+    def add_options(self, parser):
+        parser.add_argument('-n', '--neo4j', dest='neo4j', action="store", metavar="URI:PORT", required=True)
+        parser.add_argument('-u', '--username', dest='username', action="store", metavar="STRING", required=True)
+        parser.add_argument('-p', '--password', dest='password', action="store", metavar="STRING", required=True)
+
+    def connect(self, args, write=True):
+        module = self.module()
+        from neo4j import GraphDatabase
+        driver = GraphDatabase.driver("bolt://%s" % args.neo4j, auth=(args.username, args.password))
+        if write:
+            with driver.session() as session:
+                module.create_id_constraint(session)
+        return Connection(lambda: module.Neo4jWriter(driver), lambda: module.Neo4jReader(driver),
+                          module.is_transient, driver.close)
+
+
+def register(backend):
+    '''
+    Add a backend (or replace the one of the same name).
+    :param backend: Backend instance
+    '''
+    if not isinstance(backend, Backend):
+        raise TypeError("%r is not a backends.Backend" % (backend,))
+    _BACKENDS[backend.name] = backend
+
+
+def _load_plugins():
+    global _plugins_loaded
+    if _plugins_loaded:
+        return
+    _plugins_loaded = True
+    for name in os.environ.get('COREDEX_PLUGINS', '').split(','):
+        if name.strip():
+            importlib.import_module(name.strip())
+
+
+def names():
+    _load_plugins()
+    return list(_BACKENDS)
+
+
+def get(name):
+    _load_plugins()
+    return _BACKENDS[name]
+
+
+def add_parsers(subparsers, verb, configure=None):
+    '''
+    Add one subcommand per backend, with its connection options.
+    :param subparsers: from parser.add_subparsers(dest='backend')
+    :param verb: how the command uses the database, for the help, e.g. 'Load into'
+    :param configure: optional callable(subparser, backend) adding the command's own options
+    '''
+    for name in names():
+        backend = _BACKENDS[name]
+        parser = subparsers.add_parser(name, help="%s %s" % (verb, backend.help))
+        backend.add_options(parser)
+        if configure is not None:
+            configure(parser, backend)
+
+
+def connect(args, write=True):
+    '''
+    Connect to the backend chosen on the command line (args.backend).
+    :return: Connection
+    '''
+    return get(args.backend).connect(args, write)
+
+
+register(NeptuneBackend('neptune', 'csv2neptune', 'AWS Neptune'))
+register(Neo4jBackend('neo4j', 'csv2neo4j', 'Neo4j'))
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+'''
+Loader benchmarks that need no Neptune or Neo4j.
+
+  bench.py generate  writes a synthetic graph in the station-nodes.csv / station-edges.csv format
+  bench.py run       loads a graph through csv2neptune's or csv2neo4j's writers into a local sink and reports
+                     rows/sec, peak memory and time per phase (parse, load, and the vertex and edge phases of the
+                     load)
+
+The real writers are used, only the transport is replaced: for Neptune a RemoteConnection that accepts the traversal
+bytecode, for Neo4j a driver whose sessions accept the Cypher and parameters. The "memory" sink answers immediately and
+records what it was sent; the "latency" sink also sleeps for a fixed time per request, like a server on the network.
+The sink can also charge a cost per row and reject requests above a capacity with the backend's transient error (a
+Neo4j TransientError, a Neptune ConcurrentModificationException), to exercise the adaptive write controller.
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import argparse
+import csv
+import json
+import os
+import random
+import resource
+import threading
+import time
+import tracemalloc
+
+import metrics
+import neptune_bin
+import neptune_csv
+import write_control
+from parallel_load import ParallelLoader
+
+import logging
+logging.basicConfig()
+LOG = logging.getLogger('bench')
+LOG.setLevel(logging.INFO)
+
+COLORS = ["red", "blue", "orange", "silver", "green", "yellow"]
+
+
+def generate(out_dir, n_edges, n_vertices=None, seed=42):
+    '''
+    Write a random graph with the same columns as wmata2csv.py produces, streaming so any size fits in memory.
+    :return: (vertex file, edge file)
+    '''
+    n_vertices = n_vertices or max(2, n_edges // 2)
+    rng = random.Random(seed)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    v_file = os.path.join(out_dir, "station-nodes.csv")
+    e_file = os.path.join(out_dir, "station-edges.csv")
+
+    with open(v_file, 'w', newline='') as out_fh:
+        writer = csv.writer(out_fh, delimiter=',')
+        writer.writerow(["~id", "~label", "name:string", "lat:double", "lon:double", "color:string"])
+        for i in range(n_vertices):
+            writer.writerow(["S%08d" % i, "STATION", "Station %d" % i,
+                             round(rng.uniform(38.7, 39.2), 6), round(rng.uniform(-77.4, -76.8), 6),
+                             rng.choice(COLORS)])
+
+    with open(e_file, 'w', newline='') as out_fh:
+        writer = csv.writer(out_fh, delimiter=',')
+        writer.writerow(["~id", "~from", "~to", "~label", "distance:int", "color:string"])
+        for i in range(n_edges):
+            writer.writerow(["E%09d" % i, "S%08d" % rng.randrange(n_vertices), "S%08d" % rng.randrange(n_vertices),
+                             "SEGMENT", rng.randint(500, 20000), rng.choice(COLORS)])
+
+    return v_file, e_file
+
+
+class Recorder(object):
+    '''
+    What a sink was sent, shared by all of its connections.
+    '''
+    def __init__(self, latency=0.0, row_latency=0.0, capacity=None):
+        self.latency = latency
+        self.row_latency = row_latency
+        self.capacity = capacity
+        # Set by writer_factory: callable(rows) returning the backend's exception for an oversized request
+        self.overload = None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rows = 0
+        self.rejected = 0
+
+    def request(self, rows):
+        delay = self.latency + self.row_latency * rows
+        if delay:
+            time.sleep(delay)
+        if self.capacity and rows > self.capacity:
+            with self.lock:
+                self.rejected += 1
+            raise self.overload(rows)
+        with self.lock:
+            self.requests += 1
+            self.rows += rows
+
+
+class FakeGremlinRemote(object):
+    '''
+    Stands in for DriverRemoteConnection: takes the traversal bytecode and answers every traversal with one result.
+    '''
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def submit(self, bytecode):
+        from gremlin_python.driver.remote_connection import RemoteTraversal
+        from gremlin_python.process.traversal import Traverser
+
+        # Each addV/addE step is one row, as is each coalesce() of the upserts that retries are sent as
+        self.recorder.request(sum(1 for step in bytecode.step_instructions if step[0] in ('addV', 'addE', 'coalesce')))
+        try:
+            return RemoteTraversal(iter([Traverser(1)]), None)
+        except TypeError:
+            # gremlinpython 3.5+ dropped the side effects argument
+            return RemoteTraversal(iter([Traverser(1)]))
+
+    def close(self):
+        pass
+
+
+class FakeNeo4jResult(object):
+    def consume(self):
+        return None
+
+
+class FakeNeo4jSession(object):
+    '''
+    Stands in for both a neo4j session and its explicit transactions.
+    '''
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def begin_transaction(self):
+        return self
+
+    def run(self, cql, rows=None, **params):
+        self.recorder.request(len(rows) if rows is not None else 0)
+        return FakeNeo4jResult()
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class FakeNeo4jDriver(object):
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def session(self, **kwargs):
+        return FakeNeo4jSession(self.recorder)
+
+    def close(self):
+        pass
+
+
+def writer_factory(backend, recorder):
+    '''
+    :return: (callable opening a new csv2neptune / csv2neo4j writer connected to the fake sink,
+              the backend's is_transient)
+    '''
+    if backend == 'neptune':
+        from gremlin_python.driver.protocol import GremlinServerError
+        from csv2neptune import NeptuneWriter, is_transient
+        recorder.overload = lambda rows: GremlinServerError({
+            "code": 500, "attributes": {},
+            "message": '{"code":"ConcurrentModificationException","detailedMessage":"%d steps"}' % rows})
+        open_writer = lambda: NeptuneWriter(None, remote=FakeGremlinRemote(recorder))
+    elif backend == 'neo4j':
+        from neo4j.exceptions import TransientError
+        from csv2neo4j import Neo4jWriter, is_transient
+        recorder.overload = lambda rows: TransientError("Transaction of %d rows rejected" % rows)
+        driver = FakeNeo4jDriver(recorder)
+        open_writer = lambda: Neo4jWriter(driver)
+    else:
+        raise ValueError("Unknown backend %s" % backend)
+    return open_writer, is_transient
+
+
+class Phase(object):
+    '''
+    Times one phase and records its peak traced memory (when tracemalloc is running).
+    '''
+    def __init__(self, report, name):
+        self.report = report
+        self.name = name
+
+    def __enter__(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        phase = self.report["phases"].setdefault(self.name, {})
+        phase["seconds"] = round(time.time() - self.start, 4)
+        if tracemalloc.is_tracing():
+            phase["peak_traced_mb"] = round(tracemalloc.get_traced_memory()[1] / 1048576.0, 2)
+
+
+def run(backend, v_file, e_file, latency=0.0, workers=4, batch_size=None, trace_memory=False, row_latency=0.0,
+        capacity=None, max_batch_size=None, parse_workers=1):
+    '''
+    Load v_file and e_file through the backend's writers into a fake sink.
+    :param row_latency: extra seconds the sink spends per row of a request
+    :param capacity: largest request (in rows) the sink accepts
+    :param max_batch_size: let the write controller adapt the batch size up to this; None keeps it fixed
+    :param parse_workers: processes parsing the CSVs (see parallel_csv.py)
+    :return: report dict
+    '''
+    batch_size = batch_size or (50 if backend == 'neptune' else 1000)
+    report = {"backend": backend, "latency_ms": latency * 1000, "workers": workers, "batch_size": batch_size,
+              "parse_workers": parse_workers, "phases": {}}
+    if trace_memory:
+        tracemalloc.start()
+
+    # Parse only, to separate CSV cost from load cost
+    with Phase(report, "parse"):
+        n_rows = sum(1 for path in (v_file, e_file) for _ in neptune_csv.iter_records(path, workers=parse_workers))
+    report["phases"]["parse"]["rows"] = n_rows
+
+    recorder = Recorder(latency, row_latency, capacity)
+    open_writer, is_transient = writer_factory(backend, recorder)
+    load_metrics = metrics.Metrics()
+    if max_batch_size:
+        controller = write_control.WriteController(batch_size, max_batch_size=max_batch_size, inflight=workers,
+                                                   max_inflight=workers * 2, is_transient=is_transient,
+                                                   backoff_base=0.01, metrics=load_metrics)
+    else:
+        controller = write_control.WriteController(batch_size, inflight=workers * 2, max_inflight=workers * 2,
+                                                   adaptive=False, is_transient=is_transient, backoff_base=0.01,
+                                                   metrics=load_metrics)
+
+    # One load, as the loaders run it, so edges wait for (and overlap with) the vertex partitions they need
+    with Phase(report, "load"):
+        n_vertices, n_edges = ParallelLoader(open_writer, workers=workers, metrics=load_metrics,
+                                             controller=controller).load(
+            neptune_csv.iter_records(v_file, workers=parse_workers), neptune_csv.iter_records(e_file, workers=parse_workers))
+    report["phases"]["load"]["rows"] = n_vertices + n_edges
+    # The loader times its own vertex and edge phases
+    load_phases = load_metrics.snapshot()["phases"]
+    report["phases"]["vertices"] = {"seconds": load_phases["vertices"]["seconds"], "rows": n_vertices}
+    report["phases"]["edges"] = {"seconds": load_phases["edges"]["seconds"], "rows": n_edges}
+
+    if trace_memory:
+        tracemalloc.stop()
+
+    for phase in report["phases"].values():
+        phase["rows_per_sec"] = round(phase["rows"] / phase["seconds"], 1) if phase["seconds"] else None
+    report["requests"] = recorder.requests
+    report["rows_sent"] = recorder.rows
+    report["rejected"] = recorder.rejected
+    report["final_batch_size"] = controller.batch_size
+    report["final_inflight"] = controller.inflight
+    # Request latency as the loader saw it, per writer method
+    report["latency"] = load_metrics.snapshot()["latency"]
+    # ru_maxrss is in kilobytes on Linux
+    report["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+    return report
+
+
+def print_report(report):
+    print("%s: %d workers, batch size %d, %.1f ms latency, %d parse workers" % (
+        report["backend"], report["workers"], report["batch_size"], report["latency_ms"], report["parse_workers"]))
+    for name in ("parse", "load", "vertices", "edges"):
+        phase = report["phases"][name]
+        line = "  %-9s %10d rows %9.3f s %12s rows/s" % (name, phase["rows"], phase["seconds"], phase["rows_per_sec"])
+        if "peak_traced_mb" in phase:
+            line += " %8.2f MB peak" % phase["peak_traced_mb"]
+        print(line)
+    for name, summary in sorted(report["latency"].items()):
+        if summary["count"]:
+            print("  %s: p50 %.2f ms, p99 %.2f ms" % (name, summary["p50"] * 1000, summary["p99"] * 1000))
+    print("  %d requests, %d rows sent, %d rejected, %.1f MB peak RSS" % (
+        report["requests"], report["rows_sent"], report["rejected"], report["peak_rss_mb"]))
+    print("  final batch size %d, %d in flight" % (report["final_batch_size"], report["final_inflight"]))
+
+
+def main():
+    args = parse_options()
+
+    if args.command == 'generate':
+        v_file, e_file = generate(args.out_dir, args.edges, args.vertices, args.seed)
+        print("Wrote %s and %s" % (v_file, e_file))
+        if args.binary:
+            for csv_file in (v_file, e_file):
+                neptune_bin.convert(csv_file, os.path.splitext(csv_file)[0] + '.cdx')
+            print("Wrote the .cdx tables next to them")
+        return
+
+    report = run(args.backend, args.vertices, args.edges, latency=args.latency_ms / 1000.0, workers=args.workers,
+                 batch_size=args.batch_size, trace_memory=args.trace_memory,
+                 row_latency=args.row_latency_us / 1000000.0, capacity=args.capacity,
+                 max_batch_size=args.max_batch_size, parse_workers=args.parse_workers)
+    if args.json:
+        print(json.dumps(report, sort_keys=True))
+    else:
+        print_report(report)
+
+
+def parse_options():
+     parser = argparse.ArgumentParser(description='Benchmark the loaders against local sinks')
+     subparsers = parser.add_subparsers(dest='command')
+     subparsers.required = True
+
+     gen = subparsers.add_parser('generate', help='Write a synthetic graph')
+     gen.add_argument('-o', '--out-dir', dest='out_dir', action="store", metavar="DIR", required=True)
+     gen.add_argument('-e', '--edges', dest='edges', action="store", metavar="INT", type=int, default=100000)
+     gen.add_argument('-v', '--vertices', dest='vertices', action="store", metavar="INT", type=int,
+                      help='Number of vertices (default: half the number of edges)')
+     gen.add_argument('--seed', dest='seed', action="store", metavar="INT", type=int, default=42)
+     gen.add_argument('--binary', dest='binary', action="store_true",
+                      help='Also write the graph as .cdx tables (see neptune_bin.py)')
+
+     bench = subparsers.add_parser('run', help='Load a graph into a local sink and report throughput')
+     bench.add_argument('-b', '--backend', dest='backend', choices=['neptune', 'neo4j'], default='neptune')
+     bench.add_argument('-v', '--vertices', dest='vertices', action="store", metavar="FILE", required=True)
+     bench.add_argument('-e', '--edges', dest='edges', action="store", metavar="FILE", required=True)
+     bench.add_argument('-l', '--latency-ms', dest='latency_ms', action="store", metavar="MS", type=float, default=0.0,
+                        help='Simulated round trip per request; 0 records in memory only (default 0)')
+     bench.add_argument('-w', '--workers', dest='workers', action="store", metavar="INT", type=int, default=4)
+     bench.add_argument('--batch-size', dest='batch_size', action="store", metavar="INT", type=int,
+                        help='Rows per request (default: the loader\'s own default)')
+     bench.add_argument('--row-latency-us', dest='row_latency_us', action="store", metavar="US", type=float,
+                        default=0.0, help='Simulated server time per row of a request (default 0)')
+     bench.add_argument('--capacity', dest='capacity', action="store", metavar="ROWS", type=int,
+                        help='Reject larger requests with the backend\'s transient error')
+     bench.add_argument('--max-batch-size', dest='max_batch_size', action="store", metavar="INT", type=int,
+                        help='Let the write controller adapt the batch size up to this (default: fixed batches)')
+     bench.add_argument('--parse-workers', dest='parse_workers', action="store", metavar="INT", type=int, default=1,
+                        help='Processes parsing the CSVs, see parallel_csv.py (default 1)')
+     bench.add_argument('--trace-memory', dest='trace_memory', action="store_true",
+                        help='Report peak traced memory per phase (slows the run down)')
+     bench.add_argument('--json', dest='json', action="store_true", help='Print the report as one JSON line')
+
+     return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''
+One command for the coredex tools: each subcommand runs one of the scripts with the rest of the command line.
+
+  coredex.py fetch -a $API_KEY --binary
+  coredex.py validate -v data/station-nodes.csv -e data/station-edges.csv -o clean/
+  coredex.py load neptune -n $NEPTUNE:8182 -v data/station-nodes.csv -e data/station-edges.csv
+  coredex.py export neo4j -n localhost:7687 -u neo4j -p secret -v nodes.csv -e edges.csv
+  coredex.py bench run -v /tmp/bench/nodes.csv -e /tmp/bench/edges.csv
+
+Only the script that runs is imported, so neither the database drivers nor requests are loaded to print the help
+or to run a command that does not use them. "load" picks the loader from the backend registry (backends.py), so a
+plugin backend whose module has a main() can be loaded into the same way.
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import argparse
+import importlib
+import sys
+
+import backends
+
+# Subcommand -> (module whose main() runs it, help)
+COMMANDS = [
+    ('fetch', 'wmata2csv', 'Dump the WMATA network to Neptune CSVs'),
+    ('validate', 'preflight', 'Check Neptune CSVs for duplicate ids and dangling edges before loading'),
+    ('load', None, 'Load Neptune CSVs into a graph database'),
+    ('export', 'graph_export', 'Export a graph from a database to Neptune CSVs'),
+    ('pipeline', 'pipeline', 'Fetch the WMATA network and load it as it arrives'),
+    ('live', 'live_feed', 'Keep live WMATA properties of the station graph up to date'),
+    ('bench', 'bench', 'Benchmark the loaders against local sinks'),
+]
+
+
+def run(module_name, prog, argv):
+    '''
+    Run a script's main() as if it had been started with argv.
+    '''
+    sys.argv = [prog] + argv
+    return importlib.import_module(module_name).main()
+
+
+def main():
+    command, argv = parse_options()
+    prog = "%s %s" % (sys.argv[0], command)
+    if command == 'load':
+        if not argv or argv[0] not in backends.names():
+            print("usage: %s {%s} ..." % (prog, ','.join(backends.names())), file=sys.stderr)
+            return 2
+        return run(backends.get(argv[0]).module_name, "%s %s" % (prog, argv[0]), argv[1:])
+    return run(dict((name, module) for name, module, _ in COMMANDS)[command], prog, argv)
+
+
+def parse_options():
+     '''
+     :return: (command, the rest of the command line)
+     '''
+     # Everything after the command, -h included, belongs to the script, so argparse only sees what comes before it
+     argv = sys.argv[1:]
+     if argv and argv[0] in [name for name, _, _ in COMMANDS]:
+         return argv[0], argv[1:]
+
+     parser = argparse.ArgumentParser(description='Fetch, check, load, export and benchmark the WMATA station graph',
+                                      epilog='Run "%(prog)s COMMAND -h" for the options of a command.')
+     subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+     subparsers.required = True
+     for name, module, help in COMMANDS:
+         if name == 'load':
+             help = "%s (%s)" % (help, ', '.join(backends.names()))
+         subparsers.add_parser(name, help=help)
+     # Only gets here for -h or a mistake
+     parser.parse_args(argv)
+     parser.error("missing COMMAND")
+
+if __name__ == '__main__':
+    sys.exit(main())
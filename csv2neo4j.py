@@ -5,13 +5,52 @@ Load a CSV file into a Neo4j Database. Inefficiently and Dangerously.
 from __future__  import print_function  # Python 2/3 compatibility
 import argparse
 import csv
+import os
 
 from neo4j import GraphDatabase
+from neo4j.exceptions import CypherSyntaxError, ServiceUnavailable, SessionExpired, TransientError
+
+import delta_load
+import metrics
+import neptune_csv
+import write_control
+from parallel_load import ParallelLoader
 
 import logging
 logging.basicConfig()
 LOG = logging.getLogger('csv2neo4j')
-LOG.setLevel(logging.DEBUG)
+LOG.setLevel(logging.INFO)
+
+# Rows are sent as a single $rows parameter so the query text (and its plan) is the same for every batch
+CQL_CREATE_NODES = "UNWIND $rows AS row CREATE (n:Station) SET n = row"
+CQL_CREATE_EDGES = ("UNWIND $rows AS row "
+                    "MATCH (a:Station {id: row.from}) "
+                    "MATCH (b:Station {id: row.to}) "
+                    "CREATE (a)-[r:SEGMENT]->(b) SET r = row.props")
+
+# Used by --delta: SET n = row also removes properties that are no longer in the CSV
+CQL_MERGE_NODES = "UNWIND $rows AS row MERGE (n:Station {id: row.id}) SET n = row"
+CQL_MERGE_EDGES = ("UNWIND $rows AS row "
+                   "MATCH (a:Station {id: row.from}) "
+                   "MATCH (b:Station {id: row.to}) "
+                   "MERGE (a)-[r:SEGMENT {id: row.props.id}]->(b) SET r = row.props")
+CQL_DELETE_NODES = "UNWIND $rows AS id MATCH (n:Station {id: id}) DETACH DELETE n"
+CQL_DELETE_EDGES = ("UNWIND $rows AS row "
+                    "MATCH (:Station {id: row.from})-[r:SEGMENT {id: row.id}]->(:Station {id: row.to}) "
+                    "DELETE r")
+
+# Used by live_feed.py: SET n += sets only the given properties, and removes those that are null
+CQL_UPDATE_NODES = "UNWIND $rows AS row MATCH (n:Station {id: row.id}) SET n += row.props"
+
+# Used by graph_export.py. Pages are ranges of the indexed Station.id, in index order, and a page of edges is every
+# SEGMENT leaving a page of nodes
+CQL_COUNT_NODES = "MATCH (n:Station) RETURN count(n) AS count"
+CQL_SAMPLE_IDS = "MATCH (n:Station) WHERE rand() < $fraction RETURN n.id AS id"
+CQL_NODE_RANGE = "MATCH (n:Station) WHERE n.id > $after %s WITH n ORDER BY n.id LIMIT $limit "
+CQL_EXPORT_NODES = "RETURN n.id AS id, labels(n)[0] AS label, properties(n) AS props ORDER BY id"
+CQL_EXPORT_EDGES = ("OPTIONAL MATCH (n)-[r:SEGMENT]->(b:Station) "
+                    "RETURN n.id AS node, collect(CASE WHEN r IS NULL THEN null ELSE "
+                    "{id: r.id, label: type(r), to: b.id, props: properties(r)} END) AS edges ORDER BY node")
 
 def id_transform(original_id):
     '''
@@ -21,6 +60,231 @@ def id_transform(original_id):
     '''
     return "id_"+original_id
 
+def row_properties(row):
+    '''
+    Pull every property out of a record, leaving the system (`~`) columns behind.
+    :param row: record from neptune_csv
+    :return: dict of property name -> typed value
+    '''
+    return dict((key, value) for key, value in row.items() if not key.startswith('~'))
+
+def create_id_constraint(session):
+    '''
+    Make sure Station.id is indexed before we start MATCHing edge endpoints, otherwise every edge is a label scan.
+    :param session: Neo4j session
+    '''
+    try:
+        session.run("CREATE CONSTRAINT IF NOT EXISTS FOR (n:Station) REQUIRE n.id IS UNIQUE").consume()
+    except CypherSyntaxError:
+        # Neo4j 3.5 (see NEO4J.md) only understands the older syntax
+        session.run("CREATE CONSTRAINT ON (n:Station) ASSERT n.id IS UNIQUE").consume()
+
+def is_transient(exc):
+    '''
+    Whether a failed batch is worth retrying (see write_control.py). Connection errors may come after the commit
+    went through, which is why retries are sent as MERGEs (see parallel_load.py).
+    '''
+    # Hitting the transaction memory limit is a client error, but the retry goes out as smaller batches
+    code = getattr(exc, 'code', None) or ''
+    if 'OutOfMemory' in code or 'MemoryLimit' in code:
+        return True
+    if hasattr(exc, 'is_retryable'):
+        # neo4j 5+ knows which of its errors are safe to retry
+        return exc.is_retryable()
+    return isinstance(exc, (TransientError, ServiceUnavailable, SessionExpired))
+
+def run_batch(session, cql, rows):
+    '''
+    Send one batch of rows as a single parameter list in its own explicit transaction.
+    '''
+    with session.begin_transaction() as tx:
+        tx.run(cql, rows=rows).consume()
+        tx.commit()
+
+class Neo4jWriter(object):
+    '''
+    Writer for parallel_load.ParallelLoader: one session on the shared driver, which pools the connections.
+    '''
+    def __init__(self, driver):
+        self.session = driver.session()
+
+    def write_vertices(self, batch, cql=CQL_CREATE_NODES):
+        rows = []
+        for row in batch:
+            # Note that we are transforming ids because of a bug in GraphExp
+            props = row_properties(row)
+            props["id"] = id_transform(row["~id"])
+            rows.append(props)
+
+        run_batch(self.session, cql, rows)
+        LOG.debug("Wrote %d nodes (%s .. %s)", len(rows), rows[0]["id"], rows[-1]["id"])
+
+    def upsert_vertices(self, batch):
+        self.write_vertices(batch, CQL_MERGE_NODES)
+
+    def update_properties(self, batch):
+        rows = [{"id": id_transform(row["~id"]), "props": row_properties(row)} for row in batch]
+        run_batch(self.session, CQL_UPDATE_NODES, rows)
+        LOG.debug("Updated %d nodes (%s .. %s)", len(rows), rows[0]["id"], rows[-1]["id"])
+
+    def delete_vertices(self, ids):
+        run_batch(self.session, CQL_DELETE_NODES, [id_transform(vertex_id) for vertex_id in ids])
+        LOG.debug("Deleted %d nodes", len(ids))
+
+    def delete_edges(self, edges):
+        rows = [{"id": id_transform(edge_id), "from": id_transform(from_id), "to": id_transform(to_id)}
+                for edge_id, from_id, to_id in edges]
+        run_batch(self.session, CQL_DELETE_EDGES, rows)
+        LOG.debug("Deleted %d edges", len(rows))
+
+    def write_edges(self, batch, cql=CQL_CREATE_EDGES):
+        rows = []
+        for row in batch:
+            # Note that we are transforming ids because of a bug in GraphExp
+            props = row_properties(row)
+            props["id"] = id_transform(row["~id"])
+            rows.append({
+                "from": id_transform(row["~from"]),
+                "to": id_transform(row["~to"]),
+                "props": props
+            })
+
+        run_batch(self.session, cql, rows)
+        LOG.debug("Wrote %d edges (%s .. %s)", len(rows), rows[0]["props"]["id"], rows[-1]["props"]["id"])
+
+    def upsert_edges(self, batch):
+        self.write_edges(batch, CQL_MERGE_EDGES)
+
+    def close(self):
+        self.session.close()
+
+class Neo4jReader(object):
+    '''
+    Reader for graph_export.py: one session on the shared driver. Ids come back as stored, i.e. with id_transform()
+    applied, and the id property is returned as the id rather than as a property.
+    '''
+    # The id index answers a page of ids in order with a range seek, see _run_range()
+    pages = True
+
+    def __init__(self, driver):
+        self.session = driver.session()
+
+    def sample_ids(self, n):
+        count = self.session.run(CQL_COUNT_NODES).single()["count"]
+        if not count:
+            return []
+        return [record["id"] for record in self.session.run(CQL_SAMPLE_IDS, fraction=min(1.0, float(n) / count))]
+
+    def _run_range(self, tail, after, upper, limit):
+        # Two query texts rather than "$upper IS NULL OR ...", which would keep the planner off the index range seek
+        cql = CQL_NODE_RANGE % ("AND n.id <= $upper" if upper is not None else "") + tail
+        return list(self.session.run(cql, after=after if after is not None else '', upper=upper, limit=limit))
+
+    def vertex_page(self, after, upper, limit):
+        '''
+        :return: list of (id, label, properties) for the first limit nodes with after < id <= upper, by id
+        '''
+        page = []
+        for record in self._run_range(CQL_EXPORT_NODES, after, upper, limit):
+            props = dict(record["props"])
+            props.pop("id", None)
+            page.append((record["id"], record["label"], props))
+        return page
+
+    def edge_page(self, after, upper, limit):
+        '''
+        Outgoing relationships of the first limit nodes with after < id <= upper.
+        :return: (list of (id, label, from id, to id, properties), id of the last of those nodes or None)
+        '''
+        records = self._run_range(CQL_EXPORT_EDGES, after, upper, limit)
+        page = []
+        for record in records:
+            for edge in record["edges"]:
+                props = dict(edge["props"])
+                props.pop("id", None)
+                page.append((edge["id"], edge["label"], record["node"], edge["to"], props))
+        return page, records[-1]["node"] if records else None
+
+    def close(self):
+        self.session.close()
+
+# Neptune CSV property types -> neo4j-admin import types. Neptune dates are not always ISO-8601, so keep them as text.
+NEO4J_IMPORT_TYPES = {
+    'bool': 'boolean',
+    'boolean': 'boolean',
+    'byte': 'byte',
+    'short': 'short',
+    'int': 'int',
+    'long': 'long',
+    'float': 'float',
+    'double': 'double',
+    'string': 'string',
+    'date': 'string'
+}
+
+def import_header(column):
+    '''
+    neo4j-admin import header for a property column of the Neptune CSV.
+    :param column: neptune_csv.Column
+    :return: e.g. "lat:double", or "colors:string[]" for array types
+    '''
+    ptype = column.type
+    suffix = ''
+    if ptype.endswith('[]'):
+        ptype, suffix = ptype[:-2], '[]'
+    return "%s:%s%s" % (column.name, NEO4J_IMPORT_TYPES.get(ptype, 'string'), suffix)
+
+def convert_for_import(in_file, out_file, system_headers, system_values):
+    '''
+    Stream one Neptune CSV into neo4j-admin import format, a row at a time.
+    :param system_headers: import headers written in place of the Neptune system columns
+    :param system_values: function(row, schema) -> values for those headers
+    :return: number of rows written
+    '''
+    count = 0
+    with open(in_file) as in_fh, open(out_file, 'w', newline='') as out_fh:
+        reader = csv.reader(in_fh, delimiter=',', quotechar='"')
+        writer = csv.writer(out_fh, delimiter=',', quotechar='"')
+        schema = neptune_csv.Schema(next(reader))
+        properties = schema.property_columns
+
+        writer.writerow(system_headers + [import_header(column) for column in properties])
+        for row in reader:
+            if not row:
+                continue
+            row = row + [''] * (len(schema.headers) - len(row))
+            writer.writerow(system_values(row, schema) + [row[column.index] for column in properties])
+            count += 1
+    return count
+
+def export_for_import(v_file, e_file, out_dir):
+    '''
+    Write nodes.csv and relationships.csv for `neo4j-admin import`, which is much faster than Cypher for a first
+    load. Labels and ids match what the transactional load creates (Station/SEGMENT, id_transform()ed ids in `id`).
+    '''
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    nodes_file = os.path.join(out_dir, "nodes.csv")
+    relationships_file = os.path.join(out_dir, "relationships.csv")
+
+    def node_values(row, schema):
+        return [id_transform(row[schema.by_name["~id"].index]), "Station"]
+
+    def relationship_values(row, schema):
+        return [id_transform(row[schema.by_name["~id"].index]),
+                id_transform(row[schema.by_name["~from"].index]),
+                id_transform(row[schema.by_name["~to"].index]),
+                "SEGMENT"]
+
+    n_nodes = convert_for_import(v_file, nodes_file, ["id:ID", ":LABEL"], node_values)
+    n_relationships = convert_for_import(e_file, relationships_file, ["id", ":START_ID", ":END_ID", ":TYPE"],
+                                         relationship_values)
+
+    print("Nodes: %s (%s)" % (n_nodes, nodes_file))
+    print("Relationships: %s (%s)" % (n_relationships, relationships_file))
+    print("Import with: neo4j-admin import --nodes=%s --relationships=%s" % (nodes_file, relationships_file))
+    print("Then index the ids: CREATE CONSTRAINT FOR (n:Station) REQUIRE n.id IS UNIQUE")
+
 def main():
     # Read the variables
     args = parse_options()
@@ -28,6 +292,15 @@ def main():
     v_file = args.vertices
     e_file = args.edges
 
+    if args.export_dir:
+        # Offline bulk import; nothing is sent to the database
+        export_for_import(v_file, e_file, args.export_dir)
+        if args.delta:
+            # So the first --delta run after the import only sends what changed since
+            delta_load.save_snapshot(args.delta, delta_load.build_snapshot(v_file, e_file, args.parse_workers))
+            print("Delta snapshot: %s" % args.delta)
+        return
+
     # Connect to Neo4j
     neo4j_constr = "bolt://%s" % neo4j
     username = args.username
@@ -37,64 +310,60 @@ def main():
     graphDB_Driver  = GraphDatabase.driver(neo4j_constr, auth=(username, password))
 
     with graphDB_Driver.session() as graphDB_Session:
+        # Index the ids first so the node CREATEs check uniqueness cheaply and the edge MATCHes are lookups
+        create_id_constraint(graphDB_Session)
+
+    load_metrics = metrics.Metrics()
+    # Batch size and sessions in flight follow the server's latency and errors, see write_control.py
+    controller = write_control.controller_from_args(args, is_transient, load_metrics)
+    with metrics.reporter_from_args(args, load_metrics, LOG):
+        if args.delta:
+            # Only send what changed since the last load recorded in the snapshot
+            delta_load.load_delta(lambda: Neo4jWriter(graphDB_Driver), v_file, e_file, args.delta,
+                                  workers=args.workers, batch_size=args.batch_size, metrics=load_metrics,
+                                  controller=controller, parse_workers=args.parse_workers)
+            graphDB_Driver.close()
+            return
 
-        # Load the nodes / vertices from csv
-        with open(v_file) as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=',', quotechar='"')
-            for row in reader:
-                # Note that we are transforming ids because of a bug in GraphExp
-                myid = id_transform(row["~id"])
-                print(myid)
-
-                cqlCreateNode = "CREATE (n:Station {{id: \"{}\", name: \"{}\", color:\"{}\"}})".format(myid, row["name:string"], row["color:string"])
-                print(cqlCreateNode)
-                graphDB_Session.run(cqlCreateNode)
-
-    #             v = g.addV(row["~label"]).property(T.id, myid)
-    #             for key in row:
-    #                 if key.startswith('~'):
-    #                     continue
-    #                 plabel, ptype = key.split(':')
-    #                 v.property(plabel, row[key])
-    #             v.next()
-
-        # Load the edges
-        with open(e_file) as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=',', quotechar='"')
-            for row in reader:
-                # Note that we are transforming ids because of a bug in GraphExp
-                edge_id = id_transform(row["~id"])
-                from_id = id_transform(row["~from"])
-                to_id = id_transform(row["~to"])
-                print(edge_id)
-
-                cqlCreateEdge = "MATCH (a:Station), (b:Station) WHERE a.id = \"{}\" AND b.id = \"{}\" CREATE (a)-[r:SEGMENT]->(b)".format(from_id, to_id)
-                print(cqlCreateEdge)
-                graphDB_Session.run(cqlCreateEdge)
-
-        #         e = g.V(from_id).addE(row["~label"]).to( g.V(to_id) ).property(T.id, edge_id)
-
-        #         for key in row:
-        #             if key.startswith('~'):
-        #                 continue
-        #             plabel, ptype = key.split(':')
-        #             e.property(plabel, row[key])
-        #         e.next()
-
-
-    # print("Vertices: %s" % g.V().count().next())
-    # print("Edges: %s" % g.E().count().next())
+        # Load the nodes / vertices, then the edges, over a pool of sessions
+        loader = ParallelLoader(lambda: Neo4jWriter(graphDB_Driver), workers=args.workers, metrics=load_metrics,
+                                controller=controller)
+        # Rows come off the typed reader, so numeric properties are sent as numbers rather than strings
+        vertices = neptune_csv.iter_records(v_file, workers=args.parse_workers)
+        edges = neptune_csv.iter_records(e_file, workers=args.parse_workers)
+        n_vertices, n_edges = loader.load(vertices, edges)
+
+    print("Vertices: %s" % n_vertices)
+    print("Edges: %s" % n_edges)
+
+    graphDB_Driver.close()
 
 
 def parse_options():
      parser = argparse.ArgumentParser(description='Load CSVs into Neo4j')
-     parser.add_argument('-n', '--neo4j', dest='neo4j', action="store", metavar="URI:PORT", required=True)
-     parser.add_argument('-u', '--username', dest='username', action="store", metavar="STRING", required=True)
-     parser.add_argument('-p', '--password', dest='password', action="store", metavar="STIRNG", required=True)
+     parser.add_argument('-n', '--neo4j', dest='neo4j', action="store", metavar="URI:PORT")
+     parser.add_argument('-u', '--username', dest='username', action="store", metavar="STRING")
+     parser.add_argument('-p', '--password', dest='password', action="store", metavar="STIRNG")
      parser.add_argument('-v', '--vertices', dest='vertices', action="store", metavar="FILE", required=True)
      parser.add_argument('-e', '--edges', dest='edges', action="store", metavar="FILE", required=True)
-     
-     return parser.parse_args()
+     parser.add_argument('-b', '--batch-size', dest='batch_size', action="store", metavar="INT", type=int, default=1000,
+                         help='Number of rows sent per UNWIND transaction to start with (default 1000)')
+     parser.add_argument('-w', '--workers', dest='workers', action="store", metavar="INT", type=int, default=4,
+                         help='Number of concurrent sessions (default 4)')
+     parser.add_argument('-d', '--delta', dest='delta', action="store", metavar="SNAPSHOT",
+                         help='Only load what changed since the snapshot file, then update it '
+                              '(with -x: write the snapshot of the exported CSVs)')
+     parser.add_argument('-x', '--export-dir', dest='export_dir', action="store", metavar="DIR",
+                         help='Write neo4j-admin import CSVs to DIR instead of loading over bolt')
+     parser.add_argument('--parse-workers', dest='parse_workers', action="store", metavar="INT", type=int,
+                         help='Processes parsing the CSVs (default: one per core for files of 64 MB and more)')
+     write_control.add_options(parser, max_batch_size=20000)
+     metrics.add_options(parser)
+
+     args = parser.parse_args()
+     if not args.export_dir and not (args.neo4j and args.username and args.password):
+         parser.error("-n/--neo4j, -u/--username and -p/--password are required unless exporting with -x/--export-dir")
+     return args
 
 if __name__ == '__main__':
     main()
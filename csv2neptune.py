@@ -4,19 +4,27 @@ Load a CSV file into an AWS Neptune instance. Inefficiently and Dangerously.
 '''
 from __future__  import print_function  # Python 2/3 compatibility
 import argparse
-import csv
 
-from gremlin_python import statics
 from gremlin_python.structure.graph import Graph
 from gremlin_python.process.graph_traversal import __
-from gremlin_python.process.strategies import *
 from gremlin_python.driver.driver_remote_connection import DriverRemoteConnection
-from gremlin_python.process.traversal import T
+from gremlin_python.driver.protocol import GremlinServerError
+from gremlin_python.process.traversal import T, Cardinality, P
+
+import delta_load
+import metrics
+import neptune_csv
+import write_control
+from parallel_load import ParallelLoader
 
 import logging
 logging.basicConfig()
 LOG = logging.getLogger('csv2neptune')
-LOG.setLevel(logging.DEBUG)
+LOG.setLevel(logging.INFO)
+
+# Neptune errors that mean "overloaded" or "collided with another writer"; worth retrying, as upserts (see parallel_load.py)
+TRANSIENT_ERRORS = ('ConcurrentModificationException', 'TimeLimitExceededException', 'ThrottlingException',
+                    'MemoryLimitExceededException', 'TooManyRequestsException', 'ReadOnlyViolationException')
 
 def id_transform(original_id):
     '''
@@ -26,6 +34,252 @@ def id_transform(original_id):
     '''
     return "id_"+original_id
 
+def add_properties(t, row, cardinality=None):
+    '''
+    Chain a .property() step onto traversal t for every property in the record.
+    '''
+    for key, value in row.items():
+        if key.startswith('~'):
+            continue
+        if cardinality is None:
+            t = t.property(key, value)
+        else:
+            t = t.property(cardinality, key, value)
+    return t
+
+def vertex_batch_traversal(g, batch):
+    '''
+    Build one traversal that adds every vertex in the batch, so the whole batch costs a single round trip.
+    :param g: graph traversal source
+    :param batch: list of vertex rows
+    :return: traversal, not yet submitted
+    '''
+    t = g
+    for row in batch:
+        # Note that we are transforming ids because of a bug in GraphExp
+        t = t.addV(row["~label"]).property(T.id, id_transform(row["~id"]))
+        t = add_properties(t, row)
+    return t
+
+def vertex_upsert_traversal(g, batch):
+    '''
+    Like vertex_batch_traversal(), but an existing vertex is reused (fold/coalesce) and has its properties replaced
+    instead of failing on the duplicate id.
+    :param g: graph traversal source
+    :param batch: list of vertex rows
+    :return: traversal, not yet submitted
+    '''
+    t = g
+    for row in batch:
+        # Note that we are transforming ids because of a bug in GraphExp
+        myid = id_transform(row["~id"])
+        t = t.V(myid).fold().coalesce(__.unfold(), __.addV(row["~label"]).property(T.id, myid))
+        t = t.sideEffect(__.properties().drop())
+        t = add_properties(t, row, Cardinality.single)
+    return t
+
+def property_update_traversal(g, batch):
+    '''
+    Build one traversal that sets the properties in each row on an existing vertex, and removes those whose value is
+    None. Every vertex is updated in its own sideEffect(), so a missing vertex does not stop the rest of the batch.
+    :param g: graph traversal source
+    :param batch: list of rows with "~id" and the properties to change
+    :return: traversal, not yet submitted
+    '''
+    t = g.inject(0)
+    for row in batch:
+        update = __.V(id_transform(row["~id"]))
+        for key, value in row.items():
+            if key.startswith('~'):
+                continue
+            if value is None:
+                update = update.sideEffect(__.properties(key).drop())
+            else:
+                update = update.property(Cardinality.single, key, value)
+        t = t.sideEffect(update)
+    return t
+
+def edge_batch_traversal(g, batch):
+    '''
+    Build one traversal that adds every edge in the batch. Each distinct endpoint is looked up once with V() and
+    labelled with as_(), the addE() steps then refer to the labels instead of repeating the lookup.
+    :param g: graph traversal source
+    :param batch: list of edge rows
+    :return: traversal, not yet submitted
+    '''
+    t = g
+    step_labels = {}
+    for row in batch:
+        for endpoint in (row["~from"], row["~to"]):
+            if endpoint not in step_labels:
+                step_labels[endpoint] = "v%d" % len(step_labels)
+                t = t.V(id_transform(endpoint)).as_(step_labels[endpoint])
+
+    for row in batch:
+        # Note that we are transforming ids because of a bug in GraphExp
+        t = t.addE(row["~label"]).from_(step_labels[row["~from"]]).to(step_labels[row["~to"]])
+        t = t.property(T.id, id_transform(row["~id"]))
+        t = add_properties(t, row)
+    return t
+
+def edge_upsert_traversal(g, batch):
+    '''
+    Like edge_batch_traversal(), but an edge that already exists is reused and has its properties replaced instead
+    of failing on the duplicate id. The edge is looked for among the outgoing edges of its ~from vertex (the
+    equivalent of E(id).fold().coalesce(...), which cannot be chained mid-traversal).
+    :param g: graph traversal source
+    :param batch: list of edge rows
+    :return: traversal, not yet submitted
+    '''
+    t = g
+    step_labels = {}
+    for row in batch:
+        for endpoint in (row["~from"], row["~to"]):
+            if endpoint not in step_labels:
+                step_labels[endpoint] = "v%d" % len(step_labels)
+                t = t.V(id_transform(endpoint)).as_(step_labels[endpoint])
+
+    for row in batch:
+        # Note that we are transforming ids because of a bug in GraphExp
+        myid = id_transform(row["~id"])
+        from_label, to_label = step_labels[row["~from"]], step_labels[row["~to"]]
+        t = t.coalesce(__.select(from_label).outE(row["~label"]).hasId(myid),
+                       __.addE(row["~label"]).from_(from_label).to(to_label).property(T.id, myid))
+        t = t.sideEffect(__.properties().drop())
+        t = add_properties(t, row)
+    return t
+
+def is_transient(exc):
+    '''
+    Whether a failed batch is worth retrying (see write_control.py).
+    '''
+    return isinstance(exc, GremlinServerError) and any(name in str(exc) for name in TRANSIENT_ERRORS)
+
+class NeptuneWriter(object):
+    '''
+    Writer for parallel_load.ParallelLoader: each one holds its own WebSocket connection to the endpoint.
+    A ready-made remote connection (e.g. bench.py's fake server) can be passed in instead.
+    '''
+    def __init__(self, neptune_constr, remote=None):
+        self.remote = remote if remote is not None else DriverRemoteConnection(neptune_constr,'g')
+        self.g = Graph().traversal().withRemote(self.remote)
+
+    def write_vertices(self, batch):
+        vertex_batch_traversal(self.g, batch).iterate()
+        LOG.debug("Added %d vertices (%s .. %s)", len(batch), batch[0]["~id"], batch[-1]["~id"])
+
+    def write_edges(self, batch):
+        self._write_edges(edge_batch_traversal, batch)
+        LOG.debug("Added edges %s .. %s", batch[0]["~id"], batch[-1]["~id"])
+
+    def _write_edges(self, build, batch):
+        '''
+        Send the traversal build(g, batch) makes. The endpoints are all looked up before the first edge is added, and
+        a missing one leaves no traverser for the rest, so an empty result means nothing was written: then the
+        edges with a missing endpoint are left out and the rest is sent again.
+        '''
+        if build(self.g, batch).count().next():
+            return
+        batch = self._skip_missing_endpoints(batch)
+        if batch and not build(self.g, batch).count().next():
+            raise RuntimeError("Edge batch %s .. %s wrote nothing although its endpoints exist"
+                               % (batch[0]["~id"], batch[-1]["~id"]))
+
+    def _skip_missing_endpoints(self, batch):
+        '''
+        Look up every endpoint of the batch, log the edges with a missing one and leave them out.
+        :return: the edges whose endpoints both exist
+        '''
+        endpoints = set(row[key] for row in batch for key in ("~from", "~to"))
+        found = set(self.g.V(*[id_transform(endpoint) for endpoint in endpoints]).id().toList())
+        kept = []
+        for row in batch:
+            missing = [row[key] for key in ("~from", "~to") if id_transform(row[key]) not in found]
+            if missing:
+                LOG.error("Skipped edge %s: endpoint vertex %s does not exist", row["~id"], ', '.join(missing))
+            else:
+                kept.append(row)
+        return kept
+
+    def upsert_vertices(self, batch):
+        vertex_upsert_traversal(self.g, batch).iterate()
+        LOG.debug("Upserted %d vertices (%s .. %s)", len(batch), batch[0]["~id"], batch[-1]["~id"])
+
+    def upsert_edges(self, batch):
+        self._write_edges(edge_upsert_traversal, batch)
+        LOG.debug("Upserted %d edges (%s .. %s)", len(batch), batch[0]["~id"], batch[-1]["~id"])
+
+    def update_properties(self, batch):
+        property_update_traversal(self.g, batch).iterate()
+        LOG.debug("Updated %d vertices (%s .. %s)", len(batch), batch[0]["~id"], batch[-1]["~id"])
+
+    def delete_vertices(self, ids):
+        # Dropping a vertex drops its edges too
+        self.g.V(*[id_transform(vertex_id) for vertex_id in ids]).drop().iterate()
+        LOG.debug("Deleted %d vertices", len(ids))
+
+    def delete_edges(self, edges):
+        self.g.E(*[id_transform(edge_id) for edge_id, from_id, to_id in edges]).drop().iterate()
+        LOG.debug("Deleted %d edges", len(edges))
+
+    def close(self):
+        self.remote.close()
+
+class NeptuneReader(object):
+    '''
+    Reader for graph_export.py: reads the graph one vertex id range at a time over its own WebSocket connection. Ids
+    come back as stored, i.e. with id_transform() applied.
+    '''
+    # Neptune has no index it can walk in id order, so order().by(T.id).limit() sorts every vertex after the last
+    # page on every page. A range is read unordered instead, with limit() only to bound the response, and
+    # graph_export.py cuts a range in two when it has more rows than that.
+    pages = False
+
+    def __init__(self, neptune_constr, remote=None):
+        self.remote = remote if remote is not None else DriverRemoteConnection(neptune_constr,'g')
+        self.g = Graph().traversal().withRemote(self.remote)
+
+    def sample_ids(self, n, after=None, upper=None):
+        return self._vertex_range(after, upper).id().sample(n).toList()
+
+    def _vertex_range(self, after, upper):
+        t = self.g.V()
+        if after is not None:
+            t = t.has(T.id, P.gt(after))
+        if upper is not None:
+            t = t.has(T.id, P.lte(upper))
+        return t
+
+    def vertex_range(self, after, upper, limit):
+        '''
+        :return: list of (id, label, properties) for the vertices with after < id <= upper, in no particular order and
+                 no more than limit + 1 of them (all for limit None). Property values are lists (one per value of
+                 the property).
+        '''
+        t = self._vertex_range(after, upper)
+        if limit is not None:
+            t = t.limit(limit + 1)
+        rows = (t.project('id', 'label', 'props').by(T.id).by(T.label).by(__.valueMap())
+                .toList())
+        return [(row['id'], row['label'], row['props']) for row in rows]
+
+    def edge_range(self, after, upper, limit):
+        '''
+        :return: list of (id, label, from id, to id, properties) for the outgoing edges of the vertices with
+                 after < id <= upper, so edges are read by the same id ranges as the vertices; no more than
+                 limit + 1 of them (all for limit None)
+        '''
+        t = self._vertex_range(after, upper).outE()
+        if limit is not None:
+            t = t.limit(limit + 1)
+        rows = (t.project('id', 'label', 'from', 'to', 'props')
+                .by(T.id).by(T.label).by(__.outV().id()).by(__.inV().id()).by(__.valueMap())
+                .toList())
+        return [(row['id'], row['label'], row['from'], row['to'], row['props']) for row in rows]
+
+    def close(self):
+        self.remote.close()
+
 def main():
     # Read the variables
     args = parse_options()
@@ -36,47 +290,32 @@ def main():
     # Connect to Neptune
     neptune_constr = "ws://%s/gremlin" % neptune
     LOG.debug("Connecting to Neptune REST Endpoint %s", neptune)
-    graph = Graph()
-
-    g = graph.traversal().withRemote(DriverRemoteConnection(neptune_constr,'g'))
-
-    # Load the nodes / vertices from csv
-    with open(v_file) as csvfile:
-        reader = csv.DictReader(csvfile, delimiter=',', quotechar='"')
-        for row in reader:
-            # Note that we are transforming ids because of a bug in GraphExp
-            myid = id_transform(row["~id"])
-            print(myid)
-            v = g.addV(row["~label"]).property(T.id, myid)
-            for key in row:
-                if key.startswith('~'):
-                    continue
-                plabel, ptype = key.split(':')
-                v.property(plabel, row[key])
-            v.next()
-
-    # Load the edges
-    with open(e_file) as csvfile:
-        reader = csv.DictReader(csvfile, delimiter=',', quotechar='"')
-        for row in reader:
-            # Note that we are transforming ids because of a bug in GraphExp
-            edge_id = id_transform(row["~id"])
-            from_id = id_transform(row["~from"])
-            to_id = id_transform(row["~to"])
-            print(edge_id)
-
-            e = g.V(from_id).addE(row["~label"]).to( g.V(to_id) ).property(T.id, edge_id)
-
-            for key in row:
-                if key.startswith('~'):
-                    continue
-                plabel, ptype = key.split(':')
-                e.property(plabel, row[key])
-            e.next()
-
-
-    print("Vertices: %s" % g.V().count().next())
-    print("Edges: %s" % g.E().count().next())
+
+    load_metrics = metrics.Metrics()
+    # Batch size and connections in flight follow the endpoint's latency and errors, see write_control.py
+    controller = write_control.controller_from_args(args, is_transient, load_metrics)
+    with metrics.reporter_from_args(args, load_metrics, LOG):
+        if args.delta:
+            # Only send what changed since the last load recorded in the snapshot
+            delta_load.load_delta(lambda: NeptuneWriter(neptune_constr), v_file, e_file, args.delta,
+                                  workers=args.workers, batch_size=args.batch_size, metrics=load_metrics,
+                                  controller=controller, parse_workers=args.parse_workers)
+        else:
+            load_all(neptune_constr, v_file, e_file, args, load_metrics, controller)
+
+    writer = NeptuneWriter(neptune_constr)
+    print("Vertices: %s" % writer.g.V().count().next())
+    print("Edges: %s" % writer.g.E().count().next())
+    writer.close()
+
+def load_all(neptune_constr, v_file, e_file, args, load_metrics=None, controller=None):
+    # Load the nodes / vertices, then the edges, over a pool of connections
+    loader = ParallelLoader(lambda: NeptuneWriter(neptune_constr), workers=args.workers, batch_size=args.batch_size,
+                            metrics=load_metrics, controller=controller)
+    # Rows come off the typed reader, so numeric properties are sent as numbers rather than strings
+    vertices = neptune_csv.iter_records(v_file, workers=args.parse_workers)
+    edges = neptune_csv.iter_records(e_file, workers=args.parse_workers)
+    loader.load(vertices, edges)
 
 
 def parse_options():
@@ -84,7 +323,17 @@ def parse_options():
      parser.add_argument('-n', '--neptune', dest='neptune', action="store", metavar="URI:PORT", required=True)
      parser.add_argument('-v', '--vertices', dest='vertices', action="store", metavar="FILE", required=True)
      parser.add_argument('-e', '--edges', dest='edges', action="store", metavar="FILE", required=True)
-     
+     parser.add_argument('-b', '--batch-size', dest='batch_size', action="store", metavar="INT", type=int, default=50,
+                         help='Number of addV/addE steps chained into one traversal to start with (default 50)')
+     parser.add_argument('-w', '--workers', dest='workers', action="store", metavar="INT", type=int, default=4,
+                         help='Number of concurrent connections (default 4)')
+     parser.add_argument('-d', '--delta', dest='delta', action="store", metavar="SNAPSHOT",
+                         help='Only load what changed since the snapshot file, then update it')
+     parser.add_argument('--parse-workers', dest='parse_workers', action="store", metavar="INT", type=int,
+                         help='Processes parsing the CSVs (default: one per core for files of 64 MB and more)')
+     write_control.add_options(parser, max_batch_size=500)
+     metrics.add_options(parser)
+
      return parser.parse_args()
 
 if __name__ == '__main__':
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+'''
+Incremental (delta) loading for csv2neptune.py and csv2neo4j.py.
+
+A snapshot file records a content hash for every vertex and edge that was last loaded. On the next run the new CSVs
+are streamed and hashed row by row, and only the differences are sent:
+
+ * vertices that are new or whose properties changed are upserted,
+ * edges that are new are upserted, edges that changed are deleted and upserted again,
+ * vertices and edges that are no longer in the CSVs are deleted.
+
+Without a snapshot every row counts as new, and because vertices and edges are both upserted (MERGE in Neo4j,
+fold/coalesce in Neptune) a re-run against an already loaded graph neither fails on nor duplicates existing ids.
+
+Besides write_vertices/write_edges (see parallel_load.py) a writer used here needs upsert_vertices(rows),
+upsert_edges(rows), delete_vertices(ids) and delete_edges(edges), where edges is a list of (id, from, to) tuples of
+original ids.
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import contextlib
+import hashlib
+import json
+import logging
+import os
+
+import neptune_csv
+from parallel_load import ParallelLoader
+
+LOG = logging.getLogger('delta_load')
+
+
+def row_hash(record):
+    '''
+    Content hash of a neptune_csv record, independent of column order.
+    :param record: dict of column name -> typed value
+    :return: short hex digest
+    '''
+    raw = json.dumps(sorted(record.items()))
+    return hashlib.sha1(raw.encode('utf8')).hexdigest()[:16]
+
+
+def load_snapshot(path):
+    '''
+    :param path: snapshot file written by save_snapshot()
+    :return: {"vertices": {id: hash}, "edges": {id: [hash, from, to]}}, empty if there is no snapshot yet
+    '''
+    if not path or not os.path.exists(path):
+        return {"vertices": {}, "edges": {}}
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def save_snapshot(path, snapshot):
+    # Write to a temp file and rename, so a failed run never leaves a half written snapshot behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(snapshot, fh)
+    os.replace(tmp_path, path)
+
+
+class Delta(object):
+    '''
+    Differences between the CSV files and a snapshot.
+    '''
+    def __init__(self):
+        self.vertex_upserts = []
+        self.vertex_deletes = []
+        self.edge_inserts = []
+        self.edge_deletes = []
+        self.snapshot = {"vertices": {}, "edges": {}}
+
+    def __str__(self):
+        return "%d vertex upserts, %d vertex deletes, %d edge inserts, %d edge deletes" % (
+            len(self.vertex_upserts), len(self.vertex_deletes), len(self.edge_inserts), len(self.edge_deletes))
+
+
+def build_snapshot(v_file, e_file, parse_workers=1):
+    '''
+    Snapshot of the CSV files as they are, for a load that did not go through load_delta() (e.g. neo4j-admin import).
+    :return: snapshot as save_snapshot() takes it
+    '''
+    snapshot = {"vertices": {}, "edges": {}}
+    for record in neptune_csv.iter_records(v_file, workers=parse_workers):
+        snapshot["vertices"][record["~id"]] = row_hash(record)
+    for record in neptune_csv.iter_records(e_file, workers=parse_workers):
+        snapshot["edges"][record["~id"]] = [row_hash(record), record["~from"], record["~to"]]
+    return snapshot
+
+
+def compute_delta(v_file, e_file, old, parse_workers=1):
+    '''
+    Stream both CSV files and compare them against the old snapshot. Only changed rows are kept in memory.
+    :param v_file: vertex CSV
+    :param e_file: edge CSV
+    :param old: snapshot from load_snapshot()
+    :param parse_workers: processes parsing the CSVs, see neptune_csv.read_batches()
+    :return: Delta
+    '''
+    delta = Delta()
+    old_vertices = old["vertices"]
+    old_edges = old["edges"]
+    new_vertices = delta.snapshot["vertices"]
+    new_edges = delta.snapshot["edges"]
+
+    for record in neptune_csv.iter_records(v_file, workers=parse_workers):
+        h = row_hash(record)
+        new_vertices[record["~id"]] = h
+        if old_vertices.get(record["~id"]) != h:
+            delta.vertex_upserts.append(record)
+
+    for record in neptune_csv.iter_records(e_file, workers=parse_workers):
+        h = row_hash(record)
+        new_edges[record["~id"]] = [h, record["~from"], record["~to"]]
+        previous = old_edges.get(record["~id"])
+        if previous is None:
+            delta.edge_inserts.append(record)
+        elif previous[0] != h:
+            # Endpoints may have moved, so replace the edge rather than update it in place
+            delta.edge_deletes.append((record["~id"], previous[1], previous[2]))
+            delta.edge_inserts.append(record)
+
+    delta.vertex_deletes = [vertex_id for vertex_id in old_vertices if vertex_id not in new_vertices]
+    for edge_id, (h, from_id, to_id) in old_edges.items():
+        if edge_id not in new_edges:
+            delta.edge_deletes.append((edge_id, from_id, to_id))
+
+    return delta
+
+
+def phase(metrics, name):
+    return metrics.phase(name) if metrics is not None else contextlib.nullcontext()
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def load_delta(open_writer, v_file, e_file, snapshot_path, workers=4, batch_size=1000, metrics=None,
+               controller=None, parse_workers=1):
+    '''
+    Apply only what changed since the snapshot, then record the new snapshot.
+    :param open_writer: callable returning a new writer (see module docstring)
+    :param metrics: optional metrics.Metrics; the diff and deletes are timed as phases of their own
+    :param controller: optional write_control.WriteController for the upserts and inserts
+    :param parse_workers: processes parsing the CSVs
+    :return: Delta that was applied
+    '''
+    with phase(metrics, 'diff'):
+        delta = compute_delta(v_file, e_file, load_snapshot(snapshot_path), parse_workers)
+    LOG.info("Delta against %s: %s", snapshot_path, delta)
+
+    # Deletes first: removed and replaced edges, then removed vertices (which takes any remaining edges with them)
+    if delta.edge_deletes or delta.vertex_deletes:
+        with phase(metrics, 'deletes'):
+            writer = open_writer()
+            try:
+                for batch in chunks(delta.edge_deletes, batch_size):
+                    writer.delete_edges(batch)
+                for batch in chunks(delta.vertex_deletes, batch_size):
+                    writer.delete_vertices(batch)
+            finally:
+                writer.close()
+        if metrics is not None:
+            metrics.inc('rows_total', len(delta.edge_deletes) + len(delta.vertex_deletes), phase='deletes')
+
+    loader = ParallelLoader(open_writer, workers=workers, batch_size=batch_size, metrics=metrics,
+                            controller=controller)
+    loader.load(delta.vertex_upserts, delta.edge_inserts,
+                vertex_method='upsert_vertices', edge_method='upsert_edges')
+
+    save_snapshot(snapshot_path, delta.snapshot)
+    return delta
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+'''
+Export the graph from Neptune or Neo4j back into the Neptune CSV format (station-nodes.csv / station-edges.csv), the
+reverse of csv2neptune.py / csv2neo4j.py.
+
+One g.V().valueMap() or MATCH (n) RETURN n over the whole graph holds everything in one response and times out on
+a big graph. Instead the vertex ids are cut into ranges (at --split-at, or at ids sampled from the database), and a
+pool of workers, each with its own connection, reads the ranges in parallel. Edges are read by the same ranges, as
+the outgoing edges of the range's vertices.
+
+How a range is read depends on the database. Neo4j pages through it: every page is the next --page-size nodes of the
+range by id, starting after the last id of the previous page, which its id index answers with a range seek. Neptune
+has no index to walk ids in order with, so ordering a page would sort the rest of the graph for every page. A range
+is read unordered instead, asking for at most a page of rows; when it has more than that, or the request fails (e.g.
+times out), it is cut in two at the median id of what came back (or of ids sampled from it) and the halves are read
+instead. Only the edges of a single vertex that has more than a page of them are read in one go.
+
+Pages are streamed to one temporary spool per range as they arrive while the property types are collected, and the
+CSVs are then written from the spools in range order with a header that covers every property. Memory use is a page
+per worker no matter how big the graph is.
+
+The loaders prefix every id (see id_transform()); the prefix is taken off again unless --keep-ids is given, so the
+export can be loaded as it is.
+
+  graph_export.py neptune -n $NEPTUNE:8182 -v data/station-nodes.csv -e data/station-edges.csv
+  graph_export.py neo4j -n localhost:7687 -u neo4j -p secret -v nodes.csv -e edges.csv -w 8
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import argparse
+import contextlib
+import csv
+import json
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import backends
+import metrics
+import write_control
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import logging
+logging.basicConfig()
+LOG = logging.getLogger('graph_export')
+LOG.setLevel(logging.INFO)
+
+# What the loaders put in front of every id
+ID_PREFIX = "id_"
+# Ids sampled per range when the split points are not given
+SAMPLES_PER_RANGE = 20
+# Most ids sampled in one request, however many ranges are asked for
+MAX_SAMPLE = 10000
+# Neptune types in the order they widen into each other; mixing anything else falls back to string
+NUMERIC_TYPES = ('int', 'long', 'double')
+
+
+def split_points(sample, partitions):
+    '''
+    :param sample: ids sampled from the graph
+    :param partitions: number of ranges wanted
+    :return: sorted ids at which to cut the id space into (at most) that many ranges of similar size
+    '''
+    sample = sorted(set(sample))
+    points = []
+    for i in range(1, partitions):
+        point = sample[len(sample) * i // partitions] if sample else None
+        if point is not None and (not points or point > points[-1]):
+            points.append(point)
+    return points
+
+
+def id_ranges(points):
+    '''
+    :return: list of (after, upper) covering every id: after < id <= upper, None meaning unbounded
+    '''
+    bounds = [None] + list(points) + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def halve(after, upper, ids):
+    '''
+    :param ids: ids read or sampled from the range after < id <= upper
+    :return: [(after, point), (point, upper)], cutting the range at the median of the ids, or None if they leave
+             nothing to cut it at
+    '''
+    ids = sorted(set(i for i in ids if (after is None or i > after) and (upper is None or i <= upper)))
+    if not ids:
+        return None
+    point = ids[(len(ids) - 1) // 2]
+    if point == upper:
+        return None
+    return [(after, point), (point, upper)]
+
+
+def property_type(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int' if -2 ** 31 <= value < 2 ** 31 else 'long'
+    if isinstance(value, float):
+        return 'double'
+    return 'string'
+
+
+def widen(a, b):
+    if a is None or a == b:
+        return b
+    if a in NUMERIC_TYPES and b in NUMERIC_TYPES:
+        return max(a, b, key=NUMERIC_TYPES.index)
+    return 'string'
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, list):
+        # Neptune CSV array columns separate the values with semicolons
+        return ';'.join(format_value(item) for item in value)
+    return str(value)
+
+
+class PropertyTypes(object):
+    '''
+    Neptune types of the properties seen so far, widened as needed (int + double -> double, anything mixed ->
+    string); a property that ever has several values becomes an array column.
+    '''
+    def __init__(self):
+        self.types = {}
+        self.arrays = set()
+
+    def observe(self, props):
+        for key, value in props.items():
+            if isinstance(value, list):
+                self.arrays.add(key)
+                for item in value:
+                    self.types[key] = widen(self.types.get(key), property_type(item))
+            else:
+                self.types[key] = widen(self.types.get(key), property_type(value))
+
+    def update(self, other):
+        for key, ptype in other.types.items():
+            self.types[key] = widen(self.types.get(key), ptype)
+        self.arrays.update(other.arrays)
+
+    def headers(self):
+        return ["%s:%s%s" % (key, self.types[key], '[]' if key in self.arrays else '') for key in sorted(self.types)]
+
+
+def single_values(props):
+    # Neptune's valueMap() has a list of values for every vertex property; most have just the one
+    return dict((key, value[0] if isinstance(value, list) and len(value) == 1 else value)
+                for key, value in props.items())
+
+
+class GraphExporter(object):
+    '''
+    Export every vertex and edge through a pool of readers.
+
+    A reader whose `pages` attribute is true (the default) has vertex_page(after, upper, limit) and
+    edge_page(after, upper, limit), which are called until the range is done. One whose `pages` is false has
+    vertex_range(after, upper, limit) and edge_range(after, upper, limit), which return the rows of the range in any
+    order but no more than limit + 1 of them (all of them for limit None), and sample_ids(n, after, upper). A range with more than limit rows, or whose request fails, is cut in two and both halves are
+    read instead.
+    :param open_reader: callable returning a new reader (csv2neptune.NeptuneReader, csv2neo4j.Neo4jReader);
+                        called once per worker
+    :param workers: number of worker threads (and readers)
+    :param page_size: vertices per page (rows per request for readers that do not page)
+    :param metrics: optional metrics.Metrics to record pages, latencies and errors in
+    :param controller: optional write_control.WriteController; its batch size replaces page_size, and it decides
+                       which failed pages are retried
+    :param keep_ids: False takes the loaders' id prefix off again
+    '''
+    def __init__(self, open_reader, workers=4, page_size=1000, metrics=None, controller=None, keep_ids=False):
+        self.open_reader = open_reader
+        self.workers = workers
+        self.metrics = metrics
+        self.controller = controller or write_control.WriteController.fixed(page_size, workers)
+        self.keep_ids = keep_ids
+        self._readers = queue.Queue()
+        self.pages = True
+
+    def export(self, v_out, e_out, partitions=None, split_at=None):
+        '''
+        :param v_out: file object the vertex CSV is written to
+        :param e_out: file object the edge CSV is written to
+        :param partitions: number of id ranges, defaults to 4 per worker. For readers that do not page, ranges that
+                           turn out too big are cut further as they are read.
+        :param split_at: ids to cut the ranges at, instead of sampling them
+        :return: (vertex count, edge count)
+        '''
+        readers = [self.open_reader() for _ in range(self.workers)]
+        for reader in readers:
+            self._readers.put(reader)
+
+        self.pages = getattr(readers[0], 'pages', True)
+        try:
+            if split_at is None:
+                partitions = partitions or self.workers * 4
+                # The sample is one response, so it is kept small; ranges are cut further while reading if need be
+                sample = self._page('sample_ids', (min(partitions * SAMPLES_PER_RANGE, MAX_SAMPLE),))
+                split_at = split_points(sample, partitions)
+            ranges = id_ranges(split_at)
+            LOG.info("Exporting %d id ranges over %d connections", len(ranges), self.workers)
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                vertex_spools = self._export_phase(executor, 'vertices', ranges)
+                edge_spools = self._export_phase(executor, 'edges', ranges)
+        finally:
+            for reader in readers:
+                reader.close()
+
+        with self._phase('write'):
+            n_vertices = self._write_csv(v_out, ["~id", "~label"], vertex_spools)
+            n_edges = self._write_csv(e_out, ["~id", "~from", "~to", "~label"], edge_spools)
+        return n_vertices, n_edges
+
+    def _phase(self, name):
+        if self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.phase(name)
+
+    def _export_phase(self, executor, phase, ranges):
+        '''
+        Read every range in parallel.
+        :return: list of (spool, PropertyTypes), one per range, in range order
+        '''
+        with self._phase(phase):
+            futures = [executor.submit(self._export_range, phase, after, upper) for after, upper in ranges]
+            return [future.result() for future in futures]
+
+    def _export_range(self, phase, after, upper):
+        spool = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+        types = PropertyTypes()
+        pieces = None if self.pages else [(after, upper)]
+        while True:
+            if not self.pages:
+                if not pieces:
+                    break
+                page = self._read_piece(phase, pieces)
+            if phase == 'vertices':
+                if self.pages:
+                    page = self._page('vertex_page', (after, upper, self.controller.batch_size))
+                    if not page:
+                        break
+                    after = page[-1][0]
+                rows = [(self._id(vertex_id), label, single_values(props)) for vertex_id, label, props in page]
+            else:
+                if self.pages:
+                    page, after = self._page('edge_page', (after, upper, self.controller.batch_size))
+                    if after is None:
+                        break
+                rows = [(self._id(edge_id), self._id(from_id), self._id(to_id), label, single_values(props))
+                        for edge_id, label, from_id, to_id, props in page]
+
+            for row in rows:
+                types.observe(row[-1])
+                spool.write(json.dumps(row))
+                spool.write('\n')
+            if self.metrics is not None:
+                self.metrics.inc('rows_total', len(rows), phase=phase)
+        return spool, types
+
+    def _read_piece(self, phase, pieces):
+        '''
+        For a reader that does not page: read the last of the pieces (after, upper) a range has been cut into, asking
+        for at most a batch of rows. A piece with more rows than that, or whose request fails, is cut in two at the
+        median of the ids it returned (or of ids sampled from it) and both halves go back on the list instead.
+        :return: list of rows, empty if the piece was cut
+        '''
+        after, upper = pieces.pop()
+        method = 'vertex_range' if phase == 'vertices' else 'edge_range'
+        limit = self.controller.batch_size
+        page = self._page(method, (after, upper, limit), split=True)
+        if page is None:
+            halves = halve(after, upper, self._page('sample_ids', (SAMPLES_PER_RANGE, after, upper)))
+            if halves is None:
+                # Nothing to cut it at, so fall back to retrying it as it is
+                page = self._page(method, (after, upper, limit))
+        elif len(page) > limit:
+            # Edges are cut by the vertices they leave, like the ranges themselves
+            halves = halve(after, upper, [row[0] if phase == 'vertices' else row[2] for row in page])
+            if halves is None:
+                # A single vertex with more than limit edges: it cannot be cut, so read it whole
+                page = self._page(method, (after, upper, None))
+        else:
+            halves = None
+
+        if halves is not None:
+            LOG.debug("Cutting %s range (%s, %s] at %s", phase, after, upper, halves[0][1])
+            pieces.extend(halves)
+            return []
+        return page
+
+    def _page(self, method, args, split=False):
+        '''
+        Fetch one page (or range) on a free reader, retrying transient failures as the controller decides.
+        :param args: arguments of the reader method
+        :param split: return None on the first transient failure instead of retrying, so the caller can cut the
+                      request into smaller ones
+        '''
+        attempt = 0
+        while True:
+            reader = self._readers.get()
+            ticket = self.controller.start()
+            start = time.time()
+            try:
+                page = getattr(reader, method)(*args)
+            except Exception as e:
+                if self.metrics is not None:
+                    self.metrics.error(e, method=method)
+                if not self.controller.failed(ticket, e) or attempt >= self.controller.max_retries:
+                    raise
+                if self.metrics is not None:
+                    self.metrics.inc('retries_total', method=method)
+                if split:
+                    LOG.warning("Cutting %s in two after %s: %s", method, type(e).__name__, e)
+                    return None
+                LOG.warning("Retrying %s after %s: %s", method, type(e).__name__, e)
+                time.sleep(self.controller.backoff(attempt))
+                attempt += 1
+                continue
+            finally:
+                self._readers.put(reader)
+
+            seconds = time.time() - start
+            if self.metrics is not None:
+                self.metrics.observe('request_seconds', seconds, method=method)
+            rows = len(page[0] if method == 'edge_page' else page)
+            self.controller.succeeded(ticket, rows, seconds)
+            LOG.debug("%s %s: %d rows in %.2fs", method, args, rows, seconds)
+            return page
+
+    def _id(self, stored_id):
+        stored_id = str(stored_id)
+        if not self.keep_ids and stored_id.startswith(ID_PREFIX):
+            return stored_id[len(ID_PREFIX):]
+        return stored_id
+
+    def _write_csv(self, out, system_headers, spools):
+        types = PropertyTypes()
+        for spool, range_types in spools:
+            types.update(range_types)
+        property_headers = types.headers()
+        names = [header.partition(':')[0] for header in property_headers]
+
+        writer = csv.writer(out, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(system_headers + property_headers)
+        count = 0
+        for spool, range_types in spools:
+            with spool:
+                spool.seek(0)
+                for line in spool:
+                    row = json.loads(line)
+                    props = row.pop()
+                    writer.writerow(row + [format_value(props[name]) if props.get(name) is not None else ''
+                                           for name in names])
+                    count += 1
+        if self.metrics is not None:
+            self.metrics.inc('rows_total', count, phase='write')
+        return count
+
+
+def main():
+    args = parse_options()
+    connection = backends.connect(args, write=False)
+    export_metrics = metrics.Metrics()
+    # Pages shrink when they time out and grow back while they are fast, see write_control.py
+    controller = write_control.controller_from_args(args, connection.is_transient, export_metrics)
+    split_at = args.split_at.split(',') if args.split_at else None
+
+    try:
+        with metrics.reporter_from_args(args, export_metrics, LOG):
+            exporter = GraphExporter(connection.open_reader, workers=args.workers, metrics=export_metrics,
+                                     controller=controller, keep_ids=args.keep_ids)
+            with open(args.vertices, mode='w', newline='') as v_out, open(args.edges, mode='w', newline='') as e_out:
+                n_vertices, n_edges = exporter.export(v_out, e_out, partitions=args.partitions, split_at=split_at)
+    finally:
+        connection.close()
+
+    print("Vertices: %s" % n_vertices)
+    print("Edges: %s" % n_edges)
+
+
+def parse_options():
+     parser = argparse.ArgumentParser(description='Export a graph from a database to Neptune CSVs')
+     subparsers = parser.add_subparsers(dest='backend')
+     subparsers.required = True
+
+     def configure(sub, backend):
+         sub.add_argument('-v', '--vertices', dest='vertices', action="store", metavar="FILE", required=True)
+         sub.add_argument('-e', '--edges', dest='edges', action="store", metavar="FILE", required=True)
+         sub.add_argument('-b', '--page-size', dest='batch_size', action="store", metavar="INT", type=int,
+                          default=backend.page_size,
+                          help='Vertices per page (Neptune: rows per request) to start with (default %d)'
+                               % backend.page_size)
+         sub.add_argument('-w', '--workers', dest='workers', action="store", metavar="INT", type=int,
+                          default=4, help='Number of concurrent database connections (default 4)')
+         sub.add_argument('--partitions', dest='partitions', action="store", metavar="INT", type=int,
+                          help='Number of id ranges to read (default 4 per worker)')
+         sub.add_argument('--split-at', dest='split_at', action="store", metavar="ID,ID,...",
+                          help='Cut the id ranges at these (stored) ids instead of at sampled ones')
+         sub.add_argument('--keep-ids', dest='keep_ids', action="store_true",
+                          help="Keep the loaders' %s prefix on the ids" % ID_PREFIX)
+         write_control.add_options(sub, max_batch_size=backend.max_page_size)
+         metrics.add_options(sub)
+
+     backends.add_parsers(subparsers, 'Export from', configure)
+
+     return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+""" A command-line utility for converting a directory of (deep) JSON documents into a single CSV file.
+
+    Every file is flattened exactly once, across a process pool. Workers hand back the flattened rows, which are
+    spooled to a temporary file while the set of column names is merged; the CSV is then written from the spool with
+    the complete header. This replaces the old two pass driver (one pass for headers, one for rows) that used to live
+    in wmata2csv.py.
+"""
+import argparse
+import csv
+import glob
+import json
+import logging
+import multiprocessing
+import tempfile
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+APP_NAME = 'json2csv'
+# Column for a file whose top level is a lone value (a string, number, true/false or null) rather than an object
+VALUE_COLUMN = 'value'
+
+logger = logging.getLogger(APP_NAME)
+
+
+def main():
+    args = load_cmdline_args()
+
+    loggingFileHandler = logging.FileHandler(APP_NAME+'.log', mode='w')
+    loggingFileHandler.setLevel(logging.DEBUG)
+    loggingFileHandler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s (%(filename)s:%(lineno)d )'))
+    logger.addHandler(loggingFileHandler)
+    logger.setLevel(logging.DEBUG)
+    logger.debug('Starting...')
+
+    # Confirm we can write the output file before proceeding with more expensive operations like
+    # iterating over several input files...
+    out_file_name = args.outFile
+    try:
+        out_fh = open(out_file_name, mode='w', newline='')
+    except IOError as io_err:
+        err_msg = "Unable to write to file (%s). %s" % (out_file_name, io_err)
+        logger.error(err_msg)
+        print(err_msg)
+        exit(1)
+
+    in_files = sorted(glob.glob(args.inFiles))
+    # Respect the --limit parameter if specified by user
+    if args.limit is not None:
+        in_files = in_files[:args.limit]
+
+    with out_fh:
+        converted = convert(in_files, out_fh, encoding=args.inFileEncoding, delimiter=args.delimiter,
+                            workers=args.workers)
+
+    logger.info("Wrote %d of %d files to %s" % (converted, len(in_files), out_file_name))
+    print("Wrote %d of %d files to %s" % (converted, len(in_files), out_file_name))
+
+
+def convert(in_files, out_fh, encoding='utf-8', delimiter=',', workers=None, chunksize=64):
+    """ Flatten every JSON file in in_files into one CSV written to out_fh.
+
+        :return: number of files converted (unreadable or invalid files are logged and skipped)
+    """
+    csv_header_set = set()
+    converted = 0
+
+    # Rows go to the spool as JSON lines as soon as a worker hands them back, so memory stays flat no matter how
+    # many files there are
+    with tempfile.TemporaryFile(mode='w+', encoding='utf-8') as spool:
+        pool = multiprocessing.Pool(workers)
+        try:
+            jobs = ((path, encoding) for path in in_files)
+            for input_filepath, shallow_data_dict, err_msg in pool.imap(flatten_file, jobs, chunksize):
+                if err_msg is not None:
+                    logger.error(err_msg)
+                    print(err_msg)
+                    continue
+
+                csv_header_set.update(shallow_data_dict.keys())
+                spool.write(json.dumps(shallow_data_dict))
+                spool.write('\n')
+                converted += 1
+        finally:
+            pool.close()
+            pool.join()
+
+        sorted_headers = sorted(csv_header_set)
+        logger.debug("Headers: %s" % json.dumps(sorted_headers))
+
+        # restval parameter specifies the value to be written if the dictionary is missing a key in
+        # fieldnames. extrasaction parameter indicates what action to take if the dictionary passed to
+        # the writerow() method contains a key not found in fieldnames
+        writer = csv.DictWriter(out_fh, sorted_headers, restval='', extrasaction='ignore', delimiter=delimiter)
+        writer.writeheader()
+
+        spool.seek(0)
+        for line in spool:
+            writer.writerow(json.loads(line))
+
+    return converted
+
+
+def flatten_file(job):
+    """ Worker: load and flatten one JSON file.
+
+        :return: (path, flattened dict or None, error message or None)
+    """
+    input_filepath, encoding = job
+    try:
+        with open(input_filepath, mode='r', encoding=encoding) as json_input_fh:
+            # This dictionary may contain other dictionaries (aka "deep")
+            deep_data = json.load(json_input_fh)
+
+        # "Flatten" any child dicts such that we are left with a dictionary whose values will
+        # never be dictionaries (i.e., no dicts within dicts).
+        if isinstance(deep_data, MutableMapping):
+            return input_filepath, flatten_dict(deep_data), None
+        if isinstance(deep_data, list):
+            return input_filepath, flatten_list(deep_data), None
+        return input_filepath, {VALUE_COLUMN: deep_data}, None
+
+    except ValueError as value_err:
+        return input_filepath, None, "Ignoring %s; unable to parse JSON (%s)" % (input_filepath, value_err)
+
+    except IOError as io_err:
+        return input_filepath, None, "Ignoring %s; unable to open the file (%s)" % (input_filepath, io_err)
+
+
+def flatten_dict(d, parent_key=''):
+    """ Due credit to Baby Mouth Holloway for the original version of this function (which was mostly
+     just modified to support lists).
+
+     Nested dicts become "parent.child" columns and list items "parent.N" columns. Uses an explicit stack instead
+     of recursion, so deeply nested documents cannot hit the recursion limit.
+    """
+    children = [("%s.%s" % (parent_key, key) if parent_key else key, value) for key, value in d.items()]
+    return _flatten(children)
+
+
+def flatten_list(the_list, parent_key=''):
+    """ Like flatten_dict, for a list: each item becomes (or is flattened under) a "parent.N" column.
+    """
+    children = [("%s.%s" % (parent_key, item_counter) if parent_key else str(item_counter), item)
+                for item_counter, item in enumerate(the_list)]
+    return _flatten(children)
+
+
+def _flatten(children):
+    colname_val_dict = {}
+
+    # Reverse so that popping from the end visits the keys in document order
+    stack = list(reversed(children))
+    while stack:
+        colname, current_value = stack.pop()
+
+        # If the current value is a dictionary, flatten its items under this column name
+        if isinstance(current_value, MutableMapping):
+            stack.extend(reversed([("%s.%s" % (colname, key), value) for key, value in current_value.items()]))
+
+        # If the current value is a list, flatten all of its items
+        elif isinstance(current_value, list):
+            stack.extend(reversed([("%s.%s" % (colname, i), item) for i, item in enumerate(current_value)]))
+
+        else:
+            # Add the key/value pair
+            colname_val_dict[colname] = current_value
+
+    return colname_val_dict
+
+
+def load_cmdline_args():
+    parser = argparse.ArgumentParser(description="A command-line utility for converting JSON files to a single CSV")
+    parser.add_argument('--inFiles', required=True, help='Path to input file(s), may be a glob pattern')
+    parser.add_argument('--inFileEncoding', default="utf-8", help='Encoding for input files. Defaults to UTF-8')
+    parser.add_argument('--outFile', default="out.csv", help='Output CSV')
+    parser.add_argument('--limit', type=int, default=None, help='Limits the number of input files that are processed')
+    parser.add_argument('--delimiter', default=',', help='Character to use as delimiter in output file (default comma)')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: one per core)')
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
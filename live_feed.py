@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+'''
+Keep the live properties of the station graph current from the WMATA real-time feeds, while the graph itself stays
+what wmata2csv.py built.
+
+Every feed (station predictions, train positions) is polled in its own thread, no more often than its interval, over
+one pooled keep-alive session (wmata2csv.WmataClient, whose limiter also caps the overall request rate). A feed turns
+its response into {station id: {property: value}}, and the ChangeTracker compares that with what the feed said last
+time: only property values that differ are queued, and a property the feed no longer reports is queued for removal.
+Every --flush-interval seconds the queued changes are written in batches with the writers' update_properties(). A
+property that changes several times between two flushes is written once, with its latest value, so the write volume
+follows the rate of change rather than the size of the feeds, and a slow database just means bigger coalesced
+flushes.
+
+Properties set on the Station vertices:
+    next_train_min, next_train_line, next_train_destination    from the station predictions
+    trains_at_platform                                          from the train positions
+
+`live_feed.py mock` serves made-up but consistent feeds for the stations of a vertex CSV, so the poller can be run
+without an API key (point it there with --api_root):
+
+  live_feed.py mock -v data/station-nodes.csv --port 8080 &
+  live_feed.py neo4j -n localhost:7687 -u neo4j -p secret --api_root http://localhost:8080 --duration 60
+  live_feed.py neptune -n $NEPTUNE:8182 -a $WMATA_KEY
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import argparse
+import contextlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import backends
+import metrics
+import neptune_csv
+import write_control
+import wmata2csv
+
+import logging
+logging.basicConfig()
+LOG = logging.getLogger('live_feed')
+LOG.setLevel(logging.INFO)
+
+API_ROOT = 'https://api.wmata.com'
+STATIONS_PATH = '/Rail.svc/json/jStations'
+PREDICTIONS_PATH = '/StationPrediction.svc/json/GetPrediction/All'
+POSITIONS_PATH = '/TrainPositions/TrainPositions'
+ROUTES_PATH = '/TrainPositions/StandardRoutes'
+# The train position endpoints answer in XML unless asked for JSON
+JSON_PARAMS = {"contentType": "json"}
+
+
+class Feed(object):
+    '''
+    One polled endpoint.
+    :param name: feed name, for logs and metrics
+    :param url: endpoint
+    :param params: query parameters
+    :param interval: least number of seconds between two polls of the endpoint
+    :param extract: callable(response body) -> {vertex id: {property: value}}
+    '''
+    def __init__(self, name, url, params, interval, extract):
+        self.name = name
+        self.url = url
+        self.params = params
+        self.interval = interval
+        self.extract = extract
+
+
+def prediction_minutes(value):
+    # Arriving and boarding count as 0 minutes; "---" and blanks carry no estimate
+    if value in ('ARR', 'BRD'):
+        return 0
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def station_ids(client, api_root=API_ROOT):
+    '''
+    :return: {station code: vertex id}, the ids wmata2csv.py gave the stations
+    '''
+    return wmata2csv.station_ids(client.get_json(api_root + STATIONS_PATH)["Stations"])
+
+
+def next_trains(ids):
+    '''
+    :param ids: from station_ids()
+    :return: extract function turning station predictions into the next train due at every station
+    '''
+    def extract(body):
+        stations = {}
+        for train in body["Trains"]:
+            minutes = prediction_minutes(train.get("Min"))
+            # By code: a name can belong to more than one station
+            station = ids.get(train.get("LocationCode"))
+            if minutes is None or not station:
+                continue
+            if station not in stations or minutes < stations[station]["next_train_min"]:
+                stations[station] = {"next_train_min": minutes,
+                                     "next_train_line": train.get("Line"),
+                                     "next_train_destination": train.get("DestinationName")}
+        return stations
+    return extract
+
+
+def station_circuits(client, ids, api_root=API_ROOT):
+    '''
+    :param ids: from station_ids()
+    :return: {track circuit id: station id} for the circuits at station platforms, from the standard routes
+    '''
+    circuits = {}
+    for route in client.get_json(api_root + ROUTES_PATH, JSON_PARAMS)["StandardRoutes"]:
+        for circuit in route["TrackCircuits"]:
+            if circuit.get("StationCode") in ids:
+                circuits[circuit["CircuitId"]] = ids[circuit["StationCode"]]
+    return circuits
+
+
+def trains_at_stations(circuits):
+    '''
+    :param circuits: from station_circuits()
+    :return: extract function turning train positions into the number of trains at every station's platforms
+    '''
+    stations = set(circuits.values())
+
+    def extract(body):
+        counts = dict((station, 0) for station in stations)
+        for train in body["TrainPositions"]:
+            station = circuits.get(train.get("CircuitId"))
+            if station is not None:
+                counts[station] += 1
+        return dict((station, {"trains_at_platform": n}) for station, n in counts.items())
+    return extract
+
+
+class ChangeTracker(object):
+    '''
+    What every feed reported last, and the changes that have not been written yet. Thread safe.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        # feed name -> {vertex id: {property: value}}
+        self.seen = {}
+        # vertex id -> {property: latest value, None to remove it}
+        self.pending = {}
+
+    def update(self, feed, values):
+        '''
+        Queue whatever differs from the feed's previous values.
+        :param feed: feed name
+        :param values: {vertex id: {property: value}}, everything the feed reports now
+        :return: number of property values queued
+        '''
+        values = dict((vertex_id, dict((key, value) for key, value in props.items() if value is not None))
+                      for vertex_id, props in values.items())
+        changed = 0
+        with self.lock:
+            last = self.seen.get(feed, {})
+            for vertex_id in set(last) | set(values):
+                old = last.get(vertex_id, {})
+                new = values.get(vertex_id, {})
+                for key in set(old) | set(new):
+                    value = new.get(key)
+                    if key not in old or old[key] != value:
+                        # A later change of the same property replaces this one before it is written
+                        self.pending.setdefault(vertex_id, {})[key] = value
+                        changed += 1
+            self.seen[feed] = values
+        return changed
+
+    def take(self):
+        '''
+        :return: the pending changes as rows with "~id", and clear them
+        '''
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        rows = []
+        for vertex_id, props in sorted(pending.items()):
+            row = dict(props)
+            row["~id"] = vertex_id
+            rows.append(row)
+        return rows
+
+    def requeue(self, rows):
+        '''
+        Rows that could not be written: queue them again for the next flush. A property that changed again since
+        take() keeps its newer value. Removals (None) are queued as well, which a fresh poll would not do because the
+        property is already gone from what the feed reports.
+        '''
+        with self.lock:
+            for row in rows:
+                pending = self.pending.setdefault(row["~id"], {})
+                for key, value in row.items():
+                    if key != "~id" and key not in pending:
+                        pending[key] = value
+
+
+class Poller(object):
+    '''
+    Poll the feeds and write their changes until stopped.
+    :param client: wmata2csv.WmataClient the feeds are fetched with
+    :param feeds: list of Feed
+    :param open_writer: callable returning a writer with update_properties(rows) and close()
+    :param flush_interval: seconds between writes of the pending changes
+    :param metrics: optional metrics.Metrics for polls, changes, requests and errors
+    :param controller: optional write_control.WriteController for the batch size and retries
+    '''
+    def __init__(self, client, feeds, open_writer, flush_interval=2.0, metrics=None, controller=None):
+        self.client = client
+        self.feeds = feeds
+        self.open_writer = open_writer
+        self.flush_interval = flush_interval
+        self.metrics = metrics
+        self.controller = controller or write_control.WriteController.fixed(1000, 1)
+        self.tracker = ChangeTracker()
+        self.stopped = threading.Event()
+
+    def run(self, duration=None):
+        '''
+        Poll and write for duration seconds, or until stop() or Ctrl-C.
+        '''
+        threads = [threading.Thread(target=self._poll, args=(feed,), name=feed.name) for feed in self.feeds]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        deadline = time.time() + duration if duration else None
+        writer = self.open_writer()
+        try:
+            with self._phase('updates'):
+                while not self.stopped.is_set():
+                    try:
+                        wait = self.flush_interval
+                        if deadline is not None:
+                            wait = min(wait, deadline - time.time())
+                        if self.stopped.wait(max(wait, 0.0)) or (deadline is not None and time.time() >= deadline):
+                            break
+                    except KeyboardInterrupt:
+                        break
+                    finally:
+                        self.flush(writer)
+        finally:
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+            writer.close()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _phase(self, name):
+        if self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.phase(name)
+
+    def _poll(self, feed):
+        next_poll = time.time()
+        while not self.stopped.wait(max(next_poll - time.time(), 0.0)):
+            next_poll = time.time() + feed.interval
+            start = time.time()
+            try:
+                values = feed.extract(self.client.get_json(feed.url, feed.params))
+            except Exception as e:
+                # The feed may be back by the next poll; keep going
+                LOG.warning("Polling %s failed: %s: %s", feed.name, type(e).__name__, e)
+                if self.metrics is not None:
+                    self.metrics.error(e, feed=feed.name)
+                continue
+            changed = self.tracker.update(feed.name, values)
+            LOG.debug("%s: %d vertices, %d changed values", feed.name, len(values), changed)
+            if self.metrics is not None:
+                self.metrics.observe('poll_seconds', time.time() - start, feed=feed.name)
+                self.metrics.inc('polls_total', feed=feed.name)
+                self.metrics.inc('changes_total', changed, feed=feed.name)
+
+    def flush(self, writer):
+        '''
+        Write every pending change.
+        :return: number of vertices updated
+        '''
+        rows = self.tracker.take()
+        for batch in self.controller.split(rows):
+            self._write(writer, batch)
+        return len(rows)
+
+    def _write(self, writer, batch, attempt=0):
+        ticket = self.controller.start()
+        start = time.time()
+        try:
+            writer.update_properties(batch)
+        except Exception as e:
+            if self.metrics is not None:
+                self.metrics.error(e, method='update_properties')
+            if self.controller.failed(ticket, e) and attempt < self.controller.max_retries:
+                time.sleep(self.controller.backoff(attempt))
+                if self.metrics is not None:
+                    self.metrics.inc('retries_total', method='update_properties')
+                for part in self.controller.split(batch):
+                    self._write(writer, part, attempt + 1)
+                return
+            LOG.error("Failed to write %d updates, they are retried with the next flush: %s: %s", len(batch),
+                      type(e).__name__, e)
+            self.tracker.requeue(batch)
+            return
+
+        seconds = time.time() - start
+        self.controller.succeeded(ticket, len(batch), seconds)
+        if self.metrics is not None:
+            self.metrics.observe('request_seconds', seconds, method='update_properties')
+            self.metrics.inc('rows_total', len(batch), phase='updates')
+
+
+class MockFeeds(object):
+    '''
+    Made-up but consistent feeds for a list of stations: one line through all of them, CIRCUITS_PER_STATION track
+    circuits per station (the first at the platform), and trains spread along it that move on a circuit every step
+    seconds. Predictions follow from where the trains are.
+    '''
+    CIRCUITS_PER_STATION = 3
+    LINE = "MK"
+
+    def __init__(self, stations, trains=10, step=5.0):
+        self.stations = list(stations)
+        self.codes = ["X%03d" % i for i in range(len(self.stations))]
+        self.circuits = len(self.stations) * self.CIRCUITS_PER_STATION
+        self.trains = trains
+        self.step = step
+        self.started = time.time()
+        self.bodies = {STATIONS_PATH: self.stations_body, ROUTES_PATH: self.routes_body,
+                       POSITIONS_PATH: self.positions_body, PREDICTIONS_PATH: self.predictions_body}
+
+    def stations_body(self):
+        return {"Stations": [{"Code": code, "Name": name, "LineCode1": self.LINE, "StationTogether1": ""}
+                             for code, name in zip(self.codes, self.stations)]}
+
+    def routes_body(self):
+        circuits = []
+        for i in range(self.circuits):
+            station, offset = divmod(i, self.CIRCUITS_PER_STATION)
+            circuits.append({"SeqNum": i, "CircuitId": i + 1, "StationCode": None if offset else self.codes[station]})
+        return {"StandardRoutes": [{"LineCode": self.LINE, "TrackNum": 1, "TrackCircuits": circuits}]}
+
+    def positions(self):
+        '''
+        :return: circuit index (0 based) of every train now
+        '''
+        moved = int((time.time() - self.started) / self.step)
+        return [(train * self.circuits // self.trains + moved) % self.circuits for train in range(self.trains)]
+
+    def positions_body(self):
+        return {"TrainPositions": [{"TrainId": str(train), "CarCount": 6, "DirectionNum": 1, "CircuitId": circuit + 1,
+                                    "DestinationStationCode": self.codes[-1], "LineCode": self.LINE,
+                                    "SecondsAtLocation": 0, "ServiceType": "Normal"}
+                                   for train, circuit in enumerate(self.positions())]}
+
+    def predictions_body(self):
+        positions = self.positions()
+        trains = []
+        for i, (code, name) in enumerate(zip(self.codes, self.stations)):
+            platform = i * self.CIRCUITS_PER_STATION
+            # Circuits each train still has to cover, the nearest three trains
+            for distance in sorted((platform - circuit) % self.circuits for circuit in positions)[:3]:
+                minutes = int(distance * self.step / 60)
+                trains.append({"Car": "6", "Destination": self.stations[-1], "DestinationCode": self.codes[-1],
+                               "DestinationName": self.stations[-1], "Group": "1", "Line": self.LINE,
+                               "LocationCode": code, "LocationName": name,
+                               "Min": "BRD" if distance == 0 else "ARR" if minutes == 0 else str(minutes)})
+        return {"Trains": trains}
+
+
+def serve_mock(mock, port):
+    '''
+    Serve the mock feeds on localhost:port until interrupted.
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = mock.bodies.get(self.path.split('?')[0])
+            if body is None:
+                self.send_error(404)
+                return
+            data = json.dumps(body()).encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, fmt, *args):
+            LOG.debug(fmt, *args)
+
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    LOG.info("Serving mock feeds for %d stations on http://localhost:%d", len(mock.stations), port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def build_feeds(client, args):
+    '''
+    :return: list of Feed for the options
+    '''
+    ids = station_ids(client, args.api_root)
+    return [Feed('predictions', args.api_root + PREDICTIONS_PATH, None, args.predictions_interval, next_trains(ids)),
+            Feed('positions', args.api_root + POSITIONS_PATH, JSON_PARAMS, args.positions_interval,
+                 trains_at_stations(station_circuits(client, ids, args.api_root)))]
+
+
+def main():
+    args = parse_options()
+
+    if args.backend == 'mock':
+        stations = [row["~id"] for row in neptune_csv.iter_records(args.vertices)]
+        serve_mock(MockFeeds(stations, trains=args.trains, step=args.step), args.port)
+        return
+
+    connection = backends.connect(args)
+    feed_metrics = metrics.Metrics()
+    # A single writer sends the flushes; the controller sizes its batches and retries transient failures
+    controller = write_control.WriteController(args.batch_size, max_batch_size=args.max_batch_size,
+                                               target_latency=args.target_latency, adaptive=not args.fixed_batch,
+                                               max_retries=args.retries, is_transient=connection.is_transient,
+                                               metrics=feed_metrics)
+    # Live data must not come out of the response cache
+    client = wmata2csv.WmataClient(args.api_key, workers=2, rate=args.rate_limit)
+    try:
+        with metrics.reporter_from_args(args, feed_metrics, LOG):
+            poller = Poller(client, build_feeds(client, args), connection.open_writer, flush_interval=args.flush_interval,
+                            metrics=feed_metrics, controller=controller)
+            poller.run(args.duration)
+    finally:
+        connection.close()
+
+
+def parse_options():
+     parser = argparse.ArgumentParser(description='Keep live WMATA properties of the station graph up to date')
+     subparsers = parser.add_subparsers(dest='backend')
+     subparsers.required = True
+
+     def configure(sub, backend):
+         sub.add_argument('-a', '--api_key', dest='api_key', action="store", metavar="API_KEY")
+         sub.add_argument('--api_root', dest='api_root', action="store", metavar="URL", default=API_ROOT,
+                          help='Where the feeds are served, e.g. a mock (default %s)' % API_ROOT)
+         sub.add_argument('--rate_limit', type=float, default=10,
+                          help='Maximum API requests per second, 0 for no limit (default 10)')
+         sub.add_argument('--predictions-interval', dest='predictions_interval', action="store",
+                          metavar="SECONDS", type=float, default=20.0,
+                          help='Seconds between polls of the station predictions (default 20)')
+         sub.add_argument('--positions-interval', dest='positions_interval', action="store", metavar="SECONDS",
+                          type=float, default=10.0, help='Seconds between polls of the train positions (default 10)')
+         sub.add_argument('--flush-interval', dest='flush_interval', action="store", metavar="SECONDS",
+                          type=float, default=2.0, help='Seconds between writes of the changes (default 2)')
+         sub.add_argument('--duration', dest='duration', action="store", metavar="SECONDS", type=float,
+                          help='Stop after this long (default: run until interrupted)')
+         sub.add_argument('-b', '--batch-size', dest='batch_size', action="store", metavar="INT", type=int,
+                          default=backend.batch_size,
+                          help='Vertices per write request to start with (default %d)' % backend.batch_size)
+         write_control.add_options(sub, max_batch_size=backend.max_batch_size)
+         metrics.add_options(sub)
+
+     backends.add_parsers(subparsers, 'Update', configure)
+
+     mock = subparsers.add_parser('mock', help='Serve mock feeds for the stations in a vertex CSV')
+     mock.add_argument('-v', '--vertices', dest='vertices', action="store", metavar="FILE", required=True)
+     mock.add_argument('--port', dest='port', action="store", metavar="INT", type=int, default=8080,
+                       help='Port to listen on (default 8080)')
+     mock.add_argument('--trains', dest='trains', action="store", metavar="INT", type=int, default=10,
+                       help='Number of trains (default 10)')
+     mock.add_argument('--step', dest='step', action="store", metavar="SECONDS", type=float, default=5.0,
+                       help='Seconds a train takes per track circuit (default 5)')
+
+     args = parser.parse_args()
+     if args.backend != 'mock' and not args.api_key and args.api_root == API_ROOT:
+         parser.error("--api_key is required for the WMATA API")
+     return args
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+'''
+Instrumentation for the loaders: phase timers, row counters, gauges, request latency histograms and error counts.
+
+One Metrics object is shared by every thread of a load. ParallelLoader records each write request (rows, latency,
+exceptions by type) and the loaders time their phases with metrics.phase(). A ProgressReporter thread periodically
+logs a one line summary and, if asked, dumps the metrics to a file as JSON lines (one object per report, appended) or
+in the Prometheus text format (the file is replaced on every report, as the node_exporter textfile collector expects).
+
+Latencies go into fixed, geometrically spaced buckets, so a histogram costs the same few hundred bytes whether it has
+seen ten requests or ten million; p50/p99 are interpolated within the bucket they fall in.
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+LOG = logging.getLogger('metrics')
+
+# 100us .. ~90s in steps of 25%
+BUCKETS = tuple(0.0001 * 1.25 ** i for i in range(62))
+
+
+class Histogram(object):
+    '''
+    Bucketed distribution of durations in seconds. Not thread safe on its own; Metrics holds the lock.
+    '''
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        '''
+        :param q: quantile in [0, 1]
+        :return: estimated value, or None if nothing was observed
+        '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+    def summary(self):
+        return {"count": self.count,
+                "mean": self.sum / self.count if self.count else None,
+                "p50": self.quantile(0.5),
+                "p99": self.quantile(0.99),
+                "max": self.max}
+
+
+class Metrics(object):
+    '''
+    Thread safe registry of counters, histograms and phase timers.
+    :param prefix: prefix of the Prometheus metric names
+    '''
+    def __init__(self, prefix='coredex'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # phase name -> [accumulated seconds, start time of the running interval or None]
+        self.phases = {}
+        self.phase_order = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        '''
+        Set a value that goes up and down, e.g. the current batch size.
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def error(self, exc, **labels):
+        '''
+        Count an exception under its class name.
+        '''
+        self.inc('errors_total', type=type(exc).__name__, **labels)
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self._phase(phase)[0] += seconds
+
+    def _phase(self, phase):
+        if phase not in self.phases:
+            self.phases[phase] = [0.0, None]
+            self.phase_order.append(phase)
+        return self.phases[phase]
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Time a phase of the load; re-entering a phase adds to its total. While it runs, reports include the time so
+        far.
+        '''
+        start = time.time()
+        with self.lock:
+            self._phase(name)[1] = start
+        try:
+            yield self
+        finally:
+            with self.lock:
+                timer = self.phases[name]
+                timer[0] += time.time() - start
+                timer[1] = None
+
+    def timed(self, iterable, phase):
+        '''
+        Pass iterable through, adding the time spent producing its items (e.g. parsing the CSV) to phase.
+        '''
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(phase, time.time() - start)
+                return
+            self.add_time(phase, time.time() - start)
+            yield item
+
+    def counter(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def snapshot(self):
+        '''
+        :return: dict of everything recorded so far, for JSON output and progress lines
+        '''
+        now = time.time()
+        with self.lock:
+            phases = {}
+            for name in self.phase_order:
+                seconds, running = self.phases[name]
+                if running is not None:
+                    seconds += now - running
+                rows = self.counters.get(('rows_total', (('phase', name),)), 0)
+                phases[name] = {"seconds": round(seconds, 4), "rows": rows,
+                                "rows_per_sec": round(rows / seconds, 1) if seconds and rows else None}
+
+            counters = {}
+            errors = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                if name == 'errors_total':
+                    error_type = dict(labels)["type"]
+                    errors[error_type] = errors.get(error_type, 0) + value
+                counters[format_name(name, labels)] = value
+
+            gauges = dict((format_name(name, labels), value) for (name, labels), value in self.gauges.items())
+            latency = dict((format_name(name, labels), histogram.summary())
+                           for (name, labels), histogram in sorted(self.histograms.items()))
+
+        return {"time": round(now, 3), "elapsed": round(now - self.started, 3), "phases": phases,
+                "counters": counters, "gauges": gauges, "latency": latency, "errors": errors}
+
+    def json_line(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def prometheus_text(self):
+        '''
+        :return: everything recorded so far in the Prometheus text exposition format
+        '''
+        lines = []
+        snapshot = self.snapshot()
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = [(key, list(h.counts), h.count, h.sum) for key, h in sorted(self.histograms.items())]
+
+        typed = set()
+        for (name, labels), value in counters:
+            metric = self.prefix + '_' + name
+            if metric not in typed:
+                lines.append("# TYPE %s counter" % metric)
+                typed.add(metric)
+            lines.append("%s %s" % (format_name(metric, labels), value))
+
+        for (name, labels), value in gauges:
+            metric = self.prefix + '_' + name
+            if metric not in typed:
+                lines.append("# TYPE %s gauge" % metric)
+                typed.add(metric)
+            lines.append("%s %s" % (format_name(metric, labels), value))
+
+        for (name, labels), counts, count, total in histograms:
+            metric = self.prefix + '_' + name
+            if metric not in typed:
+                lines.append("# TYPE %s histogram" % metric)
+                typed.add(metric)
+            cumulative = 0
+            for bound, n in zip(BUCKETS, counts):
+                cumulative += n
+                lines.append("%s %d" % (format_name(metric + '_bucket', labels + (('le', '%.6g' % bound),)), cumulative))
+            lines.append("%s %d" % (format_name(metric + '_bucket', labels + (('le', '+Inf'),)), count))
+            lines.append("%s %r" % (format_name(metric + '_sum', labels), total))
+            lines.append("%s %d" % (format_name(metric + '_count', labels), count))
+
+        metric = self.prefix + '_phase_seconds'
+        lines.append("# TYPE %s gauge" % metric)
+        for name, phase in sorted(snapshot["phases"].items()):
+            lines.append("%s %r" % (format_name(metric, (('phase', name),)), phase["seconds"]))
+        return '\n'.join(lines) + '\n'
+
+    def progress_line(self):
+        '''
+        :return: short human readable summary for the log
+        '''
+        snapshot = self.snapshot()
+        parts = []
+        for name, phase in snapshot["phases"].items():
+            part = "%s %.1fs" % (name, phase["seconds"])
+            if phase["rows"]:
+                part += " %d rows (%s rows/s)" % (phase["rows"], phase["rows_per_sec"])
+            parts.append(part)
+        for name, summary in snapshot["latency"].items():
+            if summary["count"]:
+                parts.append("%s p50 %.1fms p99 %.1fms" % (name, summary["p50"] * 1000, summary["p99"] * 1000))
+        if snapshot["gauges"]:
+            parts.append(", ".join("%s %s" % item for item in sorted(snapshot["gauges"].items())))
+        if snapshot["errors"]:
+            parts.append("errors %s" % ", ".join("%s=%d" % item for item in sorted(snapshot["errors"].items())))
+        return "; ".join(parts) or "nothing recorded yet"
+
+
+def format_name(name, labels):
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                       for key, value in labels))
+
+
+class ProgressReporter(object):
+    '''
+    Background thread that reports every interval seconds, and once more on stop().
+    :param metrics: Metrics to report
+    :param interval: seconds between reports; 0 only reports on stop()
+    :param path: optional file to dump the metrics to, '-' for stdout
+    :param fmt: 'json' (append one line per report) or 'prometheus' (replace the file with the latest values)
+    :param log: logger for the one line progress summary
+    '''
+    def __init__(self, metrics, interval=10.0, path=None, fmt='json', log=LOG):
+        self.metrics = metrics
+        self.interval = interval
+        self.path = path
+        self.fmt = fmt
+        self.log = log
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval:
+            self._thread = threading.Thread(target=self._run, name='progress')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.report()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def report(self):
+        self.log.info("Progress: %s", self.metrics.progress_line())
+        if not self.path:
+            return
+        if self.fmt == 'prometheus':
+            text = self.metrics.prometheus_text()
+            if self.path == '-':
+                print(text, end='')
+                return
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as fh:
+                fh.write(text)
+            os.replace(tmp_path, self.path)
+        elif self.path == '-':
+            print(self.metrics.json_line())
+        else:
+            with open(self.path, 'a') as fh:
+                fh.write(self.metrics.json_line() + '\n')
+
+
+def add_options(parser):
+    '''
+    Add the --metrics / --metrics-format / --progress / --debug options shared by the loaders.
+    '''
+    parser.add_argument('--metrics', dest='metrics', action="store", metavar="FILE",
+                        help="Write load metrics to FILE ('-' for stdout)")
+    parser.add_argument('--metrics-format', dest='metrics_format', choices=['json', 'prometheus'], default='json',
+                        help='JSON lines appended per report, or a Prometheus text file replaced per report '
+                             '(default json)')
+    parser.add_argument('--progress', dest='progress', action="store", metavar="SECONDS", type=float, default=10.0,
+                        help='Seconds between progress reports, 0 for a final report only (default 10)')
+    parser.add_argument('--debug', dest='debug', action="store_true",
+                        help='Log every batch that is written')
+
+
+def reporter_from_args(args, metrics, log):
+    '''
+    Set log's level from --debug and build the ProgressReporter for the options added by add_options().
+    '''
+    log.setLevel(logging.DEBUG if args.debug else logging.INFO)
+    return ProgressReporter(metrics, interval=args.progress, path=args.metrics, fmt=args.metrics_format, log=log)
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+'''
+Compact binary form of the Neptune CSV tables (station-nodes / station-edges), read through mmap.
+
+A .cdx file holds one table with the same columns as the CSV it replaces. Every string, including `~id`, `~from` and
+`~to`, is stored once in an interned string table, and string columns hold 32 bit indices into it, so an edge's
+endpoints are plain integers. Numeric and boolean columns are fixed width arrays. Nothing has to be parsed or
+converted on load: read_batches() maps the file and hands out neptune_csv.ColumnBatches whose columns are memoryviews
+on the mapping, and strings are only decoded when a value is actually looked at.
+
+neptune_csv.read_batches() recognises these files by their magic, so anything that takes a vertex or edge CSV also
+takes a .cdx file.
+
+Layout (native byte order, every section 8 byte aligned):
+    preamble   magic, byte length of the directory
+    directory  JSON: row count, where the string table and each column's data and missing mask start
+    strings    count+1 offsets into the utf-8 blob that follows them
+    columns    per column: n values, then an optional n byte mask with 1 where the property is missing
+
+Offsets, integer columns and string indices are written in the narrowest integer type that holds all of their
+values (a label column of a handful of distinct strings costs one byte per row); the directory records each type.
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import argparse
+import array
+import csv
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+import neptune_csv
+
+MAGIC = b'CDXTBL01'
+PREAMBLE = struct.Struct('<8sQ')
+# Typecode the string index columns are collected in; they are narrowed on write like the integer columns
+STRING_INDEX = 'I'
+# Narrowest first
+SIGNED = ('b', 'h', 'i', 'q')
+UNSIGNED = ('B', 'H', 'I', 'Q')
+# Values (or mask bytes) a TableWriter column buffers before appending them to its spool file
+SPOOL_ROWS = 65536
+
+
+def pad8(length):
+    return (8 - length % 8) % 8
+
+
+def narrowest(store):
+    '''
+    :return: smallest array typecode of the same kind that holds every value in an integer array
+    '''
+    if not len(store):
+        return narrowest_range(store.typecode, None, None)
+    return narrowest_range(store.typecode, min(store), max(store))
+
+
+def narrowest_range(typecode, low, high):
+    '''
+    :return: smallest array typecode of the same kind as typecode that holds every value from low to high (both None
+             for no values)
+    '''
+    codes = SIGNED if typecode in SIGNED else UNSIGNED
+    if low is None:
+        return codes[0]
+    for code in codes:
+        bits = 8 * array.array(code).itemsize
+        if code in SIGNED and -2 ** (bits - 1) <= low and high < 2 ** (bits - 1):
+            return code
+        if code in UNSIGNED and high < 2 ** bits:
+            return code
+    return codes[-1]
+
+
+def is_binary(path):
+    '''
+    :return: True if path is a .cdx table (judged by its magic, not its name)
+    '''
+    with open(path, 'rb') as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+class ColumnSpool(object):
+    '''
+    One column of a TableWriter: values (and the missing mask, once a value is missing) are buffered and appended to
+    temporary files, keeping the range of the values for narrowing them on write.
+    '''
+    def __init__(self, typecode):
+        self.values = array.array(typecode)
+        self.file = tempfile.TemporaryFile()
+        self.low = self.high = None
+        self.mask = None
+        self.mask_file = None
+        self.mask_length = 0
+
+    def append(self, value):
+        self.values.append(value)
+        if len(self.values) >= SPOOL_ROWS:
+            self.flush()
+
+    def mark_missing(self, row):
+        '''
+        Note that the value appended for row is missing.
+        '''
+        if self.mask is None:
+            self.mask = bytearray()
+            self.mask_file = tempfile.TemporaryFile()
+        self.mask.extend(b'\0' * (row - self.mask_length))
+        self.mask.append(1)
+        self.mask_length = row + 1
+        if len(self.mask) >= SPOOL_ROWS:
+            self.flush()
+
+    def flush(self):
+        if self.values:
+            if self.values.typecode != 'd':
+                low, high = min(self.values), max(self.values)
+                self.low = low if self.low is None else min(self.low, low)
+                self.high = high if self.high is None else max(self.high, high)
+            self.values.tofile(self.file)
+            del self.values[:]
+        if self.mask:
+            self.mask_file.write(self.mask)
+            self.mask = bytearray()
+
+    def typecode(self):
+        '''
+        :return: typecode the values are written in: integer columns (and string indices) in the narrowest width that
+                 fits their values
+        '''
+        if self.values.typecode == 'd':
+            return 'd'
+        return narrowest_range(self.values.typecode, self.low, self.high)
+
+    def copy_values(self, out, length):
+        '''
+        Write the spooled values to out in typecode(), a chunk at a time.
+        '''
+        self.flush()
+        self.file.seek(0)
+        typecode = self.typecode()
+        chunk = array.array(self.values.typecode)
+        while length:
+            del chunk[:]
+            chunk.fromfile(self.file, min(length, SPOOL_ROWS))
+            length -= len(chunk)
+            out.write(chunk if chunk.typecode == typecode else array.array(typecode, chunk))
+
+    def copy_mask(self, out, length):
+        self.mask.extend(b'\0' * (length - self.mask_length))
+        self.mask_length = length
+        self.flush()
+        self.mask_file.seek(0)
+        shutil.copyfileobj(self.mask_file, out)
+
+    def close(self):
+        self.file.close()
+        if self.mask_file is not None:
+            self.mask_file.close()
+
+
+class TableWriter(object):
+    '''
+    Write rows as a .cdx table: each column is spooled to a temporary file as the rows come in, and the spools are
+    concatenated behind the directory on close(), so only the interned strings are held in memory. Used like
+    csv.DictWriter.
+    :param path: output file
+    :param headers: Neptune CSV headers, e.g. ["~id", "~label", "lat:double"]
+    '''
+    def __init__(self, path, headers):
+        self.path = path
+        self.schema = neptune_csv.Schema(headers)
+        self.index = {}
+        # utf-8 encoded, in index order
+        self.strings = []
+        self.string_bytes = 0
+        self.data = [ColumnSpool(column.typecode or STRING_INDEX) for column in self.schema.columns]
+        self.length = 0
+
+    def intern(self, value):
+        i = self.index.get(value)
+        if i is None:
+            i = self.index[value] = len(self.strings)
+            blob = value.encode('utf8')
+            self.strings.append(blob)
+            self.string_bytes += len(blob)
+        return i
+
+    def writerow(self, row):
+        '''
+        :param row: dict of header -> value; values may be strings (as read from a CSV) or already typed.
+                    None or '' leaves a property missing.
+        '''
+        for column, store in zip(self.schema.columns, self.data):
+            value = row.get(column.header)
+            if value is None or value == '':
+                if not column.system:
+                    store.mark_missing(self.length)
+                    store.append(0)
+                    continue
+                value = ''
+            if not column.typecode:
+                store.append(self.intern(str(value)))
+            elif isinstance(value, str):
+                store.append(column.coerce(value))
+            else:
+                store.append(value)
+        self.length += 1
+
+    def close(self):
+        try:
+            self._write()
+        finally:
+            for store in self.data:
+                store.close()
+
+    def _write(self):
+        offsets_type = narrowest_range('Q', 0, self.string_bytes)
+        for store in self.data:
+            store.flush()
+
+        # Section offsets are relative to the end of the directory, so they do not depend on its length
+        pos = 0
+
+        def section(length):
+            nonlocal pos
+            start = pos
+            pos += length + pad8(length)
+            return start
+
+        strings = {"count": len(self.strings), "type": offsets_type,
+                   "offsets": section((len(self.strings) + 1) * array.array(offsets_type).itemsize),
+                   "data": section(self.string_bytes)}
+        columns = []
+        for column, store in zip(self.schema.columns, self.data):
+            typecode = store.typecode()
+            entry = {"header": column.header, "type": typecode,
+                     "data": section(self.length * array.array(typecode).itemsize), "missing": None}
+            if store.mask_file is not None:
+                entry["missing"] = section(self.length)
+            columns.append(entry)
+        directory = json.dumps({"rows": self.length, "strings": strings, "columns": columns}).encode('utf8')
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            fh.write(PREAMBLE.pack(MAGIC, len(directory)))
+            fh.write(directory + b'\0' * pad8(len(directory)))
+
+            def pad(length):
+                fh.write(b'\0' * pad8(length))
+
+            offsets = array.array(offsets_type, [0])
+            for blob in self.strings:
+                offsets.append(offsets[-1] + len(blob))
+            fh.write(offsets)
+            pad(len(offsets) * offsets.itemsize)
+            del offsets
+            for blob in self.strings:
+                fh.write(blob)
+            pad(self.string_bytes)
+            for store, entry in zip(self.data, columns):
+                store.copy_values(fh, self.length)
+                pad(self.length * array.array(entry["type"]).itemsize)
+                if store.mask_file is not None:
+                    store.copy_mask(fh, self.length)
+                    pad(self.length)
+        os.replace(tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            for store in self.data:
+                store.close()
+
+
+def write_table(path, headers, rows):
+    '''
+    Write an iterable of DictWriter-style rows to a .cdx table.
+    :return: number of rows written
+    '''
+    with TableWriter(path, headers) as writer:
+        for row in rows:
+            writer.writerow(row)
+    return writer.length
+
+
+def convert(csv_path, out_path):
+    '''
+    Convert a Neptune CSV file to a .cdx table.
+    :return: number of rows written
+    '''
+    with open(csv_path) as csvfile:
+        reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+        headers = next(reader)
+        return write_table(out_path, headers, (dict(zip(headers, fields)) for fields in reader if fields))
+
+
+class StringTable(object):
+    '''
+    The interned strings of a table, decoded on first use.
+    '''
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+        self.decoded = [None] * (len(offsets) - 1)
+
+    def __len__(self):
+        return len(self.decoded)
+
+    def __getitem__(self, i):
+        value = self.decoded[i]
+        if value is None:
+            value = self.decoded[i] = str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf8')
+        return value
+
+
+class StringColumn(object):
+    '''
+    Sequence view of a string column: `indices` are the stored integers, items are the strings they stand for.
+    '''
+    def __init__(self, indices, strings):
+        self.indices = indices
+        self.strings = strings
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, row):
+        return self.strings[self.indices[row]]
+
+    def __iter__(self):
+        strings = self.strings
+        for i in self.indices:
+            yield strings[i]
+
+
+class BinaryTable(object):
+    '''
+    A .cdx table mapped into memory. Columns are memoryviews on the mapping; nothing is copied or parsed.
+    '''
+    def __init__(self, path):
+        # The mapping keeps its own handle on the file, and stays alive for as long as any view on it does
+        with open(path, 'rb') as fh:
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, dir_len = PREAMBLE.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a .cdx table" % path)
+        directory = json.loads(bytes(self.map[PREAMBLE.size:PREAMBLE.size + dir_len]).decode('utf8'))
+        body = PREAMBLE.size + dir_len + pad8(dir_len)
+        view = memoryview(self.map)
+
+        self.length = n = directory["rows"]
+        self.schema = neptune_csv.Schema([entry["header"] for entry in directory["columns"]])
+
+        strings = directory["strings"]
+        start = body + strings["offsets"]
+        offsets = view[start:start + array.array(strings["type"]).itemsize * (strings["count"] + 1)].cast(strings["type"])
+        self.strings = StringTable(offsets, view[body + strings["data"]:body + strings["data"] + offsets[-1]])
+
+        self.columns = []
+        self.masks = []
+        for column, entry in zip(self.schema.columns, directory["columns"]):
+            typecode = entry["type"]
+            start = body + entry["data"]
+            self.columns.append(view[start:start + array.array(typecode).itemsize * n].cast(typecode))
+            start = entry["missing"]
+            self.masks.append(None if start is None else view[body + start:body + start + n])
+
+    def __len__(self):
+        return self.length
+
+    def batches(self, batch_size=10000):
+        '''
+        :return: generator of neptune_csv.ColumnBatch over consecutive slices of the table
+        '''
+        for start in range(0, self.length, batch_size):
+            end = min(start + batch_size, self.length)
+            data = []
+            for column, values in zip(self.schema.columns, self.columns):
+                values = values[start:end]
+                data.append(values if column.typecode else StringColumn(values, self.strings))
+            missing = [None if mask is None else mask[start:end] for mask in self.masks]
+            yield neptune_csv.ColumnBatch.wrap(self.schema, data, missing, end - start)
+
+
+def read_batches(path, batch_size=10000):
+    '''
+    Same as neptune_csv.read_batches(), for a .cdx table.
+    '''
+    for batch in BinaryTable(path).batches(batch_size):
+        yield batch
+
+
+def main():
+    args = parse_options()
+
+    if args.command == 'convert':
+        for csv_path in args.files:
+            out_path = os.path.splitext(csv_path)[0] + '.cdx'
+            rows = convert(csv_path, out_path)
+            print("Wrote %d rows to %s (%d bytes, CSV %d bytes)" % (rows, out_path, os.path.getsize(out_path),
+                                                                    os.path.getsize(csv_path)))
+        return
+
+    for path in args.files:
+        table = BinaryTable(path)
+        print("%s: %d rows, %d strings" % (path, len(table), len(table.strings)))
+        for column, values, mask in zip(table.schema.columns, table.columns, table.masks):
+            missing = sum(mask) if mask is not None else 0
+            stored = values.format if column.typecode else "string (%s)" % values.format
+            print("  %-20s %-12s %d missing" % (column.header, stored, missing))
+
+
+def parse_options():
+     parser = argparse.ArgumentParser(description='Convert Neptune CSVs to .cdx tables, or describe .cdx tables')
+     subparsers = parser.add_subparsers(dest='command')
+     subparsers.required = True
+
+     convert_cmd = subparsers.add_parser('convert', help='Write FILE.cdx next to every FILE.csv')
+     convert_cmd.add_argument('files', nargs='+', metavar='CSV')
+     info = subparsers.add_parser('info', help='Show the columns of .cdx tables')
+     info.add_argument('files', nargs='+', metavar='CDX')
+
+     return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
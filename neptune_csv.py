@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+'''
+Typed, columnar reader for the Neptune CSV format that wmata2csv.py writes and the loaders read.
+
+The header is parsed once into a Schema: system columns (`~id`, `~label`, `~from`, `~to`) plus typed property
+columns (`name:type`). Rows are read with a plain csv.reader and coerced per column into array-backed storage, so a
+ColumnBatch of numeric columns costs a few bytes per value instead of a dict and a string per row.
+
+An empty property value means the row has no such property (as in the Neptune bulk loader) and is left out of the
+row's record.
+
+read_batches() also reads the binary .cdx tables written by neptune_bin.py, which come back as the same ColumnBatches,
+and with workers parses big CSVs in a process pool (parallel_csv.py).
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import array
+import csv
+
+# Neptune property types that get a typed array; anything else (string, date, ...) is kept as a list of str
+TYPECODES = {
+    'bool': 'b',
+    'boolean': 'b',
+    'byte': 'q',
+    'short': 'q',
+    'int': 'q',
+    'long': 'q',
+    'float': 'd',
+    'double': 'd'
+}
+
+
+def to_bool(value):
+    value = value.strip().lower()
+    if value in ('true', '1'):
+        return True
+    if value in ('false', '0'):
+        return False
+    raise ValueError("invalid literal for bool: %r" % value)
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        # Tolerate "18695.0" in an int column
+        return int(float(value))
+
+
+class Column(object):
+    '''
+    One CSV column: its header, the property (or system column) name and Neptune type.
+    '''
+    def __init__(self, header, index):
+        self.header = header
+        self.index = index
+        self.system = header.startswith('~')
+        if self.system:
+            self.name, self.type = header, 'string'
+        else:
+            name, _, ptype = header.partition(':')
+            self.name, self.type = name, (ptype.lower() or 'string')
+        self.typecode = TYPECODES.get(self.type, '')
+
+        if self.typecode == 'b':
+            self.coerce = to_bool
+        elif self.typecode == 'q':
+            self.coerce = to_int
+        elif self.typecode == 'd':
+            self.coerce = float
+        else:
+            self.coerce = None
+
+    def new_storage(self):
+        return array.array(self.typecode) if self.typecode else []
+
+
+class Schema(object):
+    '''
+    Parsed header of a Neptune CSV file.
+    '''
+    def __init__(self, headers):
+        self.headers = list(headers)
+        self.columns = [Column(header, i) for i, header in enumerate(self.headers)]
+        self.by_name = dict((column.name, column) for column in self.columns)
+
+    @property
+    def property_columns(self):
+        return [column for column in self.columns if not column.system]
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def record(self, row):
+        '''
+        Typed record, like ColumnBatch.records() produces, for a row built in memory rather than read from a file.
+        :param row: dict of header -> value (as passed to csv.DictWriter); values may be strings or already typed,
+                    None or '' means missing, keys that are not columns are ignored
+        '''
+        record = {}
+        for column in self.columns:
+            value = row.get(column.header)
+            if value is None or (value == '' and not column.system):
+                continue
+            if column.coerce is not None and isinstance(value, str):
+                value = column.coerce(value)
+            record[column.name] = value
+        return record
+
+
+class ColumnBatch(object):
+    '''
+    A block of rows stored column by column.
+    '''
+    def __init__(self, schema):
+        self.schema = schema
+        self.data = [column.new_storage() for column in schema.columns]
+        # Per column bytearray of missing flags, only allocated once a column has a missing value
+        self.missing = [None] * len(schema.columns)
+        self.length = 0
+
+    @classmethod
+    def wrap(cls, schema, data, missing, length):
+        '''
+        Batch over existing column storage (e.g. memoryviews from neptune_bin.py), without copying it.
+        :param data: per column sequence of values
+        :param missing: per column missing mask (1 = missing) or None
+        '''
+        batch = cls.__new__(cls)
+        batch.schema = schema
+        batch.data = data
+        batch.missing = missing
+        batch.length = length
+        return batch
+
+    def __len__(self):
+        return self.length
+
+    def append(self, fields):
+        n_fields = len(fields)
+        for column, store in zip(self.schema.columns, self.data):
+            value = fields[column.index] if column.index < n_fields else ''
+            if value == '' and not column.system:
+                self._mark_missing(column.index)
+                store.append(0 if column.typecode else '')
+            elif column.coerce is not None:
+                store.append(column.coerce(value))
+            else:
+                store.append(value)
+        self.length += 1
+
+    def _mark_missing(self, index):
+        mask = self.missing[index]
+        if mask is None:
+            mask = self.missing[index] = bytearray(self.length)
+        mask.extend(b'\0' * (self.length - len(mask)))
+        mask.append(1)
+
+    def is_missing(self, index, row):
+        mask = self.missing[index]
+        return mask is not None and row < len(mask) and mask[row] == 1
+
+    def column(self, name):
+        '''
+        :param name: system column (e.g. "~id") or property name (e.g. "lat")
+        :return: the column's storage (array.array or list; bool columns hold 0/1)
+        '''
+        return self.data[self.schema.by_name[name].index]
+
+    def records(self):
+        '''
+        Rows as dicts of system column / property name -> typed value, with missing properties left out.
+        '''
+        names = [column.name for column in self.schema.columns]
+        # Bool columns are stored as 0/1 bytes; turn them back into booleans
+        bools = [column.typecode == 'b' for column in self.schema.columns]
+        for row in range(self.length):
+            record = {}
+            for index, store in enumerate(self.data):
+                if self.missing[index] is not None and self.is_missing(index, row):
+                    continue
+                record[names[index]] = bool(store[row]) if bools[index] else store[row]
+            yield record
+
+
+def read_batches(path, batch_size=10000, workers=1):
+    '''
+    Read a Neptune CSV file as a stream of ColumnBatches.
+    :param path: CSV file (or .cdx table)
+    :param batch_size: rows per batch
+    :param workers: number of processes to parse a CSV with (see parallel_csv.py); None uses one per core for big
+                    files
+    :return: generator of ColumnBatch
+    '''
+    # Imported here because neptune_bin and parallel_csv build on this module
+    import neptune_bin
+    if workers != 1 and not neptune_bin.is_binary(path):
+        import parallel_csv
+        for batch in parallel_csv.read_batches(path, batch_size, workers):
+            yield batch
+        return
+    if neptune_bin.is_binary(path):
+        for batch in neptune_bin.read_batches(path, batch_size):
+            yield batch
+        return
+
+    with open(path) as csvfile:
+        reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+        try:
+            schema = Schema(next(reader))
+        except StopIteration:
+            return
+
+        batch = ColumnBatch(schema)
+        for fields in reader:
+            if not fields:
+                continue
+            batch.append(fields)
+            if batch.length >= batch_size:
+                yield batch
+                batch = ColumnBatch(schema)
+        if batch.length:
+            yield batch
+
+
+def iter_records(path, batch_size=10000, workers=1):
+    '''
+    Typed records for every row in a Neptune CSV file, read batch by batch.
+    '''
+    for batch in read_batches(path, batch_size, workers):
+        for record in batch.records():
+            yield record
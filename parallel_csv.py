@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+'''
+Parse a big Neptune CSV file on every core (used by neptune_csv.read_batches() when given workers).
+
+The file is cut into chunks of about CHUNK_BYTES, each ending just after a newline that ends a record, and a pool of
+processes parses the chunks independently: every worker reads its own byte range from the file and fills typed
+ColumnBatches, so nothing but the byte offsets is sent to the workers.
+
+A newline inside a quoted field does not end a record. Whether a position is inside quotes follows from the number
+of quote characters before it (an escaped "" counts twice and does not change it), so a first, cheap pass over the
+file in parallel counts the quotes in each chunk, and every chunk boundary is then moved to the first newline after
+it that is outside quotes. This relies on quotes only appearing in quoted fields, as csv.writer and every RFC 4180
+writer produce them.
+
+Parsed chunks travel back packed the way neptune_bin.py stores a table: numeric columns as the raw bytes of their
+arrays, string columns interned into a single utf-8 blob with narrow index arrays, missing masks as bytes. Pickling
+that is a handful of memcpys rather than one object per value, and the parent wraps the buffers in memoryviews
+without copying them. Chunks are parsed at most 2 per worker ahead of the consumer and come out in file order.
+
+The loaders parse while their writer threads (and the drivers' own threads) are running, so the pool's processes are
+started by a fork server (spawned where there is none) rather than forked from this process, which could hand a
+child a lock some other thread was holding. A worker only needs the path and its byte range.
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import argparse
+import array
+import collections
+import csv
+import io
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import neptune_bin
+import neptune_csv
+
+CHUNK_BYTES = 16 * 1024 * 1024
+# Smaller files are not worth starting a pool for
+PARALLEL_MIN_BYTES = 4 * CHUNK_BYTES
+# Read size while looking for a record boundary
+SCAN_BYTES = 64 * 1024
+# How the pool's processes are started: never by forking this (multithreaded) process
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def read_range(path, start, end):
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        return fh.read(end - start)
+
+
+def count_quotes(job):
+    path, start, end = job
+    return read_range(path, start, end).count(b'"')
+
+
+def record_boundary(fh, pos, inside):
+    '''
+    :param fh: file opened in binary mode
+    :param pos: byte offset to search from
+    :param inside: whether pos is inside a quoted field
+    :return: offset just past the first newline at or after pos that ends a record, or the end of the file
+    '''
+    fh.seek(pos)
+    while True:
+        block = fh.read(SCAN_BYTES)
+        if not block:
+            return pos
+        start = 0
+        while True:
+            newline = block.find(b'\n', start)
+            if newline < 0:
+                inside ^= block.count(b'"', start) & 1
+                break
+            inside ^= block.count(b'"', start, newline) & 1
+            if not inside:
+                return pos + newline + 1
+            start = newline + 1
+        pos += len(block)
+
+
+def parse_chunk(job):
+    '''
+    Worker: parse the records in one byte range of the file.
+    :return: packed chunk, see pack()
+    '''
+    path, start, end, headers = job
+    # Universal newlines, like the serial reader's open()
+    text = io.StringIO(read_range(path, start, end).decode('utf8'), newline=None)
+    batch = neptune_csv.ColumnBatch(neptune_csv.Schema(headers))
+    for fields in csv.reader(text, delimiter=',', quotechar='"'):
+        if fields:
+            batch.append(fields)
+    return pack(batch)
+
+
+def pack(batch):
+    '''
+    :return: (rows, [(typecode, bytes) per column], [mask bytes or None per column], offsets typecode,
+              offsets bytes, string blob); string columns hold indices into the strings
+    '''
+    index = {}
+    strings = []
+    columns = []
+    for column, store in zip(batch.schema.columns, batch.data):
+        if not column.typecode:
+            indices = array.array(neptune_bin.STRING_INDEX)
+            for value in store:
+                i = index.get(value)
+                if i is None:
+                    i = index[value] = len(strings)
+                    strings.append(value)
+                indices.append(i)
+            store = array.array(neptune_bin.narrowest(indices), indices)
+        columns.append((store.typecode, store.tobytes()))
+
+    missing = []
+    for mask in batch.missing:
+        if mask is not None:
+            mask = bytes(mask) + b'\0' * (batch.length - len(mask))
+        missing.append(mask)
+
+    blobs = [value.encode('utf8') for value in strings]
+    offsets = array.array('Q', [0])
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    offsets = array.array(neptune_bin.narrowest(offsets), offsets)
+    return batch.length, columns, missing, offsets.typecode, offsets.tobytes(), b''.join(blobs)
+
+
+def unpack(schema, packed, batch_size):
+    '''
+    :return: generator of ColumnBatches of at most batch_size rows over a packed chunk, without copying it
+    '''
+    length, columns, missing, offsets_type, offsets, blob = packed
+    strings = neptune_bin.StringTable(memoryview(offsets).cast(offsets_type), memoryview(blob))
+    views = [memoryview(data).cast(typecode) for typecode, data in columns]
+    for start in range(0, length, batch_size):
+        end = min(start + batch_size, length)
+        data = []
+        for column, values in zip(schema.columns, views):
+            values = values[start:end]
+            data.append(values if column.typecode else neptune_bin.StringColumn(values, strings))
+        masks = [None if mask is None else memoryview(mask)[start:end] for mask in missing]
+        yield neptune_csv.ColumnBatch.wrap(schema, data, masks, end - start)
+
+
+def split(path, executor, chunk_bytes=CHUNK_BYTES):
+    '''
+    :return: (header row, list of (start, end) byte ranges of whole records covering the rest of the file)
+    '''
+    size = os.path.getsize(path)
+    with open(path, 'rb') as fh:
+        data_start = record_boundary(fh, 0, False)
+        fh.seek(0)
+        headers = next(csv.reader(io.StringIO(fh.read(data_start).decode('utf8'), newline=None)), None)
+
+        raw = list(range(data_start, size, chunk_bytes)) + [size]
+        counts = executor.map(count_quotes, [(path, start, end) for start, end in zip(raw[:-1], raw[1:])])
+
+        bounds = [data_start]
+        quotes = 0
+        for start, count in zip(raw[1:-1], counts):
+            quotes += count
+            # A huge quoted field can carry a boundary past the next one
+            bounds.append(max(record_boundary(fh, start, quotes & 1), bounds[-1]))
+        bounds.append(size)
+    return headers, [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def read_batches(path, batch_size=10000, workers=None, chunk_bytes=CHUNK_BYTES):
+    '''
+    Same as neptune_csv.read_batches(), parsed by a pool of processes.
+    :param workers: number of processes; None uses one per core for files of PARALLEL_MIN_BYTES and more, and
+                    parses smaller ones in this process
+    :param chunk_bytes: about how much of the file each worker parses at a time
+    '''
+    if workers is None:
+        workers = (os.cpu_count() or 1) if os.path.getsize(path) >= PARALLEL_MIN_BYTES else 1
+    if workers <= 1 or neptune_bin.is_binary(path):
+        for batch in neptune_csv.read_batches(path, batch_size):
+            yield batch
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(START_METHOD)) as executor:
+        headers, chunks = split(path, executor, chunk_bytes)
+        if headers is None:
+            return
+        schema = neptune_csv.Schema(headers)
+
+        # Keep every worker busy, but only so far ahead of the consumer
+        jobs = iter(chunks)
+        pending = collections.deque()
+        for start, end in jobs:
+            pending.append(executor.submit(parse_chunk, (path, start, end, headers)))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            packed = pending.popleft().result()
+            for start, end in jobs:
+                pending.append(executor.submit(parse_chunk, (path, start, end, headers)))
+                break
+            for batch in unpack(schema, packed, batch_size):
+                yield batch
+
+
+def main():
+    args = parse_options()
+    for workers in sorted(set((1, args.workers))):
+        start = time.time()
+        rows = sum(len(batch) for batch in read_batches(args.file, workers=workers))
+        seconds = time.time() - start
+        print("%d worker(s): %d rows in %.2fs (%.0f rows/s)" % (workers, rows, seconds, rows / seconds))
+
+
+def parse_options():
+     parser = argparse.ArgumentParser(description='Time parsing a Neptune CSV serially and with a process pool')
+     parser.add_argument('file', metavar='CSV')
+     parser.add_argument('-w', '--workers', dest='workers', action="store", metavar="INT", type=int,
+                         default=os.cpu_count(), help='Number of processes (default one per core)')
+     return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+'''
+Parallel load engine shared by csv2neptune.py and csv2neo4j.py.
+
+Vertices are partitioned by a hash of their id and written by a pool of worker threads, each holding its own
+connection/session ("writer"). Edges are grouped by the partitions of their two endpoints and only scheduled once
+both of those partitions have been committed, so an edge never races the creation of its vertices.
+
+A writer is any object with write_vertices(rows), write_edges(rows) and close() methods, where rows is a list of
+neptune_csv records. If it also has upsert_vertices(rows) / upsert_edges(rows), failed requests are retried through
+those, so a retry cannot duplicate rows that the failed request did write.
+
+How many rows go into a request and how many requests may be in flight is up to a write_control.WriteController,
+which also decides whether a failed request is retried. Without one both are fixed and nothing is retried.
+
+Given a metrics.Metrics, every write request is recorded: rows written per phase, request latency per writer method
+and exceptions by type. The vertex and edge phases are timed, as is the time spent reading rows from the input. The
+vertex phase lasts until its last batch is written, so it overlaps the edge phase by the edges of the partitions that
+were committed before that.
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import logging
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from write_control import WriteController
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+LOG = logging.getLogger('parallel_load')
+
+# A request that failed may still have been applied (e.g. the connection dropped while the commit went through), so
+# retries go to the writer's idempotent counterpart of the method when it has one
+RETRY_METHODS = {'write_vertices': 'upsert_vertices', 'write_edges': 'upsert_edges'}
+
+
+def partition_of(vertex_id, partitions):
+    '''
+    Stable partition number for a vertex id. crc32 rather than hash() so it does not change between processes.
+    :param vertex_id: original (untransformed) vertex id
+    :param partitions: number of partitions
+    :return: int in [0, partitions)
+    '''
+    return zlib.crc32(vertex_id.encode('utf8')) % partitions
+
+
+class ParallelLoader(object):
+    '''
+    Load vertex and edge rows through a pool of writers.
+    :param open_writer: callable returning a new writer; called once per worker
+    :param workers: number of worker threads (and writers)
+    :param batch_size: rows per write request
+    :param partitions: number of vertex partitions, defaults to 4 per worker
+    :param metrics: optional metrics.Metrics to record requests, latencies and errors in
+    :param controller: optional write_control.WriteController; its batch size replaces batch_size
+    '''
+
+    def __init__(self, open_writer, workers=4, batch_size=1000, partitions=None, metrics=None, controller=None):
+        self.open_writer = open_writer
+        self.metrics = metrics
+        self.workers = workers
+        # Keep at most two batches queued per worker so reading never runs far ahead of writing
+        self.controller = controller or WriteController.fixed(batch_size, workers * 2)
+        self.partitions = partitions or workers * 4
+
+        self._writers = queue.Queue()
+        self._cond = threading.Condition()
+        self._pending = [0] * self.partitions
+        self._sealed = False
+        # When the last vertex batch was submitted, to time the vertex phase up to its last write
+        self._sealed_at = None
+        self._errors = []
+        self._running = 0
+
+    def load(self, vertices, edges, vertex_method='write_vertices', edge_method='write_edges'):
+        '''
+        Load every vertex row, then every edge row.
+        :param vertices: iterable of vertex rows (must have "~id")
+        :param edges: iterable of edge rows (must have "~from" and "~to")
+        :param vertex_method: writer method the vertex batches are passed to, e.g. 'upsert_vertices'
+        :param edge_method: writer method the edge batches are passed to, e.g. 'upsert_edges'
+        :return: (vertex count, edge count)
+        '''
+        writers = [self.open_writer() for _ in range(self.workers)]
+        for writer in writers:
+            self._writers.put(writer)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                if self.metrics is None:
+                    n_vertices = self._load_vertices(executor, vertices, vertex_method)
+                    n_edges = self._load_edges(executor, edges, edge_method)
+                else:
+                    # No drain in between: edges go out as soon as their partitions are committed, and _done() adds
+                    # the time the last vertex batches take to the vertex phase
+                    with self.metrics.phase('vertices'):
+                        n_vertices = self._load_vertices(executor, self.metrics.timed(vertices, 'parse'),
+                                                         vertex_method)
+                    with self.metrics.phase('edges'):
+                        n_edges = self._load_edges(executor, self.metrics.timed(edges, 'parse'), edge_method)
+                        self._drain()
+        finally:
+            for writer in writers:
+                writer.close()
+
+        self._raise_errors()
+        return n_vertices, n_edges
+
+    def _load_vertices(self, executor, vertices, method):
+        count = 0
+        buckets = [[] for _ in range(self.partitions)]
+        for row in vertices:
+            p = partition_of(row["~id"], self.partitions)
+            buckets[p].append(row)
+            if len(buckets[p]) >= self.controller.batch_size:
+                self._submit(executor, method, buckets[p], p)
+                buckets[p] = []
+            count += 1
+
+        for p, bucket in enumerate(buckets):
+            if bucket:
+                self._submit(executor, method, bucket, p)
+
+        # Every vertex batch is now submitted; a partition is committed as soon as its pending count drops to zero
+        with self._cond:
+            self._sealed = True
+            self._sealed_at = time.time()
+            self._vertices_written()
+            self._cond.notify_all()
+
+        LOG.debug("Scheduled %d vertices across %d partitions", count, self.partitions)
+        return count
+
+    def _load_edges(self, executor, edges, method):
+        count = 0
+        waiting = {}
+        every_partition = range(self.partitions)
+        all_committed = False
+        for row in edges:
+            # Once every partition is committed (it stays that way) there is no need to group the edges any more,
+            # and grouping would hold up to batch_size rows for every pair of partitions
+            if not all_committed and self._committed(every_partition):
+                all_committed = True
+            if all_committed:
+                key = ()
+            else:
+                key = tuple(sorted((partition_of(row["~from"], self.partitions),
+                                    partition_of(row["~to"], self.partitions))))
+            group = waiting.setdefault(key, [])
+            group.append(row)
+            if len(group) >= self.controller.batch_size and self._committed(key):
+                self._submit(executor, method, group)
+                waiting[key] = []
+            count += 1
+
+        # Flush the remaining groups as their partitions commit
+        while waiting:
+            with self._cond:
+                self._raise_errors()
+                ready = [key for key in waiting if self._committed(key)]
+                if not ready:
+                    self._cond.wait()
+                    continue
+            for key in ready:
+                group = waiting.pop(key)
+                for batch in self.controller.split(group):
+                    self._submit(executor, method, batch)
+
+        LOG.debug("Scheduled %d edges", count)
+        return count
+
+    def _committed(self, partitions):
+        with self._cond:
+            return self._sealed and all(self._pending[p] == 0 for p in partitions)
+
+    def _submit(self, executor, method, batch, partition=None):
+        with self._cond:
+            # The in-flight limit can change while we wait, so check it again on every wakeup
+            while self._running >= self.controller.inflight and not self._errors:
+                self._cond.wait()
+            self._raise_errors()
+            self._running += 1
+            if partition is not None:
+                self._pending[partition] += 1
+        future = executor.submit(self._write, method, batch)
+        future.add_done_callback(lambda f: self._done(f, partition))
+
+    def _write(self, method, batch):
+        writer = self._writers.get()
+        retry_method = RETRY_METHODS.get(method, method)
+        if not hasattr(writer, retry_method):
+            retry_method = method
+        try:
+            parts = [batch]
+            while parts:
+                part = parts.pop()
+                attempt = 0
+                while True:
+                    ticket = self.controller.start()
+                    try:
+                        self._request(writer, method, part, ticket)
+                        break
+                    except Exception as e:
+                        if not self.controller.failed(ticket, e) or attempt >= self.controller.max_retries:
+                            raise
+                        delay = self.controller.backoff(attempt)
+                        LOG.warning("Retrying %d rows in %.2fs after %s: %s", len(part), delay, type(e).__name__, e)
+                        if self.metrics is not None:
+                            self.metrics.inc('retries_total', method=method)
+                        time.sleep(delay)
+                        attempt += 1
+                        method = retry_method
+                        pieces = self.controller.split(part)
+                        if len(pieces) > 1:
+                            # Retry as smaller requests, each with its own attempts
+                            parts.extend(reversed(pieces))
+                            break
+        finally:
+            self._writers.put(writer)
+
+    def _request(self, writer, method, batch, ticket):
+        start = time.time()
+        try:
+            getattr(writer, method)(batch)
+        except Exception as e:
+            if self.metrics is not None:
+                self.metrics.error(e, method=method)
+            raise
+        finally:
+            elapsed = time.time() - start
+            if self.metrics is not None:
+                self.metrics.observe('request_seconds', elapsed, method=method)
+        self.controller.succeeded(ticket, len(batch), elapsed)
+        if self.metrics is not None:
+            self.metrics.inc('rows_total', len(batch), phase='edges' if method.endswith('_edges') else 'vertices')
+
+    def _done(self, future, partition):
+        with self._cond:
+            self._running -= 1
+            if partition is not None:
+                self._pending[partition] -= 1
+                self._vertices_written()
+            if future.exception() is not None:
+                self._errors.append(future.exception())
+            self._cond.notify_all()
+
+    def _vertices_written(self):
+        # Called with the lock held; adds the time from sealing to the last vertex write to the vertex phase once
+        if self._sealed_at is not None and not any(self._pending):
+            if self.metrics is not None:
+                self.metrics.add_time('vertices', time.time() - self._sealed_at)
+            self._sealed_at = None
+
+    def _drain(self):
+        '''
+        Wait for every submitted batch to finish, so a phase's time includes its last requests.
+        '''
+        with self._cond:
+            while self._running:
+                self._cond.wait()
+
+    def _raise_errors(self):
+        with self._cond:
+            if self._errors:
+                raise self._errors[0]
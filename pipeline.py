@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+'''
+Fetch the WMATA network and load it into Neptune or Neo4j in one go, without going through the CSV files.
+
+wmata2csv.iter_graph() runs in a producer thread and hands its records to the loader through a bounded queue, while
+the loader (parallel_load.ParallelLoader, with the backend's writers) runs at the same time. Database writes overlap
+with the API requests, at most --queue-size records are ever waiting in between, and the whole run takes about as
+long as the slower of the two stages rather than both added up.
+
+  pipeline.py neptune -n $NEPTUNE:8182 -a $WMATA_KEY
+  pipeline.py neo4j -n localhost:7687 -u neo4j -p secret --offline
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import argparse
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import backends
+import metrics
+import neptune_csv
+import write_control
+import wmata2csv
+from parallel_load import ParallelLoader
+
+import logging
+logging.basicConfig()
+LOG = logging.getLogger('pipeline')
+LOG.setLevel(logging.INFO)
+
+# Queue items besides records: the vertices are over, everything is over
+END_OF_VERTICES = object()
+END = object()
+
+
+class RecordPipe(object):
+    '''
+    Run a tagged record stream (like wmata2csv.iter_graph()) in a producer thread and expose it as the two
+    iterables ParallelLoader.load() takes. The producer blocks once maxsize records are waiting.
+    :param records: iterable of (wmata2csv.VERTEX or wmata2csv.EDGE, record), all vertices first
+    :param maxsize: most records held between producer and consumer
+    '''
+    def __init__(self, records, maxsize=10000):
+        self.records = records
+        self.queue = queue.Queue(maxsize)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce, name='fetch')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _put(self, item):
+        # Give up if the consumer has gone away, rather than block forever on a full queue
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            in_vertices = True
+            for tag, record in self.records:
+                if in_vertices and tag == wmata2csv.EDGE:
+                    in_vertices = False
+                    if not self._put(END_OF_VERTICES):
+                        return
+                if not self._put(record):
+                    return
+            if in_vertices:
+                self._put(END_OF_VERTICES)
+            self._put(END)
+        except Exception as e:
+            # Hand the failure over to the consumer, which raises it in the loading thread
+            self._put(e)
+
+    def _take(self, until):
+        while True:
+            item = self.queue.get()
+            if item is until:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def vertices(self):
+        return self._take(END_OF_VERTICES)
+
+    def edges(self):
+        return self._take(END)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def typed_records(graph):
+    '''
+    Turn iter_graph()'s CSV style rows into the typed records the writers take (as read back from the CSVs).
+    '''
+    schemas = {wmata2csv.VERTEX: neptune_csv.Schema(wmata2csv.STATION_HEADERS),
+               wmata2csv.EDGE: neptune_csv.Schema(wmata2csv.SEGMENT_HEADERS)}
+    for tag, row in graph:
+        yield tag, schemas[tag].record(row)
+
+
+def run(args):
+    '''
+    Fetch and load concurrently.
+    :return: (vertices loaded, edges loaded)
+    '''
+    connection = backends.connect(args)
+    load_metrics = metrics.Metrics()
+    controller = write_control.controller_from_args(args, connection.is_transient, load_metrics)
+    client = wmata2csv.client_from_args(args)
+
+    pipe = RecordPipe(typed_records(wmata2csv.iter_graph(client)), maxsize=args.queue_size).start()
+    try:
+        with metrics.reporter_from_args(args, load_metrics, LOG):
+            loader = ParallelLoader(connection.open_writer, workers=args.workers, metrics=load_metrics,
+                                    controller=controller)
+            return loader.load(pipe.vertices(), pipe.edges())
+    finally:
+        pipe.close()
+        connection.close()
+
+
+def main():
+    args = parse_options()
+    n_vertices, n_edges = run(args)
+    print("Vertices: %s" % n_vertices)
+    print("Edges: %s" % n_edges)
+
+
+def parse_options():
+     parser = argparse.ArgumentParser(description='Fetch the WMATA network and load it straight into a graph database')
+     subparsers = parser.add_subparsers(dest='backend')
+     subparsers.required = True
+
+     def configure(sub, backend):
+         sub.add_argument('-b', '--batch-size', dest='batch_size', action="store", metavar="INT", type=int,
+                          default=backend.batch_size,
+                          help='Rows per write request to start with (default %d)' % backend.batch_size)
+         sub.add_argument('-w', '--workers', dest='workers', action="store", metavar="INT", type=int,
+                          default=4, help='Number of concurrent database connections (default 4)')
+         sub.add_argument('--queue-size', dest='queue_size', action="store", metavar="INT", type=int,
+                          default=10000, help='Most records waiting between fetcher and loader (default 10000)')
+         wmata2csv.add_fetch_options(sub, workers_option='--api_workers')
+         write_control.add_options(sub, max_batch_size=backend.max_batch_size)
+         metrics.add_options(sub)
+
+     backends.add_parsers(subparsers, 'Load into', configure)
+
+     args = parser.parse_args()
+     wmata2csv.check_fetch_options(parser, args)
+     return args
+
+if __name__ == '__main__':
+    main()
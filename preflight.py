@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+'''
+Check a pair of Neptune CSV files before loading them, and write clean copies plus a report of the rows left out.
+
+Otherwise the database is what finds the problems, one failed request at a time (Neptune), or not at all (Neo4j
+creates a second node for a duplicate id). Rows are rejected for:
+
+ * a missing ~id, or a missing ~from/~to on an edge
+ * more fields than the header has
+ * a value that is not of its column's type (the loaders would fail to parse it)
+ * an ~id seen earlier in the same file: the first row is kept, the report says whether the later one differs
+ * an edge whose ~from or ~to is not the ~id of a clean vertex
+
+Both files are streamed, twice each, so memory does not grow with the rows. The first pass collects a 64 bit hash of
+every id in an IdIndex: sorted arrays of hashes, bucketed by their top bits, so an id costs 8 bytes and a lookup is a
+binary search in one bucket. Equal hashes in the index mark the only ids that can be duplicates, and the second pass
+tells those apart exactly by keeping just them. An edge endpoint is looked up by its hash alone, so a dangling
+endpoint whose hash collides with a vertex's goes unnoticed, which with 64 bits is vanishingly unlikely.
+
+  preflight.py -v data/station-nodes.csv -e data/station-edges.csv -o clean/
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import argparse
+import array
+import bisect
+import collections
+import csv
+import os
+
+import neptune_bin
+import neptune_csv
+
+import logging
+logging.basicConfig()
+LOG = logging.getLogger('preflight')
+LOG.setLevel(logging.INFO)
+
+REJECT_HEADERS = ["file", "line", "id", "reason", "detail"]
+# Reject reasons
+MISSING_ID = 'missing-id'
+MISSING_ENDPOINT = 'missing-endpoint'
+EXTRA_FIELDS = 'extra-fields'
+BAD_VALUE = 'bad-value'
+DUPLICATE_ID = 'duplicate-id'
+DANGLING_FROM = 'dangling-from'
+DANGLING_TO = 'dangling-to'
+
+# Buckets are picked by the top BUCKET_BITS bits of the hash
+BUCKET_BITS = 8
+
+
+def id_hash(value):
+    # str's own 64 bit hash; it differs between processes, but an index only lives in the one that built it
+    return hash(value)
+
+
+class IdIndex(object):
+    '''
+    Compact set of id hashes: add() them all, freeze(), then test membership with `in`.
+    '''
+    def __init__(self):
+        self.buckets = [array.array('q') for _ in range(1 << BUCKET_BITS)]
+        self.collisions = set()
+        self.length = 0
+
+    def _bucket(self, hashed):
+        return self.buckets[(hashed >> (64 - BUCKET_BITS)) & ((1 << BUCKET_BITS) - 1)]
+
+    def add(self, value):
+        hashed = id_hash(value)
+        self._bucket(hashed).append(hashed)
+        self.length += 1
+
+    def freeze(self):
+        '''
+        Sort the buckets (one at a time, to keep the temporary lists small) and note the hashes added more than once.
+        '''
+        for i, bucket in enumerate(self.buckets):
+            bucket = self.buckets[i] = array.array('q', sorted(bucket))
+            for j in range(1, len(bucket)):
+                if bucket[j] == bucket[j - 1]:
+                    self.collisions.add(bucket[j])
+
+    def maybe_duplicate(self, value):
+        '''
+        :return: False if value was certainly added only once
+        '''
+        return id_hash(value) in self.collisions
+
+    def __contains__(self, value):
+        hashed = id_hash(value)
+        bucket = self._bucket(hashed)
+        i = bisect.bisect_left(bucket, hashed)
+        return i < len(bucket) and bucket[i] == hashed
+
+    def __len__(self):
+        return self.length
+
+
+class Table(object):
+    '''
+    One Neptune CSV file read row by row, with what is needed to check its rows.
+    :param path: CSV file
+    :param system_columns: the system columns every row must have a value for
+    '''
+    def __init__(self, path, system_columns):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path) as fh:
+            self.headers = next(csv.reader(fh, delimiter=',', quotechar='"'), None) or []
+        self.schema = neptune_csv.Schema(self.headers)
+        missing = [name for name in system_columns if name not in self.schema]
+        if missing:
+            raise ValueError("%s has no %s column" % (path, ', '.join(missing)))
+        self.required = [self.schema.by_name[name].index for name in system_columns]
+        self.id_index = self.schema.by_name['~id'].index
+        self.typed = [column for column in self.schema.columns if column.coerce is not None]
+
+    def row_id(self, fields):
+        return fields[self.id_index] if self.id_index < len(fields) else ''
+
+    def rows(self):
+        '''
+        :return: generator of (line number the row starts on, fields)
+        '''
+        with open(self.path) as fh:
+            reader = csv.reader(fh, delimiter=',', quotechar='"')
+            next(reader, None)
+            line = reader.line_num + 1
+            for fields in reader:
+                if fields:
+                    yield line, fields
+                line = reader.line_num + 1
+
+    def check(self, fields):
+        '''
+        Checks that only need the row itself.
+        :return: (reason, detail), or None if the row is fine
+        '''
+        n_fields = len(fields)
+        for index in self.required:
+            if index >= n_fields or fields[index] == '':
+                return (MISSING_ID if index == self.id_index else MISSING_ENDPOINT), self.headers[index]
+        if n_fields > len(self.headers):
+            return EXTRA_FIELDS, "%d fields, %d columns" % (n_fields, len(self.headers))
+        for column in self.typed:
+            if column.index < n_fields and fields[column.index] != '':
+                try:
+                    column.coerce(fields[column.index])
+                except ValueError:
+                    return BAD_VALUE, "%s %r" % (column.header, fields[column.index])
+        return None
+
+
+class Report(object):
+    '''
+    Writes the rejected rows to a CSV (if given a file) and counts them by file and reason.
+    '''
+    def __init__(self, out=None):
+        self.writer = None
+        if out is not None:
+            self.writer = csv.writer(out, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            self.writer.writerow(REJECT_HEADERS)
+        self.counts = collections.Counter()
+
+    def reject(self, table, line, row_id, reason, detail=''):
+        if self.writer is not None:
+            self.writer.writerow([table.name, line, row_id, reason, detail])
+        self.counts[table.name, reason] += 1
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def __str__(self):
+        return ', '.join("%s %s: %d" % (name, reason, n) for (name, reason), n in sorted(self.counts.items()))
+
+
+def index_ids(table, report):
+    '''
+    First pass: hash the id of every row that passes Table.check(), rejecting the others.
+    :return: (IdIndex, set of the lines rejected)
+    '''
+    index = IdIndex()
+    rejected = set()
+    for line, fields in table.rows():
+        problem = table.check(fields)
+        if problem is not None:
+            report.reject(table, line, table.row_id(fields), *problem)
+            rejected.add(line)
+            continue
+        index.add(table.row_id(fields))
+    index.freeze()
+    return index, rejected
+
+
+def clean_rows(table, index, rejected, report, vertices=None):
+    '''
+    Second pass: the rows that were not rejected in the first pass, less duplicate ids (and, for edges, dangling
+    endpoints).
+    :param vertices: IdIndex of the clean vertices, when table holds edges
+    :return: generator of fields
+    '''
+    from_index = to_index = None
+    if vertices is not None:
+        from_index = table.schema.by_name['~from'].index
+        to_index = table.schema.by_name['~to'].index
+
+    # For the few ids that may be duplicates: id -> (line, fields) of the first row kept
+    first = {}
+    for line, fields in table.rows():
+        if line in rejected:
+            continue
+        row_id = table.row_id(fields)
+        if vertices is not None:
+            if fields[from_index] not in vertices:
+                report.reject(table, line, row_id, DANGLING_FROM, fields[from_index])
+                continue
+            if fields[to_index] not in vertices:
+                report.reject(table, line, row_id, DANGLING_TO, fields[to_index])
+                continue
+        if index.maybe_duplicate(row_id):
+            if row_id in first:
+                first_line, first_fields = first[row_id]
+                report.reject(table, line, row_id, DUPLICATE_ID, "first on line %d%s" % (
+                    first_line, ', identical' if fields == first_fields else ', different values'))
+                continue
+            first[row_id] = line, fields
+        yield fields
+
+
+def validate(v_file, e_file, v_out=None, e_out=None, reject_out=None):
+    '''
+    Check both files, writing the rows that pass and a report of the others.
+    :param v_file: vertex CSV
+    :param e_file: edge CSV
+    :param v_out: file object the clean vertex CSV is written to, None to only check
+    :param e_out: file object the clean edge CSV is written to, None to only check
+    :param reject_out: file object the reject report (REJECT_HEADERS) is written to, None for none
+    :return: (clean vertices, clean edges, Report)
+    '''
+    report = Report(reject_out)
+    vertex_table = Table(v_file, ['~id'])
+    edge_table = Table(e_file, ['~id', '~from', '~to'])
+
+    vertex_index, rejected = index_ids(vertex_table, report)
+    clean = IdIndex()
+    n_vertices = 0
+    for fields in write_rows(v_out, vertex_table, clean_rows(vertex_table, vertex_index, rejected, report)):
+        clean.add(vertex_table.row_id(fields))
+        n_vertices += 1
+    clean.freeze()
+    # Only the clean vertices' hashes are needed from here on
+    del vertex_index
+    LOG.info("%d clean vertices", n_vertices)
+
+    edge_index, rejected = index_ids(edge_table, report)
+    n_edges = 0
+    for _ in write_rows(e_out, edge_table, clean_rows(edge_table, edge_index, rejected, report, clean)):
+        n_edges += 1
+    LOG.info("%d clean edges", n_edges)
+    return n_vertices, n_edges, report
+
+
+def write_rows(out, table, rows):
+    '''
+    Write the header and rows to out (if not None), passing the rows on.
+    '''
+    writer = None
+    if out is not None:
+        writer = csv.writer(out, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(table.headers)
+    for fields in rows:
+        if writer is not None:
+            writer.writerow(fields)
+        yield fields
+
+
+def main():
+    args = parse_options()
+    for path in (args.vertices, args.edges):
+        if neptune_bin.is_binary(path):
+            # Checked in the CSV they were converted from; the clean CSVs can be converted again
+            raise SystemExit("%s is a .cdx table; check the CSV it was made from" % path)
+
+    if args.out_dir:
+        if not os.path.isdir(args.out_dir):
+            os.makedirs(args.out_dir)
+        outputs = [os.path.join(args.out_dir, os.path.basename(path)) for path in (args.vertices, args.edges)]
+        for path, output in zip((args.vertices, args.edges), outputs):
+            if os.path.abspath(path) == os.path.abspath(output):
+                raise SystemExit("%s would overwrite its input" % output)
+        reject_path = args.rejects or os.path.join(args.out_dir, 'rejects.csv')
+    else:
+        outputs = [None, None]
+        reject_path = args.rejects
+
+    files = [open(path, mode='w', newline='') if path else None for path in outputs + [reject_path]]
+    try:
+        n_vertices, n_edges, report = validate(args.vertices, args.edges, *files)
+    finally:
+        for fh in files:
+            if fh is not None:
+                fh.close()
+
+    print("Vertices: %s" % n_vertices)
+    print("Edges: %s" % n_edges)
+    print("Rejected: %d%s" % (len(report), " (%s)" % report if len(report) else ''))
+    if reject_path and len(report):
+        print("Reject report: %s" % reject_path)
+    if args.strict and len(report):
+        raise SystemExit(1)
+
+
+def parse_options():
+     parser = argparse.ArgumentParser(description='Check Neptune CSVs for duplicate ids and dangling edges before loading')
+     parser.add_argument('-v', '--vertices', dest='vertices', action="store", metavar="FILE", required=True)
+     parser.add_argument('-e', '--edges', dest='edges', action="store", metavar="FILE", required=True)
+     parser.add_argument('-o', '--out-dir', dest='out_dir', action="store", metavar="DIR",
+                         help='Write the clean CSVs, under their own names, and rejects.csv to this directory')
+     parser.add_argument('-r', '--rejects', dest='rejects', action="store", metavar="FILE",
+                         help='Write the reject report here (default DIR/rejects.csv with -o, none without)')
+     parser.add_argument('--strict', dest='strict', action="store_true",
+                         help='Exit with status 1 if any row was rejected')
+     return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
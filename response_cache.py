@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+""" A small persistent cache for JSON API responses, used by wmata2csv.py.
+
+    Each response is stored as one file named by a hash of the endpoint and its parameters, alongside the validators
+    (ETag / Last-Modified) needed to revalidate it once its TTL has passed. When the directory grows beyond its size
+    limit the least recently used entries are removed.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('wmata2csv')
+
+
+class ResponseCache(object):
+    """ On-disk cache of JSON responses keyed by url and parameters.
+    """
+    def __init__(self, directory, ttl=86400, max_bytes=100 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.total_bytes = sum(os.path.getsize(path) for path in self._entry_paths())
+
+    def key(self, url, params=None):
+        # Sort the parameters so the same request always maps to the same file
+        raw = json.dumps([url, sorted((params or {}).items())])
+        return hashlib.sha1(raw.encode('utf8')).hexdigest()
+
+    def path(self, url, params=None):
+        return os.path.join(self.directory, self.key(url, params) + '.json')
+
+    def get(self, url, params=None):
+        """ Return the cached entry (a dict with "body", "fetched", "etag" and "last_modified") or None.
+        """
+        path = self.path(url, params)
+        try:
+            with open(path) as fh:
+                entry = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # Reads count as use for the LRU eviction. Another thread may have evicted the file since it was read, which
+        # leaves nothing to touch but does not make the entry wrong
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry["fetched"] < self.ttl
+
+    def put(self, url, params, body, etag=None, last_modified=None):
+        entry = {
+            "url": url,
+            "params": params,
+            "fetched": time.time(),
+            "etag": etag,
+            "last_modified": last_modified,
+            "body": body
+        }
+        self._write(self.path(url, params), entry)
+        return entry
+
+    def refresh(self, url, params, entry):
+        """ The server confirmed (304) that the entry is still current; restart its TTL.
+        """
+        entry["fetched"] = time.time()
+        self._write(self.path(url, params), entry)
+        return entry
+
+    def _write(self, path, entry):
+        # Write to a temp file and rename so a concurrent reader never sees a partial file
+        tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'w') as fh:
+            json.dump(entry, fh)
+        size = os.path.getsize(tmp_path)
+
+        with self.lock:
+            if os.path.exists(path):
+                self.total_bytes -= os.path.getsize(path)
+            os.replace(tmp_path, path)
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        by_age = sorted(self._entry_paths(), key=os.path.getmtime)
+        for path in by_age:
+            if self.total_bytes <= self.max_bytes:
+                break
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.total_bytes -= size
+            logger.debug("Evicted %s from the response cache" % path)
+
+    def _entry_paths(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.json')]
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+'''
+Precomputed all-pairs route table over the station graph.
+
+build() runs Dijkstra from every station and writes the n x n distance and next-hop matrices to a binary file.
+RouteTable maps that file into memory, so opening it is instant regardless of size and every process that opens the
+same file shares the pages instead of holding its own copy.
+
+The file also keeps the CSR graph it was built from. update() compares that against the current CSVs and only
+re-runs Dijkstra for the rows (source stations) whose shortest paths can be affected by the changed segments,
+copying the other rows from the old file. Either way the table is written to a temporary file that then replaces
+the old one, so a process that has the old file mapped keeps reading it unchanged (and an interrupted build leaves
+it intact) rather than seeing it truncated and rewritten underneath.
+
+Layout (every section 8 byte aligned; the header is little endian, the arrays after it are written and mapped in
+the native byte order, so a table is only readable on a machine of the same endianness as the one that built it):
+    header   magic, n vertices, m edges, byte length of the id table
+    ids      station ids, utf-8, newline separated
+    dist     n*n int64, -1 where unreachable
+    next     n*n int32, first station after the source on the shortest path, -1 where unreachable
+    offsets  n+1 int64 \\
+    targets  m int64     > the CSR graph (see station_graph.py)
+    weights  m int64    /
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import argparse
+import array
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from station_graph import StationGraph
+
+MAGIC = b'CDXRTBL1'
+HEADER = struct.Struct('<8sQQQ')
+UNREACHABLE = -1
+
+
+def pad8(length):
+    return (8 - length % 8) % 8
+
+
+def single_source(graph, s):
+    '''
+    Dijkstra from s over the whole graph.
+    :return: (dist, first_hop) arrays of length n
+    '''
+    n = len(graph)
+    offsets, targets, weights = graph.offsets, graph.targets, graph.weights
+    dist = array.array('q', [UNREACHABLE]) * n
+    first_hop = array.array('i', [UNREACHABLE]) * n
+    dist[s] = 0
+    first_hop[s] = s
+
+    heap = [(0, s)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        for edge in range(offsets[u], offsets[u + 1]):
+            v = targets[edge]
+            nd = d + weights[edge]
+            if dist[v] == UNREACHABLE or nd < dist[v]:
+                dist[v] = nd
+                # The first hop towards v is v itself when leaving the source, otherwise inherited from u
+                first_hop[v] = v if u == s else first_hop[u]
+                heapq.heappush(heap, (nd, v))
+    return dist, first_hop
+
+
+def build(graph, path):
+    '''
+    Compute all-pairs distances and next hops for graph and write them to path.
+    '''
+    write_table(path, graph, lambda s: single_source(graph, s))
+
+
+def write_table(path, graph, row):
+    '''
+    Write a table for graph to a temporary file and move it over path.
+    :param row: function of a source vertex number returning its (dist, first_hop) rows, as single_source() does
+    '''
+    n = len(graph)
+    id_blob = '\n'.join(graph.ids).encode('utf8')
+
+    # A unique name next to path, so concurrent builds or updates of the same table do not write into each other
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh, tempfile.TemporaryFile(dir=os.path.dirname(tmp_path)) as next_fh:
+            fh.write(HEADER.pack(MAGIC, n, graph.edge_count, len(id_blob)))
+            fh.write(id_blob + b'\0' * pad8(len(id_blob)))
+
+            # Rows are computed and written one at a time so building never holds more than one row in memory; the
+            # next hops are spooled to a side file and appended after the distances
+            for s in range(n):
+                dist, first_hop = row(s)
+                fh.write(dist)
+                next_fh.write(first_hop)
+            next_fh.seek(0)
+            shutil.copyfileobj(next_fh, fh)
+            fh.write(b'\0' * pad8(4 * n * n))
+
+            write_graph(fh, graph)
+        # mkstemp() creates the file readable by its owner only; give it the old table's mode, or a new file's
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_graph(fh, graph):
+    array.array('q', graph.offsets).tofile(fh)
+    array.array('q', graph.targets).tofile(fh)
+    array.array('q', graph.weights).tofile(fh)
+
+
+class RouteTable(object):
+    '''
+    Read access to a route table file through mmap. The matrices are memoryviews on the mapping, nothing is copied.
+    '''
+    def __init__(self, path):
+        self.fh = open(path, 'rb')
+        self.map = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n, m, id_len = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a route table" % path)
+        self.n, self.m = n, m
+
+        pos = HEADER.size
+        self.ids = bytes(self.map[pos:pos + id_len]).decode('utf8').split('\n') if n else []
+        self.index = dict((vertex_id, i) for i, vertex_id in enumerate(self.ids))
+        pos += id_len + pad8(id_len)
+
+        view = self._view = memoryview(self.map)
+        self.dist = view[pos:pos + 8 * n * n].cast('q')
+        pos += 8 * n * n
+        self.next = view[pos:pos + 4 * n * n].cast('i')
+        pos += 4 * n * n + pad8(4 * n * n)
+        self.graph_pos = pos
+        self.offsets = view[pos:pos + 8 * (n + 1)].cast('q')
+        pos += 8 * (n + 1)
+        self.targets = view[pos:pos + 8 * m].cast('q')
+        pos += 8 * m
+        self.weights = view[pos:pos + 8 * m].cast('q')
+
+    def close(self):
+        for view in (self.dist, self.next, self.offsets, self.targets, self.weights):
+            view.release()
+        self._view.release()
+        self.map.close()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def distance(self, source, target):
+        '''
+        :return: shortest distance from source to target, or None if unreachable
+        '''
+        d = self.dist[self.index[source] * self.n + self.index[target]]
+        return None if d == UNREACHABLE else d
+
+    def next_hop(self, source, target):
+        '''
+        :return: the station to go to next from source on the way to target, or None
+        '''
+        s, t = self.index[source], self.index[target]
+        hop = self.next[s * self.n + t]
+        return None if hop == UNREACHABLE or s == t else self.ids[hop]
+
+    def path(self, source, target):
+        '''
+        :return: list of station ids from source to target (empty if unreachable), following the next hops
+        '''
+        s, t = self.index[source], self.index[target]
+        if self.next[s * self.n + t] == UNREACHABLE:
+            return []
+        stations = [s]
+        while stations[-1] != t:
+            stations.append(self.next[stations[-1] * self.n + t])
+        return [self.ids[i] for i in stations]
+
+    def edge_weights(self):
+        '''
+        :return: dict of (source, target) vertex numbers -> lowest weight, for the graph the table was built from
+        '''
+        return edge_weights(self.offsets, self.targets, self.weights, self.n)
+
+
+def edge_weights(offsets, targets, weights, n):
+    result = {}
+    for u in range(n):
+        for edge in range(offsets[u], offsets[u + 1]):
+            key = (u, targets[edge])
+            if key not in result or weights[edge] < result[key]:
+                result[key] = weights[edge]
+    return result
+
+
+def affected_rows(table, old_edges, new_edges):
+    '''
+    Sources whose shortest paths may change. For a segment u->v that got shorter (or was added), source s is
+    affected if dist(s,u) + new weight < dist(s,v). For one that got longer (or was removed), s is affected if the
+    segment was tight, dist(s,u) + old weight == dist(s,v), i.e. it may be on one of s's shortest paths.
+    '''
+    n, dist = table.n, table.dist
+    rows = set()
+    for key in set(old_edges) | set(new_edges):
+        old_w, new_w = old_edges.get(key), new_edges.get(key)
+        if old_w == new_w:
+            continue
+        u, v = key
+        for s in range(n):
+            du, dv = dist[s * n + u], dist[s * n + v]
+            if du == UNREACHABLE:
+                continue
+            if new_w is not None and (old_w is None or new_w < old_w):
+                if dv == UNREACHABLE or du + new_w < dv:
+                    rows.add(s)
+            elif du + old_w == dv:
+                rows.add(s)
+    return rows
+
+
+def update(path, graph):
+    '''
+    Bring the table at path up to date with graph, recomputing only the affected rows. A change in the set of
+    stations changes the matrix dimensions, so that falls back to a full build().
+    :return: number of rows recomputed
+    '''
+    with RouteTable(path) as table:
+        if table.ids != list(graph.ids):
+            rows = None
+        else:
+            old_edges = table.edge_weights()
+            new_edges = edge_weights(graph.offsets, graph.targets, graph.weights, len(graph))
+            rows = affected_rows(table, old_edges, new_edges)
+
+            n = table.n
+
+            def row(s):
+                if s in rows:
+                    return single_source(graph, s)
+                return table.dist[s * n:(s + 1) * n], table.next[s * n:(s + 1) * n]
+
+            # Written before the old file is closed; os.replace() leaves its mapping alone
+            write_table(path, graph, row)
+
+    if rows is None:
+        build(graph, path)
+        return len(graph)
+    return len(rows)
+
+
+def main():
+    args = parse_options()
+
+    if args.vertices and args.edges:
+        graph = StationGraph.from_csv(args.vertices, args.edges)
+        if args.update and os.path.exists(args.table):
+            rows = update(args.table, graph)
+            print("Recomputed %d of %d rows in %s" % (rows, len(graph), args.table))
+        else:
+            build(graph, args.table)
+            print("Built %d x %d route table in %s" % (len(graph), len(graph), args.table))
+
+    if args.source and args.target:
+        with RouteTable(args.table) as table:
+            distance = table.distance(args.source, args.target)
+            if distance is None:
+                print("No route from %s to %s" % (args.source, args.target))
+            else:
+                print("Distance: %s" % distance)
+                print("Next hop: %s" % table.next_hop(args.source, args.target))
+                print(" -> ".join(table.path(args.source, args.target)))
+
+
+def parse_options():
+     parser = argparse.ArgumentParser(description='Build or query the all-pairs station route table')
+     parser.add_argument('-t', '--table', dest='table', action="store", metavar="FILE", required=True)
+     parser.add_argument('-v', '--vertices', dest='vertices', action="store", metavar="FILE",
+                         help='Build the table from these vertices (with --edges)')
+     parser.add_argument('-e', '--edges', dest='edges', action="store", metavar="FILE")
+     parser.add_argument('-u', '--update', dest='update', action="store_true",
+                         help='Recompute only the rows affected by changed segments')
+     parser.add_argument('--from', dest='source', action="store", metavar="STATION")
+     parser.add_argument('--to', dest='target', action="store", metavar="STATION")
+
+     return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+'''
+Spatial index over the `lat:double` / `lon:double` columns of station-nodes.csv.
+
+Stations are bucketed into a uniform lat/lon grid (cells stored CSR-style, like station_graph.py). Queries take whole
+NumPy arrays of points: the points are grouped by grid cell and each group is answered with one vectorized haversine
+over the stations in the surrounding cells, so a batch of hundreds of thousands of GPS pings costs one Python
+iteration per occupied cell rather than per point.
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import argparse
+import math
+import sys
+
+import numpy as np
+
+import neptune_csv
+
+EARTH_RADIUS_M = 6371008.8
+# Metres per degree of latitude; a degree of longitude is this times cos(latitude)
+M_PER_DEG = math.pi * EARTH_RADIUS_M / 180.0
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    '''
+    Vectorized great-circle distance in metres; the arguments broadcast against each other.
+    '''
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class SpatialIndex(object):
+    '''
+    Uniform grid over station coordinates.
+    :param ids: station ids
+    :param lats: station latitudes (degrees)
+    :param lons: station longitudes (degrees)
+    :param cell_deg: grid cell size in degrees; by default about four stations per occupied cell
+    '''
+    def __init__(self, ids, lats, lons, cell_deg=None):
+        self.ids = list(ids)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        n = len(self.ids)
+
+        self.lat0 = self.lats.min() if n else 0.0
+        self.lon0 = self.lons.min() if n else 0.0
+        if cell_deg is None:
+            extent = max(np.ptp(self.lats) if n else 0.0, np.ptp(self.lons) if n else 0.0, 1e-6)
+            cell_deg = extent / max(1.0, math.sqrt(n / 4.0))
+        self.cell_deg = cell_deg
+
+        cx, cy = self._cells(self.lats, self.lons)
+        self.nx = int(cx.max()) + 1 if n else 1
+        self.ny = int(cy.max()) + 1 if n else 1
+
+        # Stations sorted by cell, with offsets into that order per cell
+        keys = cx * self.ny + cy
+        self.order = np.argsort(keys, kind='stable')
+        self.offsets = np.searchsorted(keys[self.order], np.arange(self.nx * self.ny + 1))
+
+        # Smallest ground distance one cell spans anywhere in the grid, for deciding when a ring search can stop
+        max_lat = np.abs(self.lats).max() if n else 0.0
+        self.cell_m = cell_deg * M_PER_DEG * max(math.cos(math.radians(min(max_lat + cell_deg, 89.9))), 1e-6)
+
+    @classmethod
+    def from_csv(cls, v_file, cell_deg=None):
+        '''
+        Build from a vertex CSV with `lat` and `lon` columns; stations without coordinates are skipped.
+        '''
+        ids, lats, lons = [], [], []
+        for batch in neptune_csv.read_batches(v_file):
+            lat_col = batch.schema.by_name['lat'].index
+            lon_col = batch.schema.by_name['lon'].index
+            batch_lats = np.frombuffer(batch.column('lat'), dtype=np.float64)
+            batch_lons = np.frombuffer(batch.column('lon'), dtype=np.float64)
+            keep = np.ones(len(batch), dtype=bool)
+            for row in range(len(batch)):
+                if batch.is_missing(lat_col, row) or batch.is_missing(lon_col, row):
+                    keep[row] = False
+            ids.extend(vertex_id for vertex_id, k in zip(batch.column('~id'), keep) if k)
+            lats.append(batch_lats[keep])
+            lons.append(batch_lons[keep])
+        return cls(ids, np.concatenate(lats) if lats else [], np.concatenate(lons) if lons else [], cell_deg)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cells(self, lats, lons):
+        cx = np.floor((lats - self.lat0) / self.cell_deg).astype(np.int64)
+        cy = np.floor((lons - self.lon0) / self.cell_deg).astype(np.int64)
+        return cx, cy
+
+    def _stations_in(self, cx, cy, ring):
+        '''
+        Station numbers in the (2*ring+1)^2 block of cells around (cx, cy).
+        '''
+        x0, x1 = max(cx - ring, 0), min(cx + ring, self.nx - 1)
+        y0, y1 = max(cy - ring, 0), min(cy + ring, self.ny - 1)
+        if x0 > x1 or y0 > y1:
+            return np.empty(0, dtype=np.int64)
+        chunks = []
+        for x in range(x0, x1 + 1):
+            start = self.offsets[x * self.ny + y0]
+            end = self.offsets[x * self.ny + y1 + 1]
+            if end > start:
+                chunks.append(self.order[start:end])
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+
+    def _groups(self, lats, lons):
+        '''
+        Group query points by grid cell (clamped into the grid, so far-away points still find their nearest cells).
+        :return: generator of (cx, cy, point numbers)
+        '''
+        cx, cy = self._cells(lats, lons)
+        cx = np.clip(cx, 0, self.nx - 1)
+        cy = np.clip(cy, 0, self.ny - 1)
+        keys = cx * self.ny + cy
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        bounds = np.flatnonzero(np.diff(sorted_keys)) + 1
+        for points in np.split(order, bounds):
+            if len(points):
+                key = int(keys[points[0]])
+                yield key // self.ny, key % self.ny, points
+
+    def _ring_outside(self, lats, lons, cx, cy, ring):
+        '''
+        Smallest distance (metres) from any of the points to the outside of the searched block of cells; stations
+        further than this may not have been looked at yet.
+        '''
+        lat_lo = self.lat0 + (cx - ring) * self.cell_deg
+        lat_hi = self.lat0 + (cx + ring + 1) * self.cell_deg
+        lon_lo = self.lon0 + (cy - ring) * self.cell_deg
+        lon_hi = self.lon0 + (cy + ring + 1) * self.cell_deg
+        deg = np.minimum.reduce([lats - lat_lo, lat_hi - lats, lons - lon_lo, lon_hi - lons])
+        return max(float(deg.min()), 0.0) * self.cell_m / self.cell_deg
+
+    def nearest(self, lats, lons, k=1):
+        '''
+        k nearest stations for every point.
+        :param lats: array of point latitudes
+        :param lons: array of point longitudes
+        :return: (indices, distances), both shaped (points, k) and sorted by distance; indices are positions in
+                 self.ids. If there are fewer than k stations the extra columns are -1 / inf.
+        '''
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        indices = np.full((len(lats), k), -1, dtype=np.int64)
+        distances = np.full((len(lats), k), np.inf)
+        if not len(self.ids) or not len(lats):
+            return indices, distances
+
+        kk = min(k, len(self.ids))
+        max_ring = max(self.nx, self.ny)
+        for cx, cy, points in self._groups(lats, lons):
+            plat, plon = lats[points], lons[points]
+            ring = 0
+            while True:
+                candidates = self._stations_in(cx, cy, ring)
+                if len(candidates) >= kk:
+                    d = haversine_m(plat[:, None], plon[:, None], self.lats[candidates], self.lons[candidates])
+                    part = np.argpartition(d, kk - 1, axis=1)[:, :kk]
+                    part_d = np.take_along_axis(d, part, axis=1)
+                    # Done once every point's k-th candidate is closer than anything outside the searched block
+                    if ring >= max_ring or part_d.max() <= self._ring_outside(plat, plon, cx, cy, ring):
+                        break
+                ring += 1
+
+            rank = np.argsort(part_d, axis=1)
+            indices[points, :kk] = candidates[np.take_along_axis(part, rank, axis=1)]
+            distances[points, :kk] = np.take_along_axis(part_d, rank, axis=1)
+        return indices, distances
+
+    def within(self, lats, lons, radius_m):
+        '''
+        Every (point, station) pair closer than radius_m.
+        :return: (point numbers, station indices, distances) as flat, parallel arrays
+        '''
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        found_points, found_stations, found_distances = [], [], []
+        if len(self.ids) and len(lats):
+            ring = int(math.ceil(radius_m / self.cell_m))
+            for cx, cy, points in self._groups(lats, lons):
+                candidates = self._stations_in(cx, cy, ring + 1)
+                if not len(candidates):
+                    continue
+                d = haversine_m(lats[points][:, None], lons[points][:, None],
+                                self.lats[candidates], self.lons[candidates])
+                p, c = np.nonzero(d <= radius_m)
+                found_points.append(points[p])
+                found_stations.append(candidates[c])
+                found_distances.append(d[p, c])
+
+        if not found_points:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        return np.concatenate(found_points), np.concatenate(found_stations), np.concatenate(found_distances)
+
+
+def main():
+    args = parse_options()
+    index = SpatialIndex.from_csv(args.vertices)
+
+    # Points file: lat,lon per line, optional header
+    points = np.genfromtxt(args.points, delimiter=',', dtype=np.float64, usecols=(0, 1), ndmin=2)
+    points = points[~np.isnan(points).any(axis=1)]
+    lats, lons = points[:, 0], points[:, 1]
+
+    out = sys.stdout
+    if args.radius is not None:
+        p, s, d = index.within(lats, lons, args.radius)
+        out.write("lat,lon,station,distance_m\n")
+        for i, j, dist in zip(p, s, d):
+            out.write('%s,%s,"%s",%.1f\n' % (lats[i], lons[i], index.ids[j], dist))
+    else:
+        indices, distances = index.nearest(lats, lons, args.k)
+        out.write("lat,lon,rank,station,distance_m\n")
+        for i in range(len(lats)):
+            for rank in range(args.k):
+                if indices[i, rank] >= 0:
+                    out.write('%s,%s,%d,"%s",%.1f\n' % (lats[i], lons[i], rank + 1,
+                                                         index.ids[indices[i, rank]], distances[i, rank]))
+
+
+def parse_options():
+     parser = argparse.ArgumentParser(description='Nearest stations for a file of lat,lon points')
+     parser.add_argument('-v', '--vertices', dest='vertices', action="store", metavar="FILE", required=True)
+     parser.add_argument('-p', '--points', dest='points', action="store", metavar="FILE", required=True,
+                         help='CSV of lat,lon points')
+     parser.add_argument('-k', dest='k', action="store", metavar="INT", type=int, default=1,
+                         help='Number of nearest stations per point (default 1)')
+     parser.add_argument('-r', '--radius', dest='radius', action="store", metavar="METRES", type=float,
+                         help='List every station within this many metres instead')
+
+     return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
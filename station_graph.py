@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+'''
+In-process graph over the station CSVs, for routing questions that should not need a round trip to Neptune/Neo4j.
+
+Station ids are interned to integers and the edges are stored CSR-style: for vertex i its outgoing edges are
+targets[offsets[i]:offsets[i+1]] with the matching weights (the `distance:int` column, in feet for the WMATA data).
+Everything lives in array.array, so a graph with millions of edges costs a few bytes per edge.
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import argparse
+import array
+import heapq
+import math
+
+import neptune_csv
+
+# Mean earth radius in feet, to compare great-circle distances with the WMATA track distances
+EARTH_RADIUS_FT = 20902231.0
+
+
+def haversine_ft(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_FT * math.asin(math.sqrt(a))
+
+
+class StationGraph(object):
+    '''
+    Compressed sparse row graph of stations and weighted segments.
+    '''
+    def __init__(self, ids, lats, lons, offsets, targets, weights):
+        self.ids = ids
+        self.index = dict((vertex_id, i) for i, vertex_id in enumerate(ids))
+        self.lats = lats
+        self.lons = lons
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+        self._heuristic_scale = None
+
+    @classmethod
+    def from_csv(cls, v_file, e_file, weight='distance'):
+        '''
+        :param v_file: vertex CSV (`~id`, optional `lat`/`lon` columns)
+        :param e_file: edge CSV (`~from`, `~to` and the weight column)
+        :param weight: name of the integer edge property used as the weight; missing values count as 0
+        '''
+        ids = []
+        index = {}
+        lats = array.array('d')
+        lons = array.array('d')
+
+        def intern(vertex_id):
+            i = index.get(vertex_id)
+            if i is None:
+                i = index[vertex_id] = len(ids)
+                ids.append(vertex_id)
+                lats.append(float('nan'))
+                lons.append(float('nan'))
+            return i
+
+        for batch in neptune_csv.read_batches(v_file):
+            has_coords = 'lat' in batch.schema and 'lon' in batch.schema
+            for row, vertex_id in enumerate(batch.column('~id')):
+                i = intern(vertex_id)
+                if has_coords and not batch.is_missing(batch.schema.by_name['lat'].index, row):
+                    lats[i] = batch.column('lat')[row]
+                    lons[i] = batch.column('lon')[row]
+
+        sources = array.array('l')
+        targets = array.array('l')
+        weights = array.array('q')
+        for batch in neptune_csv.read_batches(e_file):
+            has_weight = weight in batch.schema
+            for row in range(len(batch)):
+                sources.append(intern(batch.column('~from')[row]))
+                targets.append(intern(batch.column('~to')[row]))
+                weights.append(batch.column(weight)[row] if has_weight else 0)
+
+        return cls.from_edges(ids, lats, lons, sources, targets, weights)
+
+    @classmethod
+    def from_edges(cls, ids, lats, lons, sources, targets, weights):
+        '''
+        Build the CSR arrays from parallel source/target/weight arrays with a counting sort on the source.
+        '''
+        n = len(ids)
+        offsets = array.array('l', [0] * (n + 1))
+        for s in sources:
+            offsets[s + 1] += 1
+        for i in range(n):
+            offsets[i + 1] += offsets[i]
+
+        fill = array.array('l', offsets[:n])
+        csr_targets = array.array('l', [0] * len(sources))
+        csr_weights = array.array('q', [0] * len(sources))
+        for s, t, w in zip(sources, targets, weights):
+            csr_targets[fill[s]] = t
+            csr_weights[fill[s]] = w
+            fill[s] += 1
+
+        return cls(ids, lats, lons, offsets, csr_targets, csr_weights)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def edge_count(self):
+        return len(self.targets)
+
+    def neighbors(self, i):
+        '''
+        :param i: interned vertex number
+        :return: list of (target vertex number, weight)
+        '''
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return list(zip(self.targets[start:end], self.weights[start:end]))
+
+    def shortest_path(self, source, target):
+        '''
+        Dijkstra from source to target.
+        :param source: station id
+        :param target: station id
+        :return: (distance, [station ids]) or (None, []) if target is unreachable
+        '''
+        return self._search(source, target, None)
+
+    def astar(self, source, target):
+        '''
+        A* from source to target, guided by the great-circle distance to the target. The distance is scaled down by
+        heuristic_scale() so it never overestimates, which keeps the result identical to shortest_path() while
+        expanding fewer vertices. Falls back to Dijkstra for stations without coordinates.
+        :return: (distance, [station ids]) or (None, [])
+        '''
+        t = self.index[target]
+        lat_t, lon_t = self.lats[t], self.lons[t]
+        scale = self.heuristic_scale()
+        if math.isnan(lat_t) or not scale:
+            return self._search(source, target, None)
+
+        lats, lons = self.lats, self.lons
+
+        def heuristic(i):
+            if math.isnan(lats[i]):
+                return 0.0
+            return scale * haversine_ft(lats[i], lons[i], lat_t, lon_t)
+
+        return self._search(source, target, heuristic)
+
+    def heuristic_scale(self):
+        '''
+        Largest factor (at most 1) such that factor * great-circle distance <= weight for every edge. Station names
+        that cover several platforms share one coordinate, so some segments are "shorter" than the straight line
+        between their stations; scaling keeps the A* heuristic admissible and consistent anyway.
+        '''
+        if self._heuristic_scale is None:
+            scale = 1.0
+            lats, lons = self.lats, self.lons
+            for u in range(len(self.ids)):
+                if math.isnan(lats[u]):
+                    continue
+                for edge in range(self.offsets[u], self.offsets[u + 1]):
+                    v = self.targets[edge]
+                    if math.isnan(lats[v]):
+                        continue
+                    straight = haversine_ft(lats[u], lons[u], lats[v], lons[v])
+                    if straight > self.weights[edge]:
+                        scale = min(scale, self.weights[edge] / straight)
+            self._heuristic_scale = scale
+        return self._heuristic_scale
+
+    def _search(self, source, target, heuristic):
+        s = self.index[source]
+        t = self.index[target]
+        offsets, targets, weights = self.offsets, self.targets, self.weights
+
+        dist = {s: 0}
+        prev = {}
+        done = set()
+        heap = [(heuristic(s) if heuristic else 0, 0, s)]
+        while heap:
+            _, d, u = heapq.heappop(heap)
+            if u in done:
+                continue
+            if u == t:
+                break
+            done.add(u)
+            for edge in range(offsets[u], offsets[u + 1]):
+                v = targets[edge]
+                nd = d + weights[edge]
+                if nd < dist.get(v, nd + 1):
+                    dist[v] = nd
+                    prev[v] = u
+                    heapq.heappush(heap, (nd + (heuristic(v) if heuristic else 0), nd, v))
+
+        if t not in dist:
+            return None, []
+        path = [t]
+        while path[-1] != s:
+            path.append(prev[path[-1]])
+        return dist[t], [self.ids[i] for i in reversed(path)]
+
+    def k_hop(self, source, k):
+        '''
+        Stations within k hops of source (breadth first, ignoring weights).
+        :return: dict of station id -> number of hops
+        '''
+        s = self.index[source]
+        offsets, targets = self.offsets, self.targets
+        hops = {s: 0}
+        frontier = [s]
+        for depth in range(1, k + 1):
+            next_frontier = []
+            for u in frontier:
+                for v in targets[offsets[u]:offsets[u + 1]]:
+                    if v not in hops:
+                        hops[v] = depth
+                        next_frontier.append(v)
+            frontier = next_frontier
+        return dict((self.ids[i], depth) for i, depth in hops.items())
+
+
+def main():
+    args = parse_options()
+    graph = StationGraph.from_csv(args.vertices, args.edges)
+    print("Vertices: %s" % len(graph))
+    print("Edges: %s" % graph.edge_count)
+
+    if args.source and args.target:
+        distance, path = graph.astar(args.source, args.target)
+        if distance is None:
+            print("No route from %s to %s" % (args.source, args.target))
+        else:
+            print("Distance: %s" % distance)
+            print(" -> ".join(path))
+
+    if args.source and args.hops is not None:
+        for station, depth in sorted(graph.k_hop(args.source, args.hops).items(), key=lambda item: (item[1], item[0])):
+            print("%d %s" % (depth, station))
+
+
+def parse_options():
+     parser = argparse.ArgumentParser(description='Shortest paths and neighbourhoods over the station CSVs')
+     parser.add_argument('-v', '--vertices', dest='vertices', action="store", metavar="FILE", required=True)
+     parser.add_argument('-e', '--edges', dest='edges', action="store", metavar="FILE", required=True)
+     parser.add_argument('-f', '--from', dest='source', action="store", metavar="STATION")
+     parser.add_argument('-t', '--to', dest='target', action="store", metavar="STATION")
+     parser.add_argument('-k', '--hops', dest='hops', action="store", metavar="INT", type=int,
+                         help='List the stations within this many hops of --from')
+
+     return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
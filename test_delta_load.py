@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+Tests for delta_load.py. Run with `python -m unittest` (or pytest) from this directory.
+'''
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from gremlin_python.structure.graph import Graph
+
+import bench
+import csv2neo4j
+import csv2neptune
+import delta_load
+from parallel_load import ParallelLoader
+
+
+class GraphSink(object):
+    '''
+    In-memory graph shared by the writers, with the semantics of the real statements: write_* creates (a second
+    edge with the same id is a duplicate, as CREATE makes it), upsert_* replaces by id (as MERGE does).
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.vertices = {}
+        self.edges = []
+
+    def writer(self):
+        return SinkWriter(self)
+
+
+class SinkWriter(object):
+    def __init__(self, sink):
+        self.sink = sink
+
+    def write_vertices(self, batch):
+        with self.sink.lock:
+            for row in batch:
+                self.sink.vertices[row["~id"]] = dict(row)
+
+    upsert_vertices = write_vertices
+
+    def write_edges(self, batch):
+        with self.sink.lock:
+            self.sink.edges.extend(dict(row) for row in batch)
+
+    def upsert_edges(self, batch):
+        with self.sink.lock:
+            for row in batch:
+                self.sink.edges = [edge for edge in self.sink.edges if edge["~id"] != row["~id"]] + [dict(row)]
+
+    def delete_vertices(self, ids):
+        with self.sink.lock:
+            for vertex_id in ids:
+                self.sink.vertices.pop(vertex_id, None)
+
+    def delete_edges(self, edges):
+        ids = set(edge_id for edge_id, from_id, to_id in edges)
+        with self.sink.lock:
+            self.sink.edges = [edge for edge in self.sink.edges if edge["~id"] not in ids]
+
+    def close(self):
+        pass
+
+
+class RecordingSession(bench.FakeNeo4jSession):
+    def __init__(self, statements):
+        bench.FakeNeo4jSession.__init__(self, bench.Recorder())
+        self.statements = statements
+
+    def run(self, cql, rows=None, **params):
+        self.statements.append(cql)
+        return bench.FakeNeo4jSession.run(self, cql, rows, **params)
+
+
+class DeltaLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.v_file, self.e_file = bench.generate(self.dir, 200, 50)
+        self.snapshot = os.path.join(self.dir, 'snapshot.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_first_delta_against_loaded_graph_adds_no_duplicates(self):
+        sink = GraphSink()
+        loader = ParallelLoader(sink.writer, workers=2, batch_size=16)
+        loader.load(delta_load.neptune_csv.iter_records(self.v_file), delta_load.neptune_csv.iter_records(self.e_file))
+        self.assertEqual(len(sink.edges), 200)
+
+        # No snapshot yet: every row counts as new
+        delta = delta_load.load_delta(sink.writer, self.v_file, self.e_file, self.snapshot, workers=2, batch_size=16)
+        self.assertEqual(len(delta.edge_inserts), 200)
+        self.assertEqual(len(sink.edges), 200)
+        self.assertEqual(len(set(edge["~id"] for edge in sink.edges)), 200)
+        self.assertEqual(len(sink.vertices), 50)
+
+        # With the snapshot nothing is sent again
+        delta = delta_load.load_delta(sink.writer, self.v_file, self.e_file, self.snapshot, workers=2, batch_size=16)
+        self.assertEqual((len(delta.vertex_upserts), len(delta.edge_inserts)), (0, 0))
+        self.assertEqual(len(sink.edges), 200)
+
+    def test_snapshot_of_imported_csvs_leaves_nothing_to_send(self):
+        delta_load.save_snapshot(self.snapshot, delta_load.build_snapshot(self.v_file, self.e_file))
+        delta = delta_load.compute_delta(self.v_file, self.e_file, delta_load.load_snapshot(self.snapshot))
+        self.assertEqual(str(delta), "0 vertex upserts, 0 vertex deletes, 0 edge inserts, 0 edge deletes")
+
+    def test_neo4j_upsert_edges_merges(self):
+        statements = []
+        writer = csv2neo4j.Neo4jWriter(bench.FakeNeo4jDriver(None))
+        writer.session = RecordingSession(statements)
+        writer.upsert_edges([{"~id": "1", "~from": "a", "~to": "b", "~label": "SEGMENT", "distance": 3}])
+        self.assertEqual(statements, [csv2neo4j.CQL_MERGE_EDGES])
+        self.assertIn("MERGE (a)-[r:SEGMENT {id: row.props.id}]->(b)", csv2neo4j.CQL_MERGE_EDGES)
+
+    def test_neptune_upsert_edges_reuses_existing_edge(self):
+        g = Graph().traversal()
+        steps = csv2neptune.edge_upsert_traversal(g, [
+            {"~id": "1", "~from": "a", "~to": "b", "~label": "SEGMENT", "distance": 3},
+            {"~id": "2", "~from": "b", "~to": "a", "~label": "SEGMENT", "distance": 3},
+        ]).bytecode.step_instructions
+        self.assertEqual([step[0] for step in steps].count('V'), 2)
+        self.assertEqual([step[0] for step in steps].count('coalesce'), 2)
+        # Every edge is only added if it is not already there
+        self.assertNotIn('addE', [step[0] for step in steps])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+'''
+Tests for graph_export.py. Run with `python -m unittest` (or pytest) from this directory.
+'''
+import bisect
+import csv
+import io
+import unittest
+
+import graph_export
+import write_control
+
+
+class Timeout(Exception):
+    pass
+
+
+class RangeReader(object):
+    '''
+    Reader that does not page, over an in-memory graph. Like a server with a request timeout, it fails any request
+    that would read more than `capacity` vertices.
+    '''
+    pages = False
+
+    def __init__(self, vertices, edges, capacity):
+        self.vertices = sorted(vertices)
+        self.ids = [vertex[0] for vertex in self.vertices]
+        self.edges = edges
+        self.capacity = capacity
+        self.requests = []
+
+    def _range(self, after, upper):
+        lo = bisect.bisect_right(self.ids, after) if after is not None else 0
+        hi = bisect.bisect_right(self.ids, upper) if upper is not None else len(self.ids)
+        return self.vertices[lo:hi]
+
+    def sample_ids(self, n, after=None, upper=None):
+        self.requests.append(('sample_ids', after, upper, n))
+        return [vertex[0] for vertex in self._range(after, upper)][:n]
+
+    def vertex_range(self, after, upper, limit):
+        vertices = self._range(after, upper)
+        self.requests.append(('vertex_range', after, upper, limit))
+        if len(vertices) > self.capacity:
+            raise Timeout("%d vertices" % len(vertices))
+        return list(reversed(vertices))[:None if limit is None else limit + 1]
+
+    def edge_range(self, after, upper, limit):
+        ids = set(vertex[0] for vertex in self._range(after, upper))
+        self.requests.append(('edge_range', after, upper, limit))
+        edges = [edge for edge in self.edges if edge[2] in ids]
+        return edges[:None if limit is None else limit + 1]
+
+    def close(self):
+        pass
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.vertices = [("id_v%02d" % i, "Station", {"name": ["V%d" % i]}) for i in range(60)]
+        # v07 is a hub with more edges than fit in a page
+        self.edges = [("id_e%03d" % i, "SEGMENT", "id_v%02d" % (i % 60), "id_v%02d" % ((i + 1) % 60), {"d": 1})
+                      for i in range(60)]
+        self.edges += [("id_h%03d" % i, "SEGMENT", "id_v07", "id_v%02d" % i, {"d": 2}) for i in range(30)]
+
+    def export(self, reader, page_size, partitions=2):
+        controller = write_control.WriteController(page_size, inflight=2, max_retries=2, backoff_base=0.001,
+                                                   adaptive=False, is_transient=lambda e: isinstance(e, Timeout))
+        exporter = graph_export.GraphExporter(lambda: reader, workers=2, controller=controller)
+        v_out, e_out = io.StringIO(), io.StringIO()
+        counts = exporter.export(v_out, e_out, partitions=partitions)
+        return counts, [list(csv.reader(io.StringIO(out.getvalue()))) for out in (v_out, e_out)]
+
+    def test_ranges_are_cut_until_they_fit(self):
+        reader = RangeReader(self.vertices, self.edges, capacity=12)
+        (n_vertices, n_edges), (vertex_rows, edge_rows) = self.export(reader, 10)
+        self.assertEqual((n_vertices, n_edges), (60, 90))
+        self.assertEqual(sorted(row[0] for row in vertex_rows[1:]), ["v%02d" % i for i in range(60)])
+        self.assertEqual(sorted(row[0] for row in edge_rows[1:]), sorted(edge[0][3:] for edge in self.edges))
+        # Every answered request was at most a page, but for the hub's edges, which cannot be cut
+        unbounded = [request for request in reader.requests if request[3] is None]
+        self.assertEqual(unbounded, [('edge_range', 'id_v06', 'id_v07', None)])
+
+    def test_sample_is_bounded(self):
+        reader = RangeReader(self.vertices, self.edges, capacity=100)
+        (n_vertices, n_edges), _ = self.export(reader, 1000, partitions=100000)
+        self.assertEqual((n_vertices, n_edges), (60, 90))
+        self.assertEqual(reader.requests[0], ('sample_ids', None, None, graph_export.MAX_SAMPLE))
+
+    def test_halve(self):
+        self.assertEqual(graph_export.halve(None, 'c', ['a', 'b', 'c']), [(None, 'b'), ('b', 'c')])
+        self.assertEqual(graph_export.halve('a', 'c', ['a', 'c', 'b', 'b']), [('a', 'b'), ('b', 'c')])
+        self.assertIsNone(graph_export.halve('a', 'c', ['c']))
+        self.assertIsNone(graph_export.halve('a', 'c', []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+'''
+Tests for parallel_csv.py (and the .cdx tables of neptune_bin.py). Run with `python -m unittest` (or pytest) from
+this directory.
+'''
+import csv
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import neptune_bin
+import neptune_csv
+import parallel_csv
+
+HEADERS = ["~id", "~from", "~to", "~label", "name:string", "note:string", "distance:int", "weight:double",
+           "open:bool"]
+CHUNK_SIZES = (1000, 4096, 77777)
+
+
+def awkward_text(rng):
+    '''
+    A string value with the characters that make splitting a CSV hard: commas, quotes and newlines.
+    '''
+    pieces = ['plain', 'a,b', 'say ""hi""', 'two\nlines', '"', '\n', ',', 'Ümlaut', 'end\n\nof para', ' ']
+    return ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 6)))
+
+
+def write_edges(path, n_rows, seed=7):
+    rng = random.Random(seed)
+    out = io.StringIO()
+    writer = csv.writer(out, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+    writer.writerow(HEADERS)
+    for i in range(n_rows):
+        writer.writerow([
+            "e%d" % i, "v%d" % rng.randrange(50), "v%d" % rng.randrange(50), "SEGMENT",
+            awkward_text(rng), awkward_text(rng) if rng.random() < 0.7 else '',
+            rng.randint(-2 ** 40, 2 ** 40) if rng.random() < 0.8 else '',
+            round(rng.uniform(0, 100), 3),
+            rng.choice(['true', 'false', '1', '0', '']),
+        ])
+    # No newline after the last record
+    with open(path, 'w', newline='') as fh:
+        fh.write(out.getvalue().rstrip('\n'))
+
+
+class ParallelCsvTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'edges.csv')
+        write_edges(self.path, 2000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def serial(self):
+        return list(neptune_csv.iter_records(self.path))
+
+    def parallel(self, chunk_bytes):
+        return [record for batch in parallel_csv.read_batches(self.path, 64, workers=2, chunk_bytes=chunk_bytes)
+                for record in batch.records()]
+
+    def test_quoted_newlines_straddle_a_chunk_boundary(self):
+        with open(self.path, 'rb') as fh:
+            data = fh.read()
+        data_start = data.index(b'\n') + 1
+        # The biggest chunk size cuts the file only once, so that cut may fall anywhere
+        for chunk_bytes in CHUNK_SIZES[:-1]:
+            # Some raw cut lands inside a quoted field, so the boundary has to be moved past it
+            inside = [pos for pos in range(data_start + chunk_bytes, len(data), chunk_bytes)
+                      if data.count(b'"', 0, pos) & 1]
+            self.assertTrue(inside, chunk_bytes)
+
+    def test_matches_serial_reader(self):
+        expected = self.serial()
+        self.assertEqual(len(expected), 2000)
+        self.assertTrue(any('\n' in record.get('name', '') for record in expected))
+        for chunk_bytes in CHUNK_SIZES:
+            self.assertEqual(self.parallel(chunk_bytes), expected, chunk_bytes)
+
+    def test_split_covers_the_file_on_record_boundaries(self):
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as fh:
+            data = fh.read()
+        for chunk_bytes in CHUNK_SIZES:
+            with parallel_csv.ProcessPoolExecutor(max_workers=1) as executor:
+                headers, chunks = parallel_csv.split(self.path, executor, chunk_bytes)
+            self.assertEqual(headers, HEADERS)
+            self.assertEqual(chunks[-1][1], size)
+            for (_, end), (start, _) in zip(chunks[:-1], chunks[1:]):
+                self.assertEqual(end, start)
+                # Every cut is just after a newline outside quotes
+                self.assertEqual(data[end - 1:end], b'\n')
+                self.assertEqual(data.count(b'"', 0, end) & 1, 0)
+
+    def test_record_boundary(self):
+        with open(self.path, 'wb') as fh:
+            fh.write(b'a,"x\ny",b\nc,d\n"e\n"')
+        with open(self.path, 'rb') as fh:
+            # The newline in the quoted field does not end the record
+            self.assertEqual(parallel_csv.record_boundary(fh, 0, False), 10)
+            self.assertEqual(parallel_csv.record_boundary(fh, 5, True), 10)
+            self.assertEqual(parallel_csv.record_boundary(fh, 10, False), 14)
+            # The last record has no newline after it
+            self.assertEqual(parallel_csv.record_boundary(fh, 14, False), 18)
+
+
+class BinaryTableTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_convert_round_trip(self):
+        csv_path = os.path.join(self.dir, 'edges.csv')
+        cdx_path = os.path.join(self.dir, 'edges.cdx')
+        write_edges(csv_path, 300)
+        self.assertEqual(neptune_bin.convert(csv_path, cdx_path), 300)
+        self.assertTrue(neptune_bin.is_binary(cdx_path))
+        self.assertFalse(neptune_bin.is_binary(csv_path))
+        self.assertEqual(list(neptune_csv.iter_records(cdx_path, batch_size=64)),
+                         list(neptune_csv.iter_records(csv_path)))
+
+    def test_spooled_columns_round_trip(self):
+        cdx_path = os.path.join(self.dir, 'vertices.cdx')
+        rows = [{"~id": "v%d" % i, "~label": "Station", "lines:int": i * 7 if i % 3 else None,
+                 "name:string": "S%d" % (i % 5) if i % 4 else ''} for i in range(1000)]
+        old_spool_rows, neptune_bin.SPOOL_ROWS = neptune_bin.SPOOL_ROWS, 7
+        try:
+            self.assertEqual(neptune_bin.write_table(cdx_path, ["~id", "~label", "lines:int", "name:string"], rows),
+                             1000)
+        finally:
+            neptune_bin.SPOOL_ROWS = old_spool_rows
+        records = list(neptune_csv.iter_records(cdx_path))
+        self.assertEqual(records[1], {"~id": "v1", "~label": "Station", "lines": 7, "name": "S1"})
+        self.assertEqual(records[12], {"~id": "v12", "~label": "Station"})
+        self.assertEqual([record.get("lines") for record in records],
+                         [i * 7 if i % 3 else None for i in range(1000)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+'''
+Tests for parallel_load.py. Run with `python -m unittest` (or pytest) from this directory.
+'''
+import threading
+import unittest
+
+import metrics
+import write_control
+from parallel_load import ParallelLoader
+from test_delta_load import GraphSink, SinkWriter
+
+
+class CommitThenFail(Exception):
+    pass
+
+
+class FlakySinkWriter(SinkWriter):
+    '''
+    Applies every other create request and then fails it anyway, like a connection lost after the commit.
+    '''
+    def __init__(self, sink):
+        SinkWriter.__init__(self, sink)
+        self.calls = 0
+
+    def _flaky(self, write, batch):
+        self.calls += 1
+        write(self, batch)
+        if self.calls % 2:
+            raise CommitThenFail("connection lost after commit")
+
+    def write_vertices(self, batch):
+        self._flaky(SinkWriter.write_vertices, batch)
+
+    def write_edges(self, batch):
+        self._flaky(SinkWriter.write_edges, batch)
+
+
+class HeldVertexWriter(SinkWriter):
+    '''
+    Holds the batch with vertex v0 until some edge has been written.
+    '''
+    def __init__(self, sink, edge_written):
+        SinkWriter.__init__(self, sink)
+        self.edge_written = edge_written
+        self.edges_first = []
+
+    def write_vertices(self, batch):
+        if any(row["~id"] == "v0" for row in batch):
+            self.edges_first.append(self.edge_written.wait(5))
+        SinkWriter.write_vertices(self, batch)
+
+    def write_edges(self, batch):
+        SinkWriter.write_edges(self, batch)
+        self.edge_written.set()
+
+
+class ScheduleTest(unittest.TestCase):
+    def test_edges_of_committed_partitions_do_not_wait_for_the_rest(self):
+        sink = GraphSink()
+        edge_written = threading.Event()
+        writers = []
+
+        def open_writer():
+            writers.append(HeldVertexWriter(sink, edge_written))
+            return writers[-1]
+
+        vertices = [{"~id": "v%d" % i, "~label": "S"} for i in range(100)]
+        edges = [{"~id": "e%d" % i, "~from": "v%d" % i, "~to": "v%d" % ((i + 1) % 100), "~label": "SEGMENT"}
+                 for i in range(100)]
+        loader = ParallelLoader(open_writer, workers=4, batch_size=5, metrics=metrics.Metrics())
+        self.assertEqual(loader.load(vertices, edges), (100, 100))
+        self.assertEqual([held for writer in writers for held in writer.edges_first], [True])
+        self.assertEqual(len(sink.edges), 100)
+
+
+class RetryTest(unittest.TestCase):
+    def test_retries_after_commit_do_not_duplicate(self):
+        sink = GraphSink()
+        vertices = [{"~id": "v%d" % i, "~label": "S"} for i in range(40)]
+        edges = [{"~id": "e%d" % i, "~from": "v%d" % i, "~to": "v%d" % ((i + 1) % 40), "~label": "SEGMENT"}
+                 for i in range(40)]
+        controller = write_control.WriteController(8, inflight=2, max_retries=3, backoff_base=0.001,
+                                                   is_transient=lambda e: isinstance(e, CommitThenFail))
+        loader = ParallelLoader(lambda: FlakySinkWriter(sink), workers=2, controller=controller)
+        loader.load(vertices, edges)
+        self.assertEqual(len(sink.vertices), 40)
+        self.assertEqual(sorted(edge["~id"] for edge in sink.edges), sorted(edge["~id"] for edge in edges))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+'''
+Tests for preflight.py. Run with `python -m unittest` (or pytest) from this directory.
+'''
+import csv
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import preflight
+
+VERTICES = '''~id,~label,name:string,open:bool,lat:double
+a,S,Alpha,true,1.5
+b,S,Beta,FALSE,2
+a,S,Alpha again,true,1.5
+,S,No id,true,3
+c,S,Gamma,maybe,4
+d,S,Delta,1,notanumber
+e,S,Eps,,
+b,S,Beta,FALSE,2
+'''
+
+EDGES = '''~id,~from,~to,~label,distance:int
+1,a,b,SEG,10
+2,b,zz,SEG,10
+3,c,a,SEG,10
+1,b,a,SEG,10
+4,a,,SEG,1
+5,e,b,SEG,1
+'''
+
+
+class PreflightTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.v_file = self.write('v.csv', VERTICES)
+        self.e_file = self.write('e.csv', EDGES)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as fh:
+            fh.write(text)
+        return path
+
+    def validate(self):
+        v_out, e_out, rejects = io.StringIO(), io.StringIO(), io.StringIO()
+        n_vertices, n_edges, report = preflight.validate(self.v_file, self.e_file, v_out, e_out, rejects)
+        rejected = dict(((row['file'], row['line']), row['reason'])
+                        for row in csv.DictReader(io.StringIO(rejects.getvalue())))
+        clean = [list(csv.reader(io.StringIO(out.getvalue()))) for out in (v_out, e_out)]
+        return n_vertices, n_edges, rejected, clean
+
+    def test_rejects(self):
+        n_vertices, n_edges, rejected, (clean_vertices, clean_edges) = self.validate()
+        self.assertEqual(rejected, {
+            ('v.csv', '4'): preflight.DUPLICATE_ID,
+            ('v.csv', '5'): preflight.MISSING_ID,
+            ('v.csv', '6'): preflight.BAD_VALUE,
+            ('v.csv', '7'): preflight.BAD_VALUE,
+            ('v.csv', '9'): preflight.DUPLICATE_ID,
+            ('e.csv', '3'): preflight.DANGLING_TO,
+            ('e.csv', '4'): preflight.DANGLING_FROM,
+            ('e.csv', '5'): preflight.DUPLICATE_ID,
+            ('e.csv', '6'): preflight.MISSING_ENDPOINT,
+        })
+        self.assertEqual([row[0] for row in clean_vertices], ['~id', 'a', 'b', 'e'])
+        self.assertEqual([row[0] for row in clean_edges], ['~id', '1', '5'])
+        self.assertEqual((n_vertices, n_edges), (3, 2))
+
+    def test_bad_bool_is_rejected(self):
+        self.v_file = self.write('v.csv', '~id,~label,open:bool\na,S,true\nb,S,0\nc,S,maybe\nd,S,ture\n')
+        self.e_file = self.write('e.csv', '~id,~from,~to,~label\n')
+        n_vertices, n_edges, rejected, (clean_vertices, clean_edges) = self.validate()
+        self.assertEqual(rejected, {('v.csv', '4'): preflight.BAD_VALUE, ('v.csv', '5'): preflight.BAD_VALUE})
+        self.assertEqual(clean_vertices, [['~id', '~label', 'open:bool'], ['a', 'S', 'true'], ['b', 'S', '0']])
+
+    def test_id_index(self):
+        index = preflight.IdIndex()
+        for i in range(10000):
+            index.add("id-%d" % i)
+        index.add("id-7")
+        index.freeze()
+        self.assertIn("id-9999", index)
+        self.assertNotIn("id-10000", index)
+        self.assertTrue(index.maybe_duplicate("id-7"))
+        self.assertFalse(index.maybe_duplicate("id-8"))
+        self.assertEqual(len(index), 10001)
+
+
+if __name__ == '__main__':
+    unittest.main()
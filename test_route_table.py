@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+'''
+Tests for route_table.py. Run with `python -m unittest` (or pytest) from this directory.
+'''
+import array
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import route_table
+from station_graph import StationGraph
+
+
+def random_graph(rng, n, edges):
+    '''
+    :param edges: dict of (source, target) vertex numbers -> weight
+    '''
+    ids = ["s%03d" % i for i in range(n)]
+    nan = array.array('d', [float('nan')] * n)
+    keys = sorted(edges)
+    return StationGraph.from_edges(ids, nan, nan, array.array('l', [u for u, v in keys]),
+                                   array.array('l', [v for u, v in keys]),
+                                   array.array('q', [edges[key] for key in keys]))
+
+
+def change(rng, edges, n):
+    '''
+    :return: copy of edges with a few segments made longer, shorter, added and removed
+    '''
+    edges = dict(edges)
+    keys = sorted(edges)
+    for key in rng.sample(keys, 3):
+        edges[key] += rng.randint(1, 500)
+    for key in rng.sample(keys, 3):
+        edges[key] = max(1, edges[key] - rng.randint(1, 500))
+    for key in rng.sample(keys, 2):
+        del edges[key]
+    for _ in range(2):
+        edges[rng.randrange(n), rng.randrange(n)] = rng.randint(1, 1000)
+    return edges
+
+
+class UpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'routes.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertSameRoutes(self, updated, fresh):
+        n = fresh.n
+        weights = fresh.edge_weights()
+        self.assertEqual(list(updated.dist), list(fresh.dist))
+        # Next hops may differ between equally short paths, but must lead along a shortest one
+        for s in range(n):
+            for t in range(n):
+                distance = fresh.distance(fresh.ids[s], fresh.ids[t])
+                path = updated.path(updated.ids[s], updated.ids[t])
+                if distance is None:
+                    self.assertEqual(path, [])
+                    continue
+                self.assertEqual((path[0], path[-1]), (fresh.ids[s], fresh.ids[t]))
+                length = sum(weights[fresh.index[a], fresh.index[b]] for a, b in zip(path, path[1:]))
+                self.assertEqual(length, distance)
+
+    def test_update_matches_full_build(self):
+        rng = random.Random(12)
+        n = 30
+        recomputed = updates = 0
+        for _ in range(8):
+            edges = dict(((rng.randrange(n), rng.randrange(n)), rng.randint(1, 1000)) for _ in range(90))
+            route_table.build(random_graph(rng, n, edges), self.path)
+            for _ in range(3):
+                edges = change(rng, edges, n)
+                graph = random_graph(rng, n, edges)
+                recomputed += route_table.update(self.path, graph)
+                updates += 1
+                route_table.build(graph, self.path + '.fresh')
+                with route_table.RouteTable(self.path) as updated, \
+                        route_table.RouteTable(self.path + '.fresh') as fresh:
+                    self.assertSameRoutes(updated, fresh)
+                    self.assertEqual(list(updated.weights), list(fresh.weights))
+        # Some rows were left alone, or this would not test the incremental update
+        self.assertLess(recomputed, updates * n)
+        # No temporary files are left behind
+        self.assertEqual(sorted(os.listdir(self.dir)), ['routes.bin', 'routes.bin.fresh'])
+
+    def test_open_table_survives_update(self):
+        rng = random.Random(3)
+        edges = dict(((i, (i + 1) % 10), 10) for i in range(10))
+        route_table.build(random_graph(rng, 10, edges), self.path)
+        with route_table.RouteTable(self.path) as table:
+            edges[0, 1] = 100
+            route_table.update(self.path, random_graph(rng, 10, edges))
+            self.assertEqual(table.distance('s000', 's002'), 20)
+        with route_table.RouteTable(self.path) as table:
+            self.assertEqual(table.distance('s000', 's002'), 110)
+
+
+if __name__ == '__main__':
+    unittest.main()
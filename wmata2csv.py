@@ -7,10 +7,15 @@
 import logging
 import argparse
 import json
-import glob
-import collections
 import csv
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+
+import neptune_bin
+from response_cache import ResponseCache
 
 # Custom modules
 #import util.colorized_console_logging
@@ -20,27 +25,150 @@ APP_NAME = 'wmata2csv'
 logger = logging.getLogger(APP_NAME)
 logger.setLevel(logging.DEBUG)
 
-loggingFileHandler = logging.FileHandler(APP_NAME+'.log', mode='w')
-loggingFileHandler.setLevel(logging.DEBUG)
-
 loggingFormatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s (%(filename)s:%(lineno)d )')
-loggingFileHandler.setFormatter(loggingFormatter)
 
-logger.addHandler(loggingFileHandler)
+class RateLimiter(object):
+    """ Spaces out calls so no more than `rate` start per second, across all threads. A rate of 0 disables it.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
 
-def main():
-    logger.debug('Starting...')
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
 
-    args = load_cmdline_args()
 
-    url = 'http://api.wmata.com/Rail.svc/json/jLines'
-    headers = {'api_key': args.api_key}
+class OfflineCacheMiss(Exception):
+    pass
 
-    r = requests.get(url, headers=headers)
 
+class WmataClient(object):
+    """ Shared keep-alive session for the WMATA API. The connection pool is sized to the number of workers so
+        concurrent requests reuse connections instead of opening a new TCP/TLS connection each time.
+
+        If a ResponseCache is given, fresh entries are served without touching the network and stale ones are
+        revalidated with a conditional request. In offline mode only the cache is used.
+    """
+    def __init__(self, api_key, workers=4, rate=10, cache=None, offline=False):
+        self.session = requests.Session()
+        if api_key:
+            self.session.headers['api_key'] = api_key
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.limiter = RateLimiter(rate)
+        self.workers = workers
+        self.cache = cache
+        self.offline = offline
+
+    def get_json(self, url, params=None):
+        entry = self.cache.get(url, params) if self.cache is not None else None
+
+        if self.offline:
+            if entry is None:
+                raise OfflineCacheMiss("No cached response for %s %s" % (url, params))
+            return entry["body"]
+
+        if entry is not None and self.cache.is_fresh(entry):
+            logger.debug("Cache hit %s %s" % (url, params))
+            return entry["body"]
+
+        # Stale (or missing) entry: ask the server whether our copy is still good
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers['If-None-Match'] = entry["etag"]
+            if entry.get("last_modified"):
+                headers['If-Modified-Since'] = entry["last_modified"]
+
+        self.limiter.wait()
+        logger.debug("GET %s %s" % (url, params))
+        r = self.session.get(url, params=params, headers=headers)
+
+        if r.status_code == 304 and entry is not None:
+            logger.debug("Not modified %s %s" % (url, params))
+            return self.cache.refresh(url, params, entry)["body"]
+
+        r.raise_for_status()
+        body = r.json()
+        if self.cache is not None:
+            self.cache.put(url, params, body, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        return body
+
+    def map_json(self, url, params_list):
+        """ Fetch url once per params dict, concurrently, returning the responses in the same order.
+        """
+        return list(self.imap_json(url, params_list))
+
+    def imap_json(self, url, params_list):
+        """ Like map_json, but every request is started right away and the responses are yielded in order as they
+            become available, so the caller can get on with other work while they are in flight.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = [executor.submit(self.get_json, url, params) for params in params_list]
+        # Lets the threads exit once the queued requests are done, without waiting here
+        executor.shutdown(wait=False)
+        return (future.result() for future in futures)
+
+
+LINES_URL = 'https://api.wmata.com/Rail.svc/json/jLines'
+STATIONS_URL = 'https://api.wmata.com/Rail.svc/json/jStations'
+PATH_URL = 'https://api.wmata.com/Rail.svc/json/jPath'
+
+STATION_HEADERS = ["~id", "~label", "name:string", "lat:double", "lon:double", "color:string"]
+SEGMENT_HEADERS = ["~id", "~from", "~to", "~label", "distance:int", "color:string"]
+
+# Tags for the records yielded by iter_graph()
+VERTEX = 'vertex'
+EDGE = 'edge'
+
+
+def is_station_together(station, code):
+    """ True if the station record and the station with the given code are platforms of the same station.
+    """
+    return code in (station.get("StationTogether1"), station.get("StationTogether2"))
+
+
+def station_ids(stations):
+    """ Vertex id for every station code. Stations are identified by name; the codes of one station's platforms
+        (linked by StationTogether1/2) share it, and an unrelated station that has the same name as an earlier
+        one gets "Name (Code)" instead of clobbering it.
+        :param stations: the 'Stations' list of the jStations response
+        :return: {code: id}
+    """
+    ids = {}
+    same_name = {}
+    for s in stations:
+        station_id = s['Name']
+        earlier = same_name.setdefault(s['Name'], [])
+        if earlier and not any(is_station_together(s, e['Code']) or is_station_together(e, s['Code'])
+                               for e in earlier):
+            station_id = "%s (%s)" % (s['Name'], s['Code'])
+            logger.warning("Station %s shares the name %s with %s; its id is %s" % (
+                s['Code'], s['Name'], ', '.join(e['Code'] for e in earlier), station_id))
+        earlier.append(s)
+        ids[s['Code']] = station_id
+    return ids
+
+
+def iter_graph(client):
+    """ Fetch the network and yield (VERTEX, record) for every station, then (EDGE, record) for every track
+        segment, as they are produced. Records are dicts keyed by the Neptune CSV headers.
+
+        The path requests for all lines are sent before the first station is yielded, so they are in flight while
+        the consumer deals with the stations.
+    """
     # Get the lines
     lines = {}
-    for l in r.json()['Lines']:
+    for l in client.get_json(LINES_URL)['Lines']:
         print(l["DisplayName"])
         lines[l["LineCode"]] = {
             "id": l["LineCode"],
@@ -50,20 +178,23 @@ def main():
             "EndStationCode": l["EndStationCode"]
         }
 
-    #print(lines)
-
-
     # Get the Stations
-    url = 'http://api.wmata.com/Rail.svc/json/jStations'
-    r = requests.get(url, headers=headers)
+    stations_json = client.get_json(STATIONS_URL)
 
-    stations = {}
-    code_to_station = {}
-    for s in r.json()['Stations']:
-        # One station can have multiple track Codes, so we need the dict lookup
-        code_to_station[s['Code']] = s['Name']
+    # Get the track segments
+    # For each line, pull down the full path. These are independent so fetch them all at once.
+    line_list = list(lines.values())
+    payloads = [{
+        "FromStationCode": line["StartStationCode"],
+        "ToStationCode": line["EndStationCode"]
+    } for line in line_list]
+    path_jsons = client.imap_json(PATH_URL, payloads)
 
-        #print(s)
+    stations = {}
+    # One station can have multiple track Codes, so we need the dict lookup
+    code_to_station = station_ids(stations_json['Stations'])
+    for s in stations_json['Stations']:
+        station_id = code_to_station[s['Code']]
 
         # This doesn't do what I want; lots of stations have multiple lines
         # Set the color
@@ -72,17 +203,15 @@ def main():
         # else:
         #     color = lines[s["LineCode1"]]["color"]
         if s["StationTogether1"] is not None and s["StationTogether1"]:
-            #print("|"+s["StationTogether1"]+"|")
             color = "purple"
         else:
             color = lines[s["LineCode1"]]["color"]
 
-
-
         # Station names are the only way to id stations?
-        # note that the same station shows up multiple times but we're just clobbering it and loosing Code/StationTogether1 info
-        stations[s['Name']] = {
-            "~id": s['Name'],
+        # note that the same station shows up multiple times (once per platform Code, linked by StationTogether1)
+        # and we're just clobbering it and loosing Code/StationTogether1 info; only unrelated stations get their own id
+        stations[station_id] = {
+            "~id": station_id,
             "~label": "STATION",
             "name:string": s['Name'],
             "lat:double": s['Lat'],
@@ -91,281 +220,132 @@ def main():
             "color:string": color
         }
 
-
-    # Write stations to disk
-    out_file_name = "data/station-nodes.csv"
-    out_fh = None
-    try:
-        out_fh = open(out_file_name, mode='wb')
-    except IOError as io_err:
-        err_msg = "Unable to write to file (%s). %s" % (out_file_name, io_err)
-        logger.error(err_msg)
-        print(err_msg)
-        exit(1)
-
-    sorted_headers=["~id", "~label", "name:string", "lat:double", "lon:double", "color:string"]
-    writer = csv.DictWriter(out_fh, sorted_headers, restval='', extrasaction='ignore', delimiter=',')
-    writer.writeheader()
     for station in stations.values():
-        writer.writerow(station)
-
+        yield VERTEX, station
 
-    # Get the track segments
-    segments = {}
-    for line in lines.values():
-        # For each line, pull down the full path
-        payload = {
-            "FromStationCode": line["StartStationCode"],
-            "ToStationCode": line["EndStationCode"]
-        }
-
-
-        url = 'https://api.wmata.com/Rail.svc/json/jPath'
-        r = requests.get(url, headers=headers, params=payload)
-
-        paths = r.json()["Path"]
+    # Lines share track, so the same segment can come up more than once; the first line it is seen on keeps it
+    seen = set()
+    for line, path_json in zip(line_list, path_jsons):
+        paths = path_json["Path"]
         prev_code = line["StartStationCode"]
         for p in paths[1:]:
-            id = "%s_%s" % (prev_code, p["StationCode"])
-            #print(s)
-            segments[id] = {
-                "~id": id,
-                "~from": code_to_station[prev_code],
-                "~to": code_to_station[p["StationCode"]],
-                "~label": "SEGMENT",
-                "distance:int": p["DistanceToPrev"],
-                "linecode:string": p["LineCode"],
-                "color:string": lines[p["LineCode"]]["color"]
-            }
-
-            # Create the same track in the opposite direction
-            id = "%s_%s" % (p["StationCode"], prev_code)
-            #print(s)
-            segments[id] = {
-                "~id": id,
-                "~from": code_to_station[p["StationCode"]],
-                "~to": code_to_station[prev_code],
-                "~label": "SEGMENT",
-                "distance:int": p["DistanceToPrev"],
-                "linecode:string": p["LineCode"],
-                "color:string": lines[p["LineCode"]]["color"]
-            }
+            # The segment, and the same track in the opposite direction
+            for from_code, to_code in ((prev_code, p["StationCode"]), (p["StationCode"], prev_code)):
+                id = "%s_%s" % (from_code, to_code)
+                if id in seen:
+                    continue
+                seen.add(id)
+                yield EDGE, {
+                    "~id": id,
+                    "~from": code_to_station[from_code],
+                    "~to": code_to_station[to_code],
+                    "~label": "SEGMENT",
+                    "distance:int": p["DistanceToPrev"],
+                    "linecode:string": p["LineCode"],
+                    "color:string": lines[p["LineCode"]]["color"]
+                }
 
             prev_code = p["StationCode"]
 
 
-    # Write track segments to disk
-    out_file_name = "data/station-edges.csv"
-    out_fh = None
+def open_output(out_file_name):
     try:
-        out_fh = open(out_file_name, mode='wb')
+        return open(out_file_name, mode='w', newline='')
     except IOError as io_err:
         err_msg = "Unable to write to file (%s). %s" % (out_file_name, io_err)
         logger.error(err_msg)
         print(err_msg)
         exit(1)
 
-    sorted_headers=["~id", "~from", "~to", "~label", "distance:int", "color:string"]
-    writer = csv.DictWriter(out_fh, sorted_headers, restval='', extrasaction='ignore', delimiter=',')
-    writer.writeheader()
-    for segment in segments.values():
-        writer.writerow(segment)
-
-
-
-
-    # # Confirm we can write the output file before proceeding with more expensive operations like
-    # # iterating over several input files...
-
-    #
-    # in_files = glob.glob(args.inFiles)
-    #
-    # # Go through ALL of the JSON files and extract headers (and only headers) from each one. At the
-    # # end of this loop we'll be left with a "master" set of headers which covers all possible fields
-    # # from all of the JSON files. This is important because we'll be exporting ALL of the JSON files
-    # # to a single CSV file; the headers for that file need to cover all possible fields.
-    # csv_header_set = set([])
-    # counter = 1
-    # logger.info("Collecting headers from all files...")
-    # for input_filepath in in_files:
-    #
-    #     # Respect the --limit parameter if specified by user
-    #     if counter > args.limit:
-    #         break
-    #
-    #     #logger.debug("Collecting headers from %s" % input_filepath)
-    #
-    #     try:
-    #         json_input_fh = open(input_filepath, mode='r')
-    #
-    #         # This dictionary may contain other dictionaries (aka "deep")
-    #         deep_data_dict = json.load(json_input_fh, encoding=args.inFileEncoding)
-    #         json_input_fh.close()
-    #
-    #         # "Flatten" any child dicts such that we are left with a dictionary whose values will
-    #         # never be dictionaries (i.e., no dicts within dicts).
-    #         shallow_data_dict = flatten_dict(deep_data_dict)
-    #
-    #         csv_header_set.update( shallow_data_dict.keys() )
-    #
-    #     except ValueError as value_err:
-    #         err_msg = "Ignoring %s; unable to parse JSON (%s)" % (input_filepath, value_err)
-    #         logger.error(err_msg)
-    #         print err_msg
-    #
-    #     except IOError as io_err:
-    #         err_msg = "Ignoring %s; unable to open the file (%s)" % (input_filepath, io_err)
-    #         logger.error(err_msg)
-    #         print err_msg
-    #
-    #     counter += 1
-    #
-    #
-    # sorted_headers = sorted(list(csv_header_set))
-    #
-    # # restval parameter specifies the value to be written if the dictionary is missing a key in
-    # # fieldnames. extrasaction parameter indicates what action to take if the dictionary passed to
-    # # the writerow() method contains a key not found in fieldnames
-    # writer = csv.DictWriter(out_fh, sorted_headers, restval='', extrasaction='ignore', delimiter=args.delimiter)
-    #
-    # logger.debug("Headers: %s" % json.dumps(sorted_headers))
-    # logger.info("Writing headers to %s..." % out_file_name)
-    # writer.writeheader()
-    #
-    # # Go through all the JSON files again, but this time output each one to the CSV file.
-    # counter = 1
-    # for input_filepath in in_files:
-    #
-    #     # Respect the --limit parameter if specified by user
-    #     if counter > args.limit:
-    #         break
-    #
-    #     #logger.debug("Converting %s to CSV" % input_filepath)
-    #
-    #     try:
-    #         json_input_fh = open(input_filepath, mode='r')
-    #
-    #         # This dictionary may contain other dictionaries (aka "deep")
-    #         deep_data_dict = json.load(json_input_fh, encoding=args.inFileEncoding)
-    #         json_input_fh.close()
-    #
-    #         # "Flatten" any child dicts such that we are left with a dictionary whose values will
-    #         # never be dictionaries (i.e., no dicts within dicts).
-    #         shallow_data_dict = flatten_dict(deep_data_dict)
-    #
-    #         writer.writerow(shallow_data_dict)
-    #
-    #     except ValueError as value_err:
-    #         err_msg = "Ignoring %s; unable to parse JSON (%s)" % (input_filepath, value_err)
-    #         logger.error(err_msg)
-    #         print err_msg
-    #
-    #     except IOError as io_err:
-    #         err_msg = "Ignoring %s; unable to open the file (%s)" % (input_filepath, io_err)
-    #         logger.error(err_msg)
-    #         print err_msg
-    #
-    #     counter += 1
-
-
-def flatten_dict(d, parent_key=''):
-    """ Due credit to Baby Mouth Holloway for the original version of this function (which was mostly
-     just modified to support lists).
-    """
-    colname_val_tuple_list = []
-
-    for current_key, current_value in d.items():
-
-        # Create a key (i.e., CSV column name). If a parent key was passed in use that as the base.
-        colname = "%s.%s" % (parent_key, current_key) if parent_key else current_key
-
-        # If the current value is a dictionary...
-        if isinstance(current_value, collections.MutableMapping):
-
-            # ...flatten that dict and convert it to a list of key/value tuples
-            flattened_dict_tuple_list = flatten_dict(current_value, colname).items()
-
-            # ...add each of those key/value pairs to the list
-            colname_val_tuple_list.extend( flattened_dict_tuple_list )
-
-        # If the current value is a list...
-        elif isinstance(current_value, list):
-
-            # ...flatten all items in the list and add the resulting key/value pairs
-            flattened_list_tuples = flatten_list(current_value, colname).items()
-            colname_val_tuple_list.extend( flattened_list_tuples )
-
-        else:
-
-            # If the value is a unicode string, we need to UTF-8 encode it
-            if isinstance(current_value, unicode):
-                current_value = current_value.encode('utf8', 'ignore')
 
-            # Add the key/value pair
-            colname_val_tuple_list.append( (colname, current_value) )
-
-    # Convert all the key/value pairs (tuples) into a dictionary
-    return dict(colname_val_tuple_list)
-
-
-def flatten_list(the_list, parent_key=''):
-    colname_val_tuple_list = []
-
-    # For each item in the list, either append that item as a colname/value pair or flatten the
-    # item (i.e., it's a dict) and add those key/value pairs.
-    item_counter = 0
-    for item in the_list:
-        colname = "%s.%s" % (parent_key, item_counter)
-
-        # If the current value is a dictionary...
-        if isinstance(item, collections.MutableMapping):
-
-            flattened_item_tuple_list = flatten_dict(item, colname).items()
-            colname_val_tuple_list.extend( flattened_item_tuple_list )
-
-        # If the current value is a list...
-        elif isinstance(item, list):
+def write_graph(records, binary=False):
+    """ Write the records from iter_graph() to data/station-nodes.csv and data/station-edges.csv as they arrive
+        (and to the .cdx tables too if binary).
+        :return: (stations written, segments written)
+    """
+    outputs = {}
+    for tag, out_file_name, headers in ((VERTEX, "data/station-nodes.csv", STATION_HEADERS),
+                                        (EDGE, "data/station-edges.csv", SEGMENT_HEADERS)):
+        out_fh = open_output(out_file_name)
+        writer = csv.DictWriter(out_fh, headers, restval='', extrasaction='ignore', delimiter=',')
+        writer.writeheader()
+        table = neptune_bin.TableWriter(out_file_name[:-len('.csv')] + '.cdx', headers) if binary else None
+        outputs[tag] = (out_fh, writer, table)
+
+    counts = {VERTEX: 0, EDGE: 0}
+    for tag, record in records:
+        out_fh, writer, table = outputs[tag]
+        writer.writerow(record)
+        if table is not None:
+            table.writerow(record)
+        counts[tag] += 1
+
+    for out_fh, writer, table in outputs.values():
+        out_fh.close()
+        if table is not None:
+            table.close()
+    return counts[VERTEX], counts[EDGE]
+
+
+def client_from_args(args):
+    """ WmataClient (and its response cache) for the options added by add_fetch_options().
+    """
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_dir, ttl=args.cache_ttl, max_bytes=int(args.cache_max_mb * 1024 * 1024))
+    return WmataClient(args.api_key, workers=args.api_workers, rate=args.rate_limit, cache=cache, offline=args.offline)
 
-            # ...flatten all items in the list and add the resulting key/value pairs
-            flattened_list_tuples = flatten_list(item, colname).items()
-            colname_val_tuple_list.extend( flattened_list_tuples )
 
-        else:
+def main():
+    args = load_cmdline_args()
 
-            # If the value is a unicode string, we need to UTF-8 encode it
-            if isinstance(item, unicode):
-                item = item.encode('utf8', 'ignore')
-                colname_val_tuple_list.append( (colname, item) )
+    # Opened here rather than on import, so importing this module (pipeline.py, coredex.py) leaves the log alone
+    loggingFileHandler = logging.FileHandler(APP_NAME+'.log', mode='w')
+    loggingFileHandler.setLevel(logging.DEBUG)
+    loggingFileHandler.setFormatter(loggingFormatter)
+    logger.addHandler(loggingFileHandler)
+    logger.debug('Starting...')
 
-            else:
+    client = client_from_args(args)
 
-                # Add the key/value pair
-                colname_val_tuple_list.append( (colname, item) )
+    n_stations, n_segments = write_graph(iter_graph(client), binary=args.binary)
+    logger.info("Wrote %d stations and %d segments" % (n_stations, n_segments))
 
 
-        item_counter += 1
+def add_fetch_options(parser, workers_option='--workers'):
+    """ Add the options for talking to the WMATA API; shared with pipeline.py.
+        :param workers_option: name of the API concurrency option, for tools that already have a --workers
+    """
+    parser.add_argument('-a', '--api_key', dest='api_key', action="store", metavar="API_KEY")
+    parser.add_argument(workers_option, dest='api_workers', type=int, default=4, help='Maximum number of concurrent API requests (default 4)')
+    parser.add_argument('--rate_limit', type=float, default=10, help='Maximum API requests per second, 0 for no limit (default 10)')
+    parser.add_argument('--cache_dir', default='.wmata_cache', help='Directory for cached API responses (default .wmata_cache)')
+    parser.add_argument('--cache_ttl', type=float, default=86400, help='Seconds before a cached response is revalidated (default 86400)')
+    parser.add_argument('--cache_max_mb', type=float, default=100, help='Maximum size of the response cache in MB (default 100)')
+    parser.add_argument('--no_cache', action='store_true', help='Always fetch from the API and do not cache responses')
+    parser.add_argument('--offline', action='store_true', help='Build the graph purely from cached responses, without the network')
 
-    # Convert all the key/value pairs (tuples) into a dictionary
-    return dict(colname_val_tuple_list)
 
+def check_fetch_options(parser, args):
+    if args.offline and args.no_cache:
+        parser.error("--offline needs the response cache")
+    if not args.offline and not args.api_key:
+        parser.error("--api_key is required unless running --offline")
 
 
 def load_cmdline_args():
     parser = argparse.ArgumentParser(description="A command-line utility for dumping the WMATA transportation network as CSV")
-    #parser.add_argument('--inFiles', nargs='?', required=True, help='Path to input file(s)')
-    #parser.add_argument('--inFileEncoding', nargs='?', default="utf-8", help='Encoding for input files. Defaults to UTF-8')
-    #parser.add_argument('--outFile', default="out.csv", help='Output CSV')
-    #parser.add_argument('--limit', type=int, default=float('inf'), nargs='?', help='Limits the number of input files that are processed')
     parser.add_argument('--verbose', nargs='?', default=False, help='Displays verbose logging to console')
-    #parser.add_argument('--delimiter', default=',', help='Character to use as delimiter in output file (default comma)')
 
-    parser.add_argument('-a', '--api_key', dest='api_key', action="store", metavar="API_KEY", required=True)
+    add_fetch_options(parser)
+    parser.add_argument('--binary', action='store_true', help='Also write the compact binary tables data/station-nodes.cdx and data/station-edges.cdx')
 
     args = parser.parse_args()
+    check_fetch_options(parser, args)
 
     # Verbose flag means showing the logger output in the console
     if args.verbose != False:
-        loggingConsoleHandler = util.colorized_console_logging.ColorizingStreamHandler()
+        loggingConsoleHandler = logging.StreamHandler()
         loggingConsoleHandler.setLevel(logging.DEBUG)
         loggingConsoleHandler.setFormatter(loggingFormatter)
         logger.addHandler(loggingConsoleHandler)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+'''
+Adaptive batch size and concurrency for the loaders' write requests (used by parallel_load.ParallelLoader).
+
+The controller works like TCP congestion control (AIMD). After every "round" of successful requests that came back
+under the target latency, it grows the batch size by a fixed step and allows one more request in flight. A slow
+request, or a transient failure (timeouts, Neptune ConcurrentModificationException/throttling, Neo4j transient and
+transaction memory errors), halves both. Requests that were already in flight when the limits were cut do not cut
+them again, so one overloaded moment causes one decrease rather than one per outstanding request.
+
+A request that failed with a transient error is retried after a jittered exponential backoff ("full jitter": a random
+sleep of up to base * 2^attempt seconds, capped). Retries are split down to the current batch size first, so a batch
+that was too big for the server's transaction memory does not fail the same way again. A failed request is not
+always a request that left nothing behind: the connection can drop after the commit went through (Neo4j
+ServiceUnavailable/SessionExpired), and a Neptune time limit can hit a batch that was partly applied. So
+parallel_load.py retries through the writers' idempotent upserts (MERGE, fold/coalesce), which cannot duplicate
+rows or fail on ids that the first attempt did create.
+'''
+from __future__  import print_function  # Python 2/3 compatibility
+import logging
+import random
+import threading
+
+LOG = logging.getLogger('write_control')
+
+
+def never_transient(exc):
+    return False
+
+
+class WriteController(object):
+    '''
+    Thread safe AIMD controller for one load.
+    :param batch_size: initial rows per request
+    :param max_batch_size: upper limit for the batch size (defaults to batch_size, i.e. no growth)
+    :param min_batch_size: lower limit for the batch size
+    :param inflight: initial number of requests allowed in flight
+    :param max_inflight: upper limit for requests in flight
+    :param target_latency: seconds; a request slower than this counts as congestion
+    :param adaptive: False keeps batch size and in-flight limit fixed (retries still apply)
+    :param max_retries: attempts after the first for a transiently failing request
+    :param backoff_base: seconds, first retry waits up to this long
+    :param backoff_cap: seconds, no retry waits longer than this
+    :param is_transient: callable(exception) -> bool deciding whether a failure is retried
+    :param metrics: optional metrics.Metrics to publish the limits and retries to
+    '''
+    def __init__(self, batch_size, max_batch_size=None, min_batch_size=1, inflight=1, max_inflight=8,
+                 target_latency=2.0, adaptive=True, max_retries=5, backoff_base=0.1, backoff_cap=10.0,
+                 is_transient=never_transient, metrics=None):
+        self.max_batch_size = max(max_batch_size or batch_size, batch_size)
+        self.min_batch_size = min(min_batch_size, batch_size)
+        self.max_inflight = max(max_inflight, 1)
+        self.target_latency = target_latency
+        self.adaptive = adaptive
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.is_transient = is_transient
+        self.metrics = metrics
+
+        self.lock = threading.Lock()
+        self.batch_size = batch_size
+        self.inflight = min(max(inflight, 1), self.max_inflight)
+        # Additive step: reach the maximum batch size in about 20 good rounds
+        self.step = max(1, (self.max_batch_size - batch_size) // 20)
+        self._generation = 0
+        self._successes = 0
+        self._publish()
+
+    @classmethod
+    def fixed(cls, batch_size, inflight):
+        '''
+        Controller that never adapts or retries, i.e. the loaders' behaviour without one.
+        '''
+        return cls(batch_size, inflight=inflight, max_inflight=inflight, adaptive=False, max_retries=0)
+
+    def start(self):
+        '''
+        Called when a request is sent.
+        :return: ticket to pass to succeeded() / failed()
+        '''
+        with self.lock:
+            return self._generation
+
+    def succeeded(self, ticket, rows, seconds):
+        if not self.adaptive:
+            return
+        with self.lock:
+            if seconds > self.target_latency:
+                self._decrease(ticket, "%.2fs request for %d rows" % (seconds, rows))
+                return
+            # Grow once per round of requests, i.e. once per inflight successes
+            self._successes += 1
+            if self._successes < self.inflight:
+                return
+            self._successes = 0
+            self.batch_size = min(self.batch_size + self.step, self.max_batch_size)
+            self.inflight = min(self.inflight + 1, self.max_inflight)
+            self._publish()
+
+    def failed(self, ticket, exc):
+        '''
+        :return: True if the request should be retried
+        '''
+        transient = self.is_transient(exc)
+        if transient and self.adaptive:
+            with self.lock:
+                self._decrease(ticket, "%s: %s" % (type(exc).__name__, exc))
+        return transient
+
+    def _decrease(self, ticket, reason):
+        # Only requests sent since the last decrease may cut the limits again
+        if ticket < self._generation:
+            return
+        self._generation += 1
+        self._successes = 0
+        self.batch_size = max(self.batch_size // 2, self.min_batch_size)
+        self.inflight = max(self.inflight // 2, 1)
+        LOG.info("Backing off to batch size %d, %d in flight (%s)", self.batch_size, self.inflight, reason)
+        self._publish()
+
+    def _publish(self):
+        if self.metrics is not None:
+            self.metrics.gauge('batch_size', self.batch_size)
+            self.metrics.gauge('inflight_limit', self.inflight)
+
+    def backoff(self, attempt):
+        '''
+        :param attempt: number of the retry, starting at 0
+        :return: seconds to sleep before it
+        '''
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def split(self, batch):
+        '''
+        Cut a batch (e.g. one that is to be retried) down to the current batch size.
+        :return: list of non-empty batches
+        '''
+        size = self.batch_size
+        if len(batch) <= size:
+            return [batch] if batch else []
+        return [batch[start:start + size] for start in range(0, len(batch), size)]
+
+
+def add_options(parser, max_batch_size):
+    '''
+    Add the options for the write controller shared by the loaders; -b/--batch-size is the initial batch size.
+    :param max_batch_size: default for --max-batch-size
+    '''
+    parser.add_argument('--fixed-batch', dest='fixed_batch', action="store_true",
+                        help='Keep the batch size and number of requests in flight fixed instead of adapting them')
+    parser.add_argument('--max-batch-size', dest='max_batch_size', action="store", metavar="INT", type=int,
+                        default=max_batch_size, help='Largest batch size to grow to (default %d)' % max_batch_size)
+    parser.add_argument('--target-latency', dest='target_latency', action="store", metavar="SECONDS", type=float,
+                        default=2.0, help='Slower requests count as overload and shrink the batches (default 2)')
+    parser.add_argument('--retries', dest='retries', action="store", metavar="INT", type=int, default=5,
+                        help='Retries with jittered backoff for transient failures (default 5)')
+
+
+def controller_from_args(args, is_transient, metrics=None):
+    '''
+    Build the WriteController for the options added by add_options() and the loaders' -b and -w.
+    '''
+    inflight = args.workers * 2 if args.fixed_batch else args.workers
+    return WriteController(args.batch_size, max_batch_size=args.max_batch_size,
+                           inflight=inflight, max_inflight=args.workers * 2,
+                           target_latency=args.target_latency, adaptive=not args.fixed_batch,
+                           max_retries=args.retries, is_transient=is_transient, metrics=metrics)